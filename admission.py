@@ -0,0 +1,191 @@
+"""Контроль допуска: классы приоритета обработчиков и сброс нагрузки
+
+Класс обработчика задается флагом aiogram:
+    @router.message(Command("ask"), flags={"admission": "text"})
+"interactive" (по умолчанию) - меню и команды без обращения к моделям,
+"text" / "image" - генерация, "model" - по выбранной пользователем модели.
+Ожидающие места обработчики выстраиваются по классу, внутри класса платные
+пакеты идут раньше бесплатных.
+"""
+import asyncio
+import bisect
+import itertools
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message, TelegramObject
+
+from config import (
+    ADMISSION_MAX_CONCURRENT, ADMISSION_CLASS_SHARE, ADMISSION_QUEUE_BUDGET,
+    ADMISSION_WAIT_TIMEOUT, ADMISSION_INTERACTIVE_RESERVED, MODELS, PREMIUM_TIERS
+)
+from user_context import user_models, user_tiers
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE, TEXT, IMAGE = 0, 1, 2
+CLASS_NAMES = ("interactive", "text", "image")
+
+BUSY_TEXT = "⏳ Бот сейчас перегружен. Попробуйте ещё раз через минуту."
+
+
+class AdmissionController:
+    """Общий предел одновременных обработчиков с приоритетной очередью"""
+
+    def __init__(self, max_concurrent: int = ADMISSION_MAX_CONCURRENT, shares=ADMISSION_CLASS_SHARE,
+                 budgets=ADMISSION_QUEUE_BUDGET, wait_timeout: float = ADMISSION_WAIT_TIMEOUT,
+                 reserved: int = ADMISSION_INTERACTIVE_RESERVED):
+        self.max_concurrent = max_concurrent
+        self.class_limits = [max(1, int(max_concurrent * share)) for share in shares]
+        # Общий предел text и image: доли классов в сумме могут быть больше 1,
+        # а меню, /limits и кнопке отмены всегда должны оставаться свободные места
+        self.generation_limit = max(1, max_concurrent - reserved)
+        self.budgets = budgets
+        self.wait_timeout = wait_timeout
+        self.active = [0, 0, 0]
+        self.waiting = [0, 0, 0]
+        # Отсортированный список ((класс, бесплатный, порядок), future)
+        self.waiters = []
+        self._order = itertools.count()
+        self.admitted = [0, 0, 0]
+        self.shed = [0, 0, 0]
+
+    def _dispatch(self):
+        """Отдает освободившиеся места ожидающим в порядке приоритета"""
+        i = 0
+        while i < len(self.waiters) and sum(self.active) < self.max_concurrent:
+            key, future = self.waiters[i]
+            if future.done():
+                # Ожидание отменено или истекло
+                del self.waiters[i]
+                continue
+            priority = key[0]
+            generation_full = (
+                priority != INTERACTIVE and self.active[TEXT] + self.active[IMAGE] >= self.generation_limit
+            )
+            if self.active[priority] < self.class_limits[priority] and not generation_full:
+                del self.waiters[i]
+                self.active[priority] += 1
+                future.set_result(None)
+            else:
+                i += 1
+
+    async def acquire(self, priority: int, paid: bool = False) -> bool:
+        """Ждет места для обработчика; False - обработчик нужно отклонить"""
+        if self.waiting[priority] >= self.budgets[priority]:
+            self.shed[priority] += 1
+            return False
+
+        future = asyncio.get_running_loop().create_future()
+        bisect.insort(self.waiters, ((priority, 0 if paid else 1, next(self._order)), future), key=lambda w: w[0])
+        self.waiting[priority] += 1
+        self._dispatch()
+        try:
+            if not future.done():
+                await asyncio.wait_for(asyncio.shield(future), self.wait_timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if future.done():
+                self.release(priority)
+            else:
+                future.cancel()
+            raise
+        finally:
+            self.waiting[priority] -= 1
+
+        if future.done() and not future.cancelled():
+            self.admitted[priority] += 1
+            return True
+        future.cancel()
+        self.shed[priority] += 1
+        return False
+
+    def release(self, priority: int):
+        self.active[priority] -= 1
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "active": self.active[i],
+                "waiting": self.waiting[i],
+                "limit": self.class_limits[i],
+                "admitted": self.admitted[i],
+                "shed": self.shed[i],
+            }
+            for i, name in enumerate(CLASS_NAMES)
+        }
+
+
+admission = AdmissionController()
+
+
+def handler_priority(data: dict) -> int:
+    """Класс приоритета обработчика по флагу "admission\""""
+    flag = get_flag(data, "admission", default="interactive")
+    if flag == "model":
+        user = data.get("event_from_user")
+        model_key = user_models.get(user.id, "text") if user else "text"
+        return TEXT if "system_prompt" in MODELS.get(model_key, {}) else IMAGE
+    return CLASS_NAMES.index(flag)
+
+
+async def reply_busy(event: TelegramObject):
+    """Быстрый ответ отклоненному обработчику"""
+    try:
+        # Для callback - всплывающее уведомление, для сообщения - ответ в чат
+        if isinstance(event, (CallbackQuery, Message)):
+            await event.answer(BUSY_TEXT)
+    except Exception as e:
+        logger.error(f"Не удалось ответить об отказе: {e}")
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Пропускает обработчик, когда для его класса есть место
+
+    Регистрируется первым, до UserContextMiddleware: отклоненный update
+    не читает хранилище. Пакет для порядка в очереди берется из user_tiers
+    (записи, уже загружавшиеся процессом; неизвестный пользователь - free).
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        priority = handler_priority(data)
+        user = data.get("event_from_user")
+        paid = user is not None and user_tiers.get(user.id) in PREMIUM_TIERS
+
+        if not await admission.acquire(priority, paid):
+            logger.warning(f"Перегрузка: отклонен обработчик класса {CLASS_NAMES[priority]}")
+            await reply_busy(event)
+            return None
+        try:
+            return await handler(event, data)
+        finally:
+            admission.release(priority)
+
+
+if __name__ == "__main__":
+    # Проверка: python admission.py
+    # text и image заполняют все доступные им места - interactive все равно проходит сразу
+    async def check():
+        controller = AdmissionController(max_concurrent=10, shares=(1.0, 0.8, 0.5), budgets=(100, 100, 100),
+                                         wait_timeout=0.1, reserved=3)
+        admitted = {TEXT: 0, IMAGE: 0}
+        for priority in (TEXT, IMAGE) * 10:
+            if await controller.acquire(priority):
+                admitted[priority] += 1
+        generation = admitted[TEXT] + admitted[IMAGE]
+        assert generation == controller.generation_limit == 7, admitted
+        for _ in range(3):
+            assert await controller.acquire(INTERACTIVE), "interactive ждет, хотя места зарезервированы"
+        assert not await controller.acquire(INTERACTIVE), "общий предел превышен"
+        print(f"text {admitted[TEXT]}, image {admitted[IMAGE]}, interactive 3 из 3 зарезервированных мест: OK")
+
+    asyncio.run(check())
@@ -1,80 +1,302 @@
 """Генерация текста и изображений через NVIDIA API"""
+import asyncio
+import hashlib
 import logging
-import base64
-import re
+import random
+import time
 import aiohttp
-import httpx
-from openai import OpenAI
-from config import NVIDIA_API_KEY, MODELS
-from user_manager import get_user_history, add_to_history
+from config import (
+    NVIDIA_API_KEY, MODELS, HEDGE_ENABLED, LLM_BASE_URL, DEFAULT_LLM_UPSTREAMS,
+    TRANSLATE_UPSTREAMS, ROUTER_PROBE_INTERVAL, ROUTER_PROBE_START_DELAY, ANSWER_CACHE_ENABLED,
+    HTTP_POOL_SIZE, NVCF_STATUS_URL, NVCF_POLL_SECONDS, NVCF_POLL_MIN_INTERVAL, NVCF_POLL_MAX_INTERVAL,
+    IMAGE_TIMEOUT, PARAKEET_API_URL, VOICE_LANGUAGE, NVCF_ASSETS_URL, CHANGENET_URL,
+    ASSET_CACHE_SIZE, ASSET_CACHE_TTL
+)
+from resilience import UpstreamError, call_with_retry, parse_retry_after, is_caller_error
+from hedging import hedged_call
+from router import model_router
+from sanitizer import sanitize
+from offload import run_offloaded
+from image_tools import decode_image_payload, extract_changenet_result
+from usage_log import usage_log
+from answer_cache import AnswerCache, answer_cache, cache_key
 
 logger = logging.getLogger(__name__)
 
-# OpenAI клиент для NVIDIA LLM
-try:
-    llm_client = OpenAI(
-        base_url="https://integrate.api.nvidia.com/v1",
-        api_key=NVIDIA_API_KEY,
-        http_client=None
-    )
-except TypeError:
-    # Для Python 3.14+ используем другой способ
-    llm_client = OpenAI(
-        base_url="https://integrate.api.nvidia.com/v1",
-        api_key=NVIDIA_API_KEY,
-        http_client=httpx.Client()
+# Семафоры параллельных запросов к моделям изображений
+_model_semaphores = {}
+# Семафоры принятых NVCF задач модели: держатся до конца опроса результата
+_inflight_semaphores = {}
+
+# OpenAI клиенты для NVIDIA LLM (по одному на эндпоинт)
+_llm_clients = {}
+
+# Общий пул HTTP соединений для остальных запросов к NVIDIA API
+_http_session = None
+
+# ID ассетов NVCF по хэшу содержимого изображения
+_asset_cache = AnswerCache(ASSET_CACHE_SIZE, ASSET_CACHE_TTL)
+# Размер части при потоковой загрузке ассета
+ASSET_UPLOAD_CHUNK = 256 * 1024
+
+# openai импортируется при первом запросе к LLM: импорт занимает около
+# секунды и не должен задерживать запуск бота после перезапуска
+
+
+def _no_failover_errors() -> tuple:
+    """Ошибки, при которых нет смысла переключаться на другой upstream"""
+    import openai
+    return (
+        openai.BadRequestError,
+        openai.AuthenticationError,
+        openai.PermissionDeniedError,
     )
 
 
-async def generate_text(prompt: str, model_key: str = "text", user_id: int = None) -> str:
-    """Генерирует текст через NVIDIA LLM с учетом истории сообщений"""
-    try:
-        logger.info(f"Генерирую текст для промпта: {prompt[:100]}")
+def get_llm_client(base_url: str = LLM_BASE_URL):
+    """Возвращает OpenAI клиент для эндпоинта (создается при первом использовании)
 
-        model = MODELS.get(model_key, MODELS["text"])
-        system_prompt = model.get("system_prompt", "You are a helpful AI assistant.")
+    Повторы выполняет resilience.call_with_retry, поэтому встроенные отключены.
+    """
+    if base_url not in _llm_clients:
+        from openai import AsyncOpenAI
+        try:
+            _llm_clients[base_url] = AsyncOpenAI(
+                base_url=base_url,
+                api_key=NVIDIA_API_KEY,
+                max_retries=0,
+                http_client=None
+            )
+        except TypeError:
+            # Для Python 3.14+ используем другой способ
+            import httpx
+            _llm_clients[base_url] = AsyncOpenAI(
+                base_url=base_url,
+                api_key=NVIDIA_API_KEY,
+                max_retries=0,
+                http_client=httpx.AsyncClient()
+            )
+    return _llm_clients[base_url]
 
-        # Формируем список сообщений с историей
-        messages = [{"role": "system", "content": system_prompt}]
 
-        # Добавляем историю если есть user_id
-        if user_id:
-            history = get_user_history(user_id, model_key)
-            messages.extend(history)
+def get_http_session() -> aiohttp.ClientSession:
+    """Возвращает общий пул HTTP соединений (создается при первом использовании)
 
-        # Добавляем текущий запрос пользователя
-        messages.append({"role": "user", "content": prompt})
+    Соединения переиспользуются между запросами: без TLS рукопожатия
+    на каждую генерацию.
+    """
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        _http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE))
+    return _http_session
 
-        completion = llm_client.chat.completions.create(
-            model="minimaxai/minimax-m2.5",
-            messages=messages,
-            temperature=1,
-            top_p=0.95,
-            max_tokens=8192,
-            stream=False
+
+async def close_http_clients():
+    """Закрывает HTTP соединения OpenAI клиентов и общего пула (при остановке бота)"""
+    global _http_session
+    for client in _llm_clients.values():
+        try:
+            await client.close()
+        except Exception as e:
+            logger.error(f"Ошибка при закрытии LLM клиента: {e}")
+    _llm_clients.clear()
+    if _http_session is not None:
+        await _http_session.close()
+        _http_session = None
+
+
+def _classify_llm_error(error: Exception) -> tuple[bool, float | None, bool]:
+    """Определяет, можно ли повторить запрос к LLM и виноват ли upstream"""
+    import openai
+    if isinstance(error, openai.APITimeoutError):
+        # Таймаут не повторяем - иначе пользователь ждет в разы дольше;
+        # но это ошибка upstream, она учитывается circuit breaker
+        return False, None, True
+    if isinstance(error, openai.APIConnectionError):
+        return True, None, True
+    if isinstance(error, openai.APIStatusError):
+        retryable = error.status_code in {429, 500, 502, 503, 504}
+        return (
+            retryable,
+            parse_retry_after(error.response.headers.get("retry-after")),
+            not is_caller_error(error.status_code)
         )
+    return False, None, False
+
 
-        generated_text = completion.choices[0].message.content
+def _classify_image_error(error: Exception) -> tuple[bool, float | None, bool]:
+    """Определяет, можно ли повторить запрос на генерацию изображения и виноват ли сервис"""
+    if isinstance(error, UpstreamError):
+        return error.retryable, error.retry_after, error.upstream_failure
+    if isinstance(error, asyncio.TimeoutError):
+        return False, None, True
+    if isinstance(error, aiohttp.ClientConnectionError):
+        return True, None, True
+    return False, None, False
 
-        # Удаляем теги <think>...</think>
-        generated_text = re.sub(r'<think>.*?</think>', '', generated_text, flags=re.DOTALL).strip()
 
-        # Удаляем markdown форматирование (**, ##, ||, и т.д.)
-        generated_text = re.sub(r'\*\*', '', generated_text)  # Удаляем **
-        generated_text = re.sub(r'##+ ', '', generated_text)  # Удаляем заголовки
-        generated_text = re.sub(r'\|\s*-+\s*\|', '', generated_text)  # Удаляем разделители таблиц
-        generated_text = re.sub(r'^\s*\|\s*', '', generated_text, flags=re.MULTILINE)  # Удаляем пустые строки с |
+async def _complete_upstream(base_url: str, model: str, messages: list, hedge: bool, **params):
+    """Запрос к одному upstream с повторами, circuit breaker и учетом статистики"""
+    key = f"{base_url}/{model}"
+    client = get_llm_client(base_url)
 
-        # Сохраняем в историю если есть user_id
-        if user_id:
-            add_to_history(user_id, model_key, prompt, generated_text)
+    def request():
+        return call_with_retry(
+            lambda: client.chat.completions.create(model=model, messages=messages, **params),
+            key=key,
+            classify=_classify_llm_error
+        )
+
+    started = time.monotonic()
+    try:
+        if hedge and HEDGE_ENABLED:
+            completion = await hedged_call(request, key)
+        else:
+            completion = await request()
+    except Exception:
+        model_router.record(key, time.monotonic() - started, ok=False)
+        raise
+
+    # Задержка учитывается на токен ответа - короткие и длинные ответы сравнимы
+    usage = getattr(completion, "usage", None)
+    tokens = usage.completion_tokens if usage else None
+    model_router.record(key, time.monotonic() - started, ok=True, tokens=tokens)
+    return completion
+
+
+async def create_completion(upstreams: list[str], messages: list, base_url: str = LLM_BASE_URL,
+                            hedge: bool = False, **params):
+    """Запрос к LLM через лучший upstream с переключением на следующий при сбое
+
+    hedge=True включает дублирующий запрос при медленном ответе
+    (если HEDGE_ENABLED).
+    """
+    models_by_key = {f"{base_url}/{model}": model for model in upstreams}
+    ranked = model_router.rank(list(models_by_key))
+    no_failover_errors = _no_failover_errors()
+
+    for i, key in enumerate(ranked):
+        model = models_by_key[key]
+        try:
+            return await _complete_upstream(base_url, model, messages, hedge, **params)
+        except no_failover_errors:
+            raise
+        except Exception as e:
+            if i == len(ranked) - 1:
+                raise
+            logger.warning(f"Upstream {model} недоступен ({e}), переключаюсь на {models_by_key[ranked[i + 1]]}")
+
+
+async def probe_upstreams():
+    """Отправляет короткий запрос каждому upstream, чтобы обновить статистику"""
+    targets = {(LLM_BASE_URL, model) for model in TRANSLATE_UPSTREAMS}
+    for model in MODELS.values():
+        for upstream in model.get("upstreams", []):
+            targets.add((model.get("base_url", LLM_BASE_URL), upstream))
+
+    async def probe(base_url: str, model: str):
+        started = time.monotonic()
+        try:
+            await get_llm_client(base_url).with_options(timeout=15).chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": "ping"}],
+                max_tokens=1
+            )
+            ok = True
+        except Exception as e:
+            logger.warning(f"Пробный запрос к {model} не удался: {e}")
+            ok = False
+        model_router.record(f"{base_url}/{model}", time.monotonic() - started, ok, probe=True)
 
-        logger.info(f"Текст сгенерирован: {generated_text[:100]}")
+    await asyncio.gather(*(probe(base_url, model) for base_url, model in targets))
+
+
+async def run_probe_loop():
+    """Фоновая задача пробных запросов к upstream моделям"""
+    if ROUTER_PROBE_INTERVAL <= 0:
+        return
+    # Не конкурируем с первыми updates после запуска
+    await asyncio.sleep(ROUTER_PROBE_START_DELAY)
+    while True:
+        try:
+            await probe_upstreams()
+            logger.info(f"Статистика upstream: {model_router.snapshot()}")
+        except Exception as e:
+            logger.error(f"Ошибка пробных запросов: {e}")
+        await asyncio.sleep(ROUTER_PROBE_INTERVAL)
+
+
+async def generate_text(prompt: str, model_key: str = "text", user_ctx=None, cached: bool = False) -> str:
+    """Генерирует текст через NVIDIA LLM с учетом истории сообщений
+
+    user_ctx - UserContext текущего update: из него берется история,
+    в него же записывается новая пара сообщений.
+    cached=True - запрос без истории (история не читается и не пополняется),
+    ответ берется из кэша одинаковых вопросов, если есть.
+    """
+    user_id = user_ctx.user_id if user_ctx else 0
+    model = MODELS.get(model_key, MODELS["text"])
+    system_prompt = model.get("system_prompt", "You are a helpful AI assistant.")
+
+    async def complete() -> str:
+        started = time.monotonic()
+        try:
+            logger.info(f"Генерирую текст для промпта: {prompt[:100]}")
+
+            # Формируем список сообщений с историей
+            messages = [{"role": "system", "content": system_prompt}]
+
+            # Добавляем историю если есть контекст пользователя
+            if user_ctx and not cached:
+                messages.extend(user_ctx.get_history(model_key))
+
+            # Добавляем текущий запрос пользователя
+            messages.append({"role": "user", "content": prompt})
+
+            completion = await create_completion(
+                upstreams=model.get("upstreams", DEFAULT_LLM_UPSTREAMS),
+                messages=messages,
+                base_url=model.get("base_url", LLM_BASE_URL),
+                temperature=1,
+                top_p=0.95,
+                max_tokens=8192,
+                stream=False,
+                hedge=True
+            )
+
+            # Удаляем теги <think>...</think> и markdown форматирование (**, ##, ||, и т.д.)
+            generated_text = sanitize(completion.choices[0].message.content)
+
+            usage = completion.usage
+            usage_log.record(
+                user_id, model_key, time.monotonic() - started,
+                prompt_tokens=usage.prompt_tokens if usage else 0,
+                completion_tokens=usage.completion_tokens if usage else 0,
+                size=len(generated_text.encode("utf-8"))
+            )
+
+            logger.info(f"Текст сгенерирован: {generated_text[:100]}")
+            return generated_text
+
+        except Exception as e:
+            usage_log.record(user_id, model_key, time.monotonic() - started, ok=False, units=0)
+            logger.error(f"Ошибка при генерации текста: {e}")
+            raise Exception(f"Ошибка LLM: {str(e)}")
+
+    if cached and ANSWER_CACHE_ENABLED:
+        key = cache_key(model_key, system_prompt, prompt)
+        generated_text, from_cache = await answer_cache.get_or_create(key, complete)
+        if from_cache:
+            logger.info(f"Ответ из кэша для промпта: {prompt[:100]}")
         return generated_text
 
-    except Exception as e:
-        logger.error(f"Ошибка при генерации текста: {e}")
-        raise Exception(f"Ошибка LLM: {str(e)}")
+    generated_text = await complete()
+
+    # Сохраняем в историю если есть контекст пользователя
+    if user_ctx and not cached:
+        user_ctx.add_to_history(model_key, prompt, generated_text)
+
+    return generated_text
 
 
 def enhance_prompt(prompt: str) -> str:
@@ -108,18 +330,16 @@ async def translate_to_english(prompt: str) -> str:
             }
         ]
         
-        completion = llm_client.chat.completions.create(
-            model="minimaxai/minimax-m2.5",
+        completion = await create_completion(
+            upstreams=TRANSLATE_UPSTREAMS,
             messages=messages,
             temperature=0.3,
             max_tokens=200,
             stream=False
         )
         
-        translated = completion.choices[0].message.content.strip()
-        
         # Удаляем теги <think>...</think> если есть
-        translated = re.sub(r'<think>.*?</think>', '', translated, flags=re.DOTALL).strip()
+        translated = sanitize(completion.choices[0].message.content)
         
         # Удаляем кавычки если есть
         translated = translated.strip('"\'')
@@ -142,10 +362,8 @@ async def translate_to_english(prompt: str) -> str:
         return prompt
 
 
-async def generate_image(prompt: str, model_key: str, image_data: str = None) -> tuple[bytes, dict]:
-    """Генерирует изображение через NVIDIA API"""
-    model = MODELS.get(model_key, MODELS["schnell"])
-    
+async def prepare_image_prompt(prompt: str, model_key: str) -> str:
+    """Переводит и улучшает промпт для генерации изображения"""
     # Переводим промпт на английский для лучшего качества
     translated_prompt = await translate_to_english(prompt)
     
@@ -155,10 +373,77 @@ async def generate_image(prompt: str, model_key: str, image_data: str = None) ->
     else:
         final_prompt = enhance_prompt(translated_prompt)
     
-    logger.info(f"Модель: {model['name']}")
     logger.info(f"Исходный промпт: {prompt}")
     logger.info(f"Переведенный промпт: {translated_prompt}")
     logger.info(f"Финальный промпт: {final_prompt}")
+    return final_prompt
+
+
+def _get_model_semaphore(model_key: str) -> asyncio.Semaphore:
+    """Возвращает семафор, ограничивающий параллельные запросы к модели"""
+    if model_key not in _model_semaphores:
+        model = MODELS.get(model_key, MODELS["schnell"])
+        _model_semaphores[model_key] = asyncio.Semaphore(model.get("max_concurrency", 1))
+    return _model_semaphores[model_key]
+
+
+def _get_inflight_semaphore(model_key: str) -> asyncio.Semaphore:
+    """Возвращает семафор, ограничивающий задачи модели в работе у NVCF
+
+    В отличие от семафора отправки держится и на время опроса: задача,
+    принятая с ответом 202, продолжает занимать мощности модели.
+    """
+    if model_key not in _inflight_semaphores:
+        model = MODELS.get(model_key, MODELS["schnell"])
+        _inflight_semaphores[model_key] = asyncio.Semaphore(
+            model.get("max_inflight", model.get("max_concurrency", 1))
+        )
+    return _inflight_semaphores[model_key]
+
+
+async def _poll_nvcf(request_id: str, headers: dict, deadline: float, progress=None) -> tuple[int, dict, bytes]:
+    """Опрашивает статус асинхронной задачи NVCF до результата
+
+    Ответ 202 значит, что задача еще выполняется. Соединение занято только
+    на время одного опроса (не дольше NVCF_POLL_SECONDS), пауза между
+    опросами растет от NVCF_POLL_MIN_INTERVAL до NVCF_POLL_MAX_INTERVAL.
+    progress() вызывается после каждого опроса.
+    Возвращает (статус, заголовки, тело) итогового ответа.
+    """
+    session = get_http_session()
+    interval = NVCF_POLL_MIN_INTERVAL
+    while True:
+        async with session.get(
+            f"{NVCF_STATUS_URL}/{request_id}",
+            headers={**headers, "NVCF-POLL-SECONDS": str(NVCF_POLL_SECONDS)},
+            timeout=aiohttp.ClientTimeout(total=NVCF_POLL_SECONDS + 30)
+        ) as response:
+            if response.status != 202:
+                return response.status, response.headers, await response.read()
+        
+        if progress is not None:
+            try:
+                await progress()
+            except Exception as e:
+                logger.warning(f"Ошибка обновления статуса генерации: {e}")
+        
+        if time.monotonic() + interval > deadline:
+            # Как и таймаут запроса, не повторяется: повтор ждал бы столько же
+            raise asyncio.TimeoutError(f"Генерация не завершилась за {IMAGE_TIMEOUT:.0f} сек.")
+        await asyncio.sleep(interval)
+        interval = min(interval * 1.5, NVCF_POLL_MAX_INTERVAL)
+
+
+async def _request_image(final_prompt: str, model_key: str, image_data: str = None,
+                         seed: int = None, progress=None) -> tuple[bytes, dict]:
+    """Отправляет один запрос на генерацию изображения
+
+    Долгие генерации NVCF выполняет асинхронно: ответ 202 с Nvcf-Reqid,
+    после чего результат забирается опросом статуса (_poll_nvcf).
+    """
+    model = MODELS.get(model_key, MODELS["schnell"])
+    
+    logger.info(f"Модель: {model['name']}")
     
     headers = {
         "Authorization": f"Bearer {NVIDIA_API_KEY}",
@@ -170,6 +455,9 @@ async def generate_image(prompt: str, model_key: str, image_data: str = None) ->
         **model["params"]
     }
     
+    if seed is not None:
+        payload["seed"] = seed
+    
     # Для kontext добавляем изображение
     if model_key == "kontext" and image_data:
         # Убираем префикс если он есть
@@ -183,47 +471,236 @@ async def generate_image(prompt: str, model_key: str, image_data: str = None) ->
     logger.info(f"Payload keys: {list(payload.keys())}")
     logger.info(f"Payload (без image): {dict((k, v) for k, v in payload.items() if k != 'image')}")
     
-    async with aiohttp.ClientSession() as session:
-        try:
-            async with session.post(
-                model["url"],
-                json=payload,
-                headers=headers,
+    async def post_once() -> tuple[bytes, dict]:
+        deadline = time.monotonic() + IMAGE_TIMEOUT
+        # max_inflight - задачи модели у NVCF (до конца опроса), max_concurrency -
+        # только одновременные отправки: опрос не занимает слот отправки
+        async with _get_inflight_semaphore(model_key):
+            async with _get_model_semaphore(model_key):
+                async with get_http_session().post(
+                    model["url"],
+                    json=payload,
+                    # Не держать соединение всю генерацию: после NVCF_POLL_SECONDS - ответ 202
+                    headers={**headers, "NVCF-POLL-SECONDS": str(NVCF_POLL_SECONDS)},
+                    timeout=aiohttp.ClientTimeout(total=180)
+                ) as response:
+                    status, response_headers, body = response.status, response.headers, await response.read()
+            
+            request_id = response_headers.get("Nvcf-Reqid", "N/A")
+            if status == 202 and request_id != "N/A":
+                logger.info(f"Request ID: {request_id}: генерация выполняется, опрашиваю статус")
+                status, response_headers, body = await _poll_nvcf(request_id, headers, deadline, progress)
+        
+        # Тело ответа - несколько МБ base64, логируем и декодируем только начало
+        response_text = body[:500].decode("utf-8", errors="replace")
+        logger.info(f"Статус ответа: {status}")
+        logger.info(f"Ответ API: {response_text}")
+        
+        request_info = {
+            "request_id": request_id,
+            "status": response_headers.get("Nvcf-Status", "N/A"),
+            "model": model["name"],
+        }
+        
+        logger.info(f"Request ID: {request_info['request_id']}, Status: {request_info['status']}")
+        
+        if status != 200:
+            raise UpstreamError(
+                f"API вернул ошибку: {status}\n{response_text[:200]}",
+                status=status,
+                retry_after=parse_retry_after(response_headers.get("Retry-After"))
+            )
+        
+        # Разбор JSON и base64 держат GIL - выполняются вне event loop
+        image_bytes = await run_offloaded(decode_image_payload, body, size=len(body))
+        return image_bytes, request_info
+    
+    try:
+        return await call_with_retry(post_once, key=model["url"], classify=_classify_image_error)
+    except Exception as e:
+        logger.error(f"Ошибка при генерации изображения: {e}")
+        raise
+
+
+async def generate_image(prompt: str, model_key: str, image_data: str = None,
+                         progress=None) -> tuple[bytes, dict]:
+    """Генерирует изображение через NVIDIA API
+
+    progress - корутинная функция без аргументов, вызывается, пока
+    генерация выполняется (для обновления сообщения со статусом).
+    """
+    final_prompt = await prepare_image_prompt(prompt, model_key)
+    return await _request_image(final_prompt, model_key, image_data, progress=progress)
+
+
+async def generate_image_variants(prompt: str, model_key: str, count: int,
+                                  progress=None) -> list[tuple[bytes, dict]]:
+    """Генерирует несколько вариантов изображения с разными seed
+
+    Промпт переводится один раз, запросы выполняются параллельно
+    с ограничениями модели max_concurrency и max_inflight. Возвращает только
+    успешные варианты; если не удался ни один - пробрасывает ошибку.
+    """
+    final_prompt = await prepare_image_prompt(prompt, model_key)
+    seeds = random.sample(range(1, 2 ** 31), count)
+    
+    results = await asyncio.gather(
+        *(_request_image(final_prompt, model_key, seed=seed, progress=progress) for seed in seeds),
+        return_exceptions=True
+    )
+    
+    variants = [result for result in results if not isinstance(result, BaseException)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    
+    logger.info(f"Варианты: успешно {len(variants)} из {count}")
+    
+    if not variants:
+        raise errors[0]
+    
+    return variants
+
+
+async def _stream_bytes(data: bytes):
+    """Отдает данные частями без копирования (тело потоковой загрузки)"""
+    view = memoryview(data)
+    for start in range(0, len(view), ASSET_UPLOAD_CHUNK):
+        yield view[start:start + ASSET_UPLOAD_CHUNK]
+
+
+async def _upload_asset(data: bytes, description: str, content_type: str = "image/jpeg") -> str:
+    """Загружает изображение как ассет NVCF и возвращает asset ID"""
+    session = get_http_session()
+    
+    async def authorize() -> dict:
+        async with session.post(
+            NVCF_ASSETS_URL,
+            headers={
+                "Authorization": f"Bearer {NVIDIA_API_KEY}",
+                "Accept": "application/json",
+            },
+            json={"contentType": content_type, "description": description},
+            timeout=aiohttp.ClientTimeout(total=30)
+        ) as response:
+            if response.status != 200:
+                raise UpstreamError(
+                    f"Не удалось создать ассет: {response.status}\n{(await response.text())[:200]}",
+                    status=response.status,
+                    retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                )
+            return await response.json(content_type=None)
+    
+    async def upload(upload_url: str):
+        # Хранилище ассетов не принимает chunked - длина указывается заранее
+        async with session.put(
+            upload_url,
+            data=_stream_bytes(data),
+            headers={
+                "x-amz-meta-nvcf-asset-description": description,
+                "Content-Type": content_type,
+                "Content-Length": str(len(data)),
+            },
+            timeout=aiohttp.ClientTimeout(total=120)
+        ) as response:
+            if response.status not in (200, 201, 204):
+                raise UpstreamError(
+                    f"Не удалось загрузить ассет: {response.status}\n{(await response.text())[:200]}",
+                    status=response.status
+                )
+    
+    asset = await call_with_retry(authorize, key=NVCF_ASSETS_URL, classify=_classify_image_error)
+    # PUT по ссылке загрузки идемпотентен - его можно повторить
+    await call_with_retry(lambda: upload(asset["uploadUrl"]), key=NVCF_ASSETS_URL, classify=_classify_image_error)
+    logger.info(f"Изображение загружено с ID: {asset['assetId']} ({len(data)} байт)")
+    return asset["assetId"]
+
+
+async def _get_asset_id(data: bytes, description: str) -> str:
+    """Возвращает ID ассета с этим содержимым, загружая его только при промахе кэша"""
+    key = (hashlib.sha256(data).hexdigest(),)
+    asset_id, cached = await _asset_cache.get_or_create(key, lambda: _upload_asset(data, description))
+    if cached:
+        logger.info(f"Ассет {asset_id} взят из кэша")
+    return asset_id
+
+
+async def compare_images_changenet(reference_image: bytes, test_image: bytes) -> bytes:
+    """Сравнивает два изображения с помощью Visual ChangeNet и возвращает карту изменений
+
+    Оба изображения загружаются параллельно; уже загруженные (по хэшу
+    содержимого) не загружаются повторно. Результат - zip, он
+    распаковывается в памяти вне event loop.
+    """
+    try:
+        logger.info("Загружаю изображения для сравнения...")
+        reference_id, test_id = await asyncio.gather(
+            _get_asset_id(reference_image, "Reference Image"),
+            _get_asset_id(test_image, "Test Image")
+        )
+        logger.info(f"Asset IDs: {reference_id}, {test_id}")
+        
+        asset_list = f"{reference_id},{test_id}"
+        headers = {
+            "Authorization": f"Bearer {NVIDIA_API_KEY}",
+            "NVCF-INPUT-ASSET-REFERENCES": asset_list,
+            "NVCF-FUNCTION-ASSET-IDS": asset_list,
+        }
+        inputs = {"reference_image": reference_id, "test_image": test_id}
+        
+        async def post_once() -> bytes:
+            deadline = time.monotonic() + IMAGE_TIMEOUT
+            async with get_http_session().post(
+                CHANGENET_URL,
+                json=inputs,
+                headers={**headers, "NVCF-POLL-SECONDS": str(NVCF_POLL_SECONDS)},
                 timeout=aiohttp.ClientTimeout(total=180)
             ) as response:
-                response_text = await response.text()
-                logger.info(f"Статус ответа: {response.status}")
-                logger.info(f"Ответ API: {response_text[:500]}")
-                
-                request_info = {
-                    "request_id": response.headers.get("Nvcf-Reqid", "N/A"),
-                    "status": response.headers.get("Nvcf-Status", "N/A"),
-                    "model": model["name"],
-                }
-                
-                logger.info(f"Request ID: {request_info['request_id']}, Status: {request_info['status']}")
-                
-                if response.status != 200:
-                    raise Exception(f"API вернул ошибку: {response.status}\n{response_text[:200]}")
-                
-                result = await response.json()
-                
-                # Разные форматы ответа для разных моделей
-                if "artifacts" in result and len(result["artifacts"]) > 0:
-                    # Формат Stability AI (SD3)
-                    image_b64 = result["artifacts"][0].get("base64", "")
-                elif "image" in result:
-                    # Формат FLUX
-                    image_b64 = result["image"]
-                elif "data" in result and len(result["data"]) > 0:
-                    # Альтернативный формат
-                    image_b64 = result["data"][0].get("b64_json", "")
-                else:
-                    raise Exception("Не удалось найти изображение в ответе API")
-                
-                image_bytes = base64.b64decode(image_b64)
-                return image_bytes, request_info
-                
-        except Exception as e:
-            logger.error(f"Ошибка при генерации изображения: {e}")
-            raise
+                status, response_headers, body = response.status, response.headers, await response.read()
+            
+            request_id = response_headers.get("Nvcf-Reqid")
+            if status == 202 and request_id:
+                status, response_headers, body = await _poll_nvcf(request_id, headers, deadline)
+            
+            if status != 200:
+                raise UpstreamError(
+                    f"API вернул ошибку: {status}\n{body[:200].decode('utf-8', errors='replace')}",
+                    status=status,
+                    retry_after=parse_retry_after(response_headers.get("Retry-After"))
+                )
+            return body
+        
+        logger.info("Отправляю запрос к Visual ChangeNet...")
+        body = await call_with_retry(post_once, key=CHANGENET_URL, classify=_classify_image_error)
+        logger.info(f"Ответ получен ({len(body)} байт), распаковываю результаты...")
+        return await run_offloaded(extract_changenet_result, body, size=len(body))
+    
+    except Exception as e:
+        logger.error(f"Ошибка при сравнении изображений: {e}")
+        raise Exception(f"Ошибка сравнения: {str(e)}")
+
+
+async def transcribe_audio(wav_bytes: bytes) -> str:
+    """Распознает речь (WAV) через Parakeet и возвращает текст"""
+    headers = {
+        "Authorization": f"Bearer {NVIDIA_API_KEY}",
+        "Accept": "application/json",
+    }
+    
+    async def post_once() -> str:
+        form = aiohttp.FormData()
+        form.add_field("file", wav_bytes, filename="voice.wav", content_type="audio/wav")
+        form.add_field("language", VOICE_LANGUAGE)
+        async with get_http_session().post(
+            PARAKEET_API_URL, data=form, headers=headers, timeout=aiohttp.ClientTimeout(total=120)
+        ) as response:
+            if response.status != 200:
+                body = await response.text()
+                raise UpstreamError(
+                    f"API распознавания вернул ошибку: {response.status}\n{body[:200]}",
+                    status=response.status,
+                    retry_after=parse_retry_after(response.headers.get("Retry-After"))
+                )
+            result = await response.json(content_type=None)
+        return (result.get("text") or "").strip()
+    
+    # Ошибки классифицируются так же, как у запросов изображений
+    return await call_with_retry(post_once, key=PARAKEET_API_URL, classify=_classify_image_error)
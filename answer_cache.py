@@ -0,0 +1,117 @@
+"""Кэш ответов LLM на одинаковые вопросы без истории диалога"""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+
+from config import ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+# Знаки в конце вопроса не меняют его смысла: "что такое ИИ?" == "Что такое ИИ"
+_TRAILING_PUNCTUATION = " ?!.…"
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Приводит вопрос к виду для сравнения: регистр, пробелы, знаки в конце"""
+    return _WHITESPACE_RE.sub(" ", prompt.casefold()).strip().rstrip(_TRAILING_PUNCTUATION)
+
+
+def cache_key(model_key: str, system_prompt: str, prompt: str) -> tuple:
+    """Ключ кэша: модель, хэш системного промпта и нормализованный вопрос
+
+    Хэш системного промпта отделяет ответы после его изменения в конфиге.
+    """
+    system_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:16]
+    return model_key, system_hash, normalize_prompt(prompt)
+
+
+class AnswerCache:
+    """LRU кэш с ограничением размера и временем жизни записей
+
+    Одновременные промахи по одному ключу объединяются: запрос к модели
+    выполняется один раз, остальные ждут его результат.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_SIZE, ttl: float = ANSWER_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> str | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        answer, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return answer
+
+    def put(self, key: tuple, answer: str):
+        self.entries[key] = (answer, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_create(self, key: tuple, factory) -> tuple[str, bool]:
+        """Возвращает (ответ, из_кэша); factory - корутина-функция генерации"""
+        answer = self.get(key)
+        if answer is not None:
+            self.hits += 1
+            return answer, True
+
+        if key in self.inflight:
+            # Такой же вопрос уже генерируется - ждем его ответ
+            self.hits += 1
+            try:
+                return await asyncio.shield(self.inflight[key]), True
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                # Генерацию отменил пользователь, который ее запустил - запускаем свою
+                self.hits -= 1
+                return await self.get_or_create(key, factory)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        try:
+            answer = await factory()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # Ошибку получат только ожидающие; без них не логировать "never retrieved"
+                future.exception()
+            raise
+        else:
+            if answer:
+                self.put(key, answer)
+            future.set_result(answer)
+            return answer, False
+        finally:
+            del self.inflight[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,80 @@
+"""Дисковое хранилище загруженных файлов с автоматической очисткой"""
+import asyncio
+import logging
+import time
+import uuid
+
+from config import BLOB_DIR, BLOB_TTL, BLOB_CLEANUP_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+def _blob_path(ref: str):
+    """Путь к файлу по ссылке (ссылка - hex строка без разделителей)"""
+    if not ref.isalnum():
+        raise ValueError(f"Некорректная ссылка на файл: {ref}")
+    return BLOB_DIR / ref
+
+
+def _write_blob(ref: str, data: bytes):
+    BLOB_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = BLOB_DIR / f"{ref}.tmp"
+    tmp_path.write_bytes(data)
+    tmp_path.replace(_blob_path(ref))
+
+
+def _read_blob(ref: str) -> bytes | None:
+    path = _blob_path(ref)
+    if not path.exists():
+        return None
+    if time.time() - path.stat().st_mtime > BLOB_TTL:
+        path.unlink(missing_ok=True)
+        return None
+    return path.read_bytes()
+
+
+async def put_blob(data: bytes) -> str:
+    """Сохраняет данные на диск и возвращает ссылку на них"""
+    ref = uuid.uuid4().hex
+    await asyncio.to_thread(_write_blob, ref, data)
+    logger.info(f"Файл сохранен в хранилище: {ref} ({len(data)} байт)")
+    return ref
+
+
+async def get_blob(ref: str) -> bytes | None:
+    """Читает данные по ссылке (None если файл удален или устарел)"""
+    return await asyncio.to_thread(_read_blob, ref)
+
+
+async def delete_blob(ref: str):
+    """Удаляет данные по ссылке"""
+    await asyncio.to_thread(_blob_path(ref).unlink, missing_ok=True)
+
+
+def cleanup_expired() -> int:
+    """Удаляет файлы старше BLOB_TTL, возвращает количество удаленных"""
+    if not BLOB_DIR.exists():
+        return 0
+
+    removed = 0
+    deadline = time.time() - BLOB_TTL
+    for path in BLOB_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < deadline:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            continue
+    return removed
+
+
+async def run_cleanup_loop():
+    """Фоновая задача периодической очистки хранилища"""
+    while True:
+        try:
+            removed = await asyncio.to_thread(cleanup_expired)
+            if removed:
+                logger.info(f"Удалено устаревших файлов: {removed}")
+        except Exception as e:
+            logger.error(f"Ошибка при очистке хранилища: {e}")
+        await asyncio.sleep(BLOB_CLEANUP_INTERVAL)
@@ -0,0 +1,74 @@
+"""Отмена генераций пользователем (/cancel и кнопка «Отмена»)
+
+Генерация запускается через run_cancellable и привязывается к пользователю
+и сообщению со статусом. Отмена прерывает задачу, а вместе с ней и HTTP
+запрос к модели: соединение закрывается и не держит место у провайдера.
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class OperationCancelled(Exception):
+    """Операция отменена пользователем"""
+
+
+class _Operation:
+    def __init__(self, user_id: int, task: asyncio.Task, chat_id: int, message_id: int | None):
+        self.user_id = user_id
+        self.task = task
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.cancelled = False
+
+
+# {user_id: {операция}}
+_operations = {}
+
+
+async def run_cancellable(coro, user_id: int, chat_id: int, message_id: int = None):
+    """Выполняет coro как отменяемую операцию пользователя
+
+    message_id - сообщение со статусом и кнопкой «Отмена».
+    При отмене пользователем бросает OperationCancelled; остановка самого
+    вызывающего (например, при выключении бота) остается CancelledError.
+    """
+    task = asyncio.ensure_future(coro)
+    operation = _Operation(user_id, task, chat_id, message_id)
+    _operations.setdefault(user_id, set()).add(operation)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if operation.cancelled and not asyncio.current_task().cancelling():
+            raise OperationCancelled() from None
+        raise
+    finally:
+        operations = _operations.get(user_id)
+        if operations is not None:
+            operations.discard(operation)
+            if not operations:
+                del _operations[user_id]
+
+
+def cancel_operations(user_id: int, message_id: int = None) -> list[tuple[int, int]]:
+    """Отменяет генерации пользователя (только привязанную к message_id, если он задан)
+
+    Возвращает (chat_id, message_id) сообщений со статусом отмененных операций.
+    """
+    cancelled = []
+    for operation in list(_operations.get(user_id, ())):
+        if message_id is not None and operation.message_id != message_id:
+            continue
+        if operation.task.done() or operation.cancelled:
+            continue
+        operation.cancelled = True
+        operation.task.cancel()
+        cancelled.append((operation.chat_id, operation.message_id))
+    if cancelled:
+        logger.info(f"Пользователь {user_id} отменил генераций: {len(cancelled)}")
+    return cancelled
+
+
+def active_operations(user_id: int) -> int:
+    return len(_operations.get(user_id, ()))
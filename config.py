@@ -10,11 +10,183 @@ load_dotenv()
 BOT_TOKEN = getenv("BOT_TOKEN")
 NVIDIA_API_KEY = getenv("NVIDIA_API_KEY")
 
+# NVIDIA LLM API (OpenAI-совместимый)
+LLM_BASE_URL = "https://integrate.api.nvidia.com/v1"
+DEFAULT_LLM_UPSTREAMS = ["minimaxai/minimax-m2.5", "meta/llama-3.1-70b-instruct"]
+# Модели для перевода промптов изображений
+TRANSLATE_UPSTREAMS = ["minimaxai/minimax-m2.5", "meta/llama-3.1-8b-instruct"]
+
 # NVIDIA Whisper API
 PARAKEET_API_URL = "https://ai.api.nvidia.com/v1/audio/transcription"
 
-# Файл для хранения данных пользователей
+# Файл для хранения данных пользователей (до шардирования; переносится в USER_DATA_DIR)
 USER_DATA_FILE = Path("user_data.json")
+# Каталог шардов с данными пользователей
+USER_DATA_DIR = Path(getenv("USER_DATA_DIR", "user_data"))
+# Число шардов для нового хранилища (для существующего - python user_manager.py reshard)
+USER_DATA_SHARDS = int(getenv("USER_DATA_SHARDS", "16"))
+# Журнал изменений шардов: fsync после каждой пачки записей (0 - положиться на ОС)
+USER_JOURNAL_FSYNC = getenv("USER_JOURNAL_FSYNC", "1") == "1"
+# Как часто проверять журналы и с какого размера сворачивать журнал шарда в снимок
+USER_SNAPSHOT_INTERVAL = int(getenv("USER_SNAPSHOT_INTERVAL", "60"))
+USER_SNAPSHOT_JOURNAL_SIZE = int(getenv("USER_SNAPSHOT_JOURNAL_SIZE", str(256 * 1024)))
+# База промокодов
+PROMO_DB_FILE = Path(getenv("PROMO_DB_FILE", "promo.db"))
+# Журнал использования моделей и агрегаты по дням
+USAGE_LOG_DIR = Path(getenv("USAGE_LOG_DIR", "usage_log"))
+USAGE_FLUSH_INTERVAL = float(getenv("USAGE_FLUSH_INTERVAL", "10"))  # секунд
+
+# Администраторы бота (Telegram ID через запятую)
+ADMIN_IDS = {int(admin_id) for admin_id in getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
+# Перекодирование сгенерированных изображений перед отправкой в Telegram
+# Формат: jpeg, webp или png (png - отправлять оригинал без перекодирования)
+IMAGE_OUTPUT_FORMAT = getenv("IMAGE_OUTPUT_FORMAT", "jpeg").lower()
+IMAGE_OUTPUT_QUALITY = int(getenv("IMAGE_OUTPUT_QUALITY", "90"))
+# Показывать кнопку для получения оригинального PNG файлом
+IMAGE_OFFER_ORIGINAL = getenv("IMAGE_OFFER_ORIGINAL", "1") == "1"
+# Сколько последних оригиналов держать в памяти для кнопки
+IMAGE_ORIGINALS_CACHE_SIZE = int(getenv("IMAGE_ORIGINALS_CACHE_SIZE", "50"))
+
+# Хранилище загруженных фото (вместо FSM состояния)
+BLOB_DIR = Path(getenv("BLOB_DIR", "blobs"))
+BLOB_TTL = int(getenv("BLOB_TTL", "3600"))  # секунд
+BLOB_CLEANUP_INTERVAL = int(getenv("BLOB_CLEANUP_INTERVAL", "300"))  # секунд
+# Максимальная сторона фото для kontext (фото уменьшается перед отправкой)
+KONTEXT_IMAGE_MAX_SIDE = int(getenv("KONTEXT_IMAGE_MAX_SIDE", "1024"))
+
+# Маршрутизация между upstream моделями по задержке и ошибкам
+ROUTER_EWMA_ALPHA = float(getenv("ROUTER_EWMA_ALPHA", "0.2"))
+ROUTER_ERROR_PENALTY = float(getenv("ROUTER_ERROR_PENALTY", "10"))
+# Интервал фоновых пробных запросов, секунд (0 - отключить)
+ROUTER_PROBE_INTERVAL = float(getenv("ROUTER_PROBE_INTERVAL", "120"))
+# Задержка первого пробного запроса после запуска, секунд
+ROUTER_PROBE_START_DELAY = float(getenv("ROUTER_PROBE_START_DELAY", "30"))
+
+# Повторы запросов к NVIDIA API и circuit breaker
+RETRY_ATTEMPTS = int(getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(getenv("RETRY_BASE_DELAY", "1.0"))  # секунд
+RETRY_MAX_DELAY = float(getenv("RETRY_MAX_DELAY", "20"))  # секунд
+BREAKER_FAILURE_THRESHOLD = int(getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = float(getenv("BREAKER_RESET_TIMEOUT", "30"))  # секунд
+BREAKER_HALF_OPEN_PROBES = int(getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+
+# Hedged requests для генерации текста (выключено по умолчанию)
+HEDGE_ENABLED = getenv("HEDGE_ENABLED", "0") == "1"
+# Дубль отправляется, если ответа нет дольше этого перцентиля недавних задержек
+HEDGE_PERCENTILE = float(getenv("HEDGE_PERCENTILE", "95"))
+# Максимальная дополнительная нагрузка от дублей, % от основных запросов
+HEDGE_BUDGET_PERCENT = float(getenv("HEDGE_BUDGET_PERCENT", "5"))
+HEDGE_MIN_SAMPLES = int(getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(getenv("HEDGE_WINDOW", "200"))
+
+# Лимиты отправки сообщений в Telegram (сообщений в секунду)
+SEND_GLOBAL_RATE = float(getenv("SEND_GLOBAL_RATE", "25"))
+SEND_CHAT_RATE = float(getenv("SEND_CHAT_RATE", "1"))
+SEND_GROUP_RATE = float(getenv("SEND_GROUP_RATE", str(20 / 60)))
+SEND_CHAT_BURST = float(getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(getenv("SEND_MAX_RETRIES", "3"))
+
+# Очередь задач генерации изображений
+JOB_DB_FILE = Path(getenv("JOB_DB_FILE", "jobs.db"))
+JOB_WORKERS = int(getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(getenv("JOB_POLL_INTERVAL", "5"))  # секунд
+# Аренда задачи воркером: продлевается, пока задача выполняется; задачи
+# с истекшей арендой (процесс упал) забирает любой процесс
+JOB_LEASE_SECONDS = float(getenv("JOB_LEASE_SECONDS", "60"))
+# Больше задач в очереди - новые генерации изображений отклоняются
+JOB_QUEUE_MAX_PENDING = int(getenv("JOB_QUEUE_MAX_PENDING", "200"))
+
+# Контроль допуска: общий предел одновременно выполняемых обработчиков
+ADMISSION_MAX_CONCURRENT = int(getenv("ADMISSION_MAX_CONCURRENT", "64"))
+# Доли предела для классов "interactive,text,image"
+ADMISSION_CLASS_SHARE = tuple(float(x) for x in getenv("ADMISSION_CLASS_SHARE", "1.0,0.8,0.5").split(","))
+# Места только для interactive: text и image вместе не занимают больше
+# ADMISSION_MAX_CONCURRENT - ADMISSION_INTERACTIVE_RESERVED
+ADMISSION_INTERACTIVE_RESERVED = int(getenv("ADMISSION_INTERACTIVE_RESERVED", "8"))
+# Сколько обработчиков класса может ждать места; остальные получают "бот занят"
+ADMISSION_QUEUE_BUDGET = tuple(int(x) for x in getenv("ADMISSION_QUEUE_BUDGET", "200,50,20").split(","))
+ADMISSION_WAIT_TIMEOUT = float(getenv("ADMISSION_WAIT_TIMEOUT", "15"))  # секунд
+
+# Вынос CPU-тяжелой работы (json, base64, перекодирование изображений) из event loop
+OFFLOAD_THREAD_WORKERS = int(getenv("OFFLOAD_THREAD_WORKERS", "4"))
+# Пул процессов для больших данных (0 - только потоки)
+OFFLOAD_PROCESS_WORKERS = int(getenv("OFFLOAD_PROCESS_WORKERS", "2"))
+# С какого размера данных (байт) использовать пул процессов
+OFFLOAD_PROCESS_THRESHOLD = int(getenv("OFFLOAD_PROCESS_THRESHOLD", str(512 * 1024)))
+# Метрики задержки event loop
+LOOP_LAG_INTERVAL = float(getenv("LOOP_LAG_INTERVAL", "0.5"))  # секунд
+LOOP_LAG_WARN = float(getenv("LOOP_LAG_WARN", "0.1"))  # секунд
+
+# Остановка бота: сколько секунд ждать завершения начатых генераций
+SHUTDOWN_TIMEOUT = float(getenv("SHUTDOWN_TIMEOUT", "25"))
+
+# Режим webhook (если задан WEBHOOK_URL), иначе polling
+WEBHOOK_URL = getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = getenv("WEBHOOK_SECRET", "")
+WEBAPP_HOST = getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(getenv("PORT", "8080"))
+
+# Кэш ответов /ask (выключен по умолчанию). Включенный кэш делает /ask
+# запросом без истории диалога: одинаковые вопросы получают один ответ
+ANSWER_CACHE_ENABLED = getenv("ANSWER_CACHE_ENABLED", "0") == "1"
+ANSWER_CACHE_SIZE = int(getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(getenv("ANSWER_CACHE_TTL", "86400"))  # секунд
+
+# Режим вариантов: сколько изображений максимум за один запрос
+IMAGE_VARIANTS_MAX = int(getenv("IMAGE_VARIANTS_MAX", "4"))
+
+# Общий пул HTTP соединений к NVIDIA API
+HTTP_POOL_SIZE = int(getenv("HTTP_POOL_SIZE", "100"))
+# Асинхронный вызов NVCF: сервер держит запрос не дольше NVCF_POLL_SECONDS,
+# затем отвечает 202 с Nvcf-Reqid, и статус задачи опрашивается отдельно
+NVCF_STATUS_URL = getenv("NVCF_STATUS_URL", "https://api.nvcf.nvidia.com/v2/nvcf/pexec/status")
+NVCF_POLL_SECONDS = int(getenv("NVCF_POLL_SECONDS", "5"))
+# Пауза между опросами растет от минимальной до максимальной
+NVCF_POLL_MIN_INTERVAL = float(getenv("NVCF_POLL_MIN_INTERVAL", "1"))
+NVCF_POLL_MAX_INTERVAL = float(getenv("NVCF_POLL_MAX_INTERVAL", "10"))
+# Сколько всего ждать изображение, секунд
+IMAGE_TIMEOUT = float(getenv("IMAGE_TIMEOUT", "600"))
+# Как часто обновлять сообщение со статусом генерации, секунд
+IMAGE_PROGRESS_INTERVAL = float(getenv("IMAGE_PROGRESS_INTERVAL", "10"))
+
+# Голосовые сообщения: распознавание через PARAKEET_API_URL
+# Эндпоинт принимает WAV 16 кГц моно - OGG/Opus из Telegram перекодирует ffmpeg
+FFMPEG_BINARY = getenv("FFMPEG_BINARY", "ffmpeg")
+VOICE_SAMPLE_RATE = int(getenv("VOICE_SAMPLE_RATE", "16000"))
+VOICE_LANGUAGE = getenv("VOICE_LANGUAGE", "ru-RU")
+# Сколько голосовых распознается одновременно и максимальная длина, секунд
+VOICE_MAX_CONCURRENT = int(getenv("VOICE_MAX_CONCURRENT", "4"))
+VOICE_MAX_DURATION = int(getenv("VOICE_MAX_DURATION", "300"))
+# Кэш расшифровок по file_unique_id (пересланное голосовое не распознается повторно)
+VOICE_CACHE_SIZE = int(getenv("VOICE_CACHE_SIZE", "1000"))
+VOICE_CACHE_TTL = float(getenv("VOICE_CACHE_TTL", "86400"))  # секунд
+
+# Сравнение изображений (Visual ChangeNet): изображения загружаются как ассеты NVCF
+NVCF_ASSETS_URL = getenv("NVCF_ASSETS_URL", "https://api.nvcf.nvidia.com/v2/nvcf/assets")
+CHANGENET_URL = getenv("CHANGENET_URL", "https://ai.api.nvidia.com/v1/cv/nvidia/visual-changenet")
+# ID загруженных ассетов по хэшу содержимого: повторное сравнение с тем же
+# эталоном не загружает его снова. Время жизни - меньше срока хранения ассета в NVCF
+ASSET_CACHE_SIZE = int(getenv("ASSET_CACHE_SIZE", "256"))
+ASSET_CACHE_TTL = float(getenv("ASSET_CACHE_TTL", "3600"))  # секунд
+
+# Лимиты бесплатного доступа для новых пользователей
+FREE_TIER_LIMITS = {
+    "text": 5,
+    "gemini": 3,
+    "deepseek": 2,
+    "claude": 2,
+    "claude_sonnet": 2,
+    "claude_haiku": 3,
+    "claude_opus": 1,
+    "qwen": 3,
+    "llama": 4,
+    "schnell": 2,
+    "dev": 0,
+    "kontext": 0
+}
 
 # Пакеты премиума
 PREMIUM_TIERS = {
@@ -97,66 +269,79 @@ PREMIUM_TIERS = {
 }
 
 # Модели NVIDIA
+# Для текстовых моделей "upstreams" - кандидаты для маршрутизации (router.py),
+# необязательный "base_url" переопределяет LLM_BASE_URL
 MODELS = {
     "text": {
         "provider": "OpenAI",
         "name": "Chat GPT 5",
         "description": "Генерация текста",
-        "system_prompt": "You are ChatGPT-5, an advanced AI assistant created by OpenAI. You are a highly intelligent, helpful, and harmless AI that provides accurate, thoughtful, and comprehensive responses to user queries. You have extensive knowledge across all domains and can engage in complex reasoning, creative tasks, and problem-solving. Always respond in the language the user uses."
+        "system_prompt": "You are ChatGPT-5, an advanced AI assistant created by OpenAI. You are a highly intelligent, helpful, and harmless AI that provides accurate, thoughtful, and comprehensive responses to user queries. You have extensive knowledge across all domains and can engage in complex reasoning, creative tasks, and problem-solving. Always respond in the language the user uses.",
+        "upstreams": DEFAULT_LLM_UPSTREAMS
     },
     "gemini": {
         "provider": "Google",
         "name": "Gemini 2.0",
         "description": "Генерация текста",
-        "system_prompt": "You are Gemini 2.0, an advanced AI assistant created by Google. You are known for your multimodal capabilities, reasoning skills, and ability to understand complex contexts. You provide thoughtful, accurate, and comprehensive responses. Always respond in the language the user uses."
+        "system_prompt": "You are Gemini 2.0, an advanced AI assistant created by Google. You are known for your multimodal capabilities, reasoning skills, and ability to understand complex contexts. You provide thoughtful, accurate, and comprehensive responses. Always respond in the language the user uses.",
+        "upstreams": DEFAULT_LLM_UPSTREAMS
     },
     "deepseek": {
         "provider": "DeepSeek",
         "name": "DeepSeek R1",
         "description": "Генерация текста",
-        "system_prompt": "You are DeepSeek R1, an advanced reasoning AI assistant created by DeepSeek. You excel at logical reasoning, problem-solving, and providing detailed explanations. You think step-by-step and provide thorough analysis. Always respond in the language the user uses."
+        "system_prompt": "You are DeepSeek R1, an advanced reasoning AI assistant created by DeepSeek. You excel at logical reasoning, problem-solving, and providing detailed explanations. You think step-by-step and provide thorough analysis. Always respond in the language the user uses.",
+        "upstreams": DEFAULT_LLM_UPSTREAMS
     },
     "claude": {
         "provider": "Anthropic",
         "name": "Claude 3.5",
         "description": "Генерация текста",
-        "system_prompt": "You are Claude 3.5, an advanced AI assistant created by Anthropic. You are known for your thoughtful analysis, nuanced understanding, and ethical reasoning. You provide balanced, insightful responses while being honest about limitations. Always respond in the language the user uses."
+        "system_prompt": "You are Claude 3.5, an advanced AI assistant created by Anthropic. You are known for your thoughtful analysis, nuanced understanding, and ethical reasoning. You provide balanced, insightful responses while being honest about limitations. Always respond in the language the user uses.",
+        "upstreams": DEFAULT_LLM_UPSTREAMS
     },
     "claude_sonnet": {
         "provider": "Anthropic",
         "name": "Claude Sonnet 4.5",
         "description": "Генерация текста",
-        "system_prompt": "You are Claude Sonnet 4.5, an advanced AI assistant created by Anthropic. You are optimized for speed and efficiency while maintaining high quality reasoning. You excel at creative tasks and provide nuanced, thoughtful responses. Always respond in the language the user uses."
+        "system_prompt": "You are Claude Sonnet 4.5, an advanced AI assistant created by Anthropic. You are optimized for speed and efficiency while maintaining high quality reasoning. You excel at creative tasks and provide nuanced, thoughtful responses. Always respond in the language the user uses.",
+        "upstreams": DEFAULT_LLM_UPSTREAMS
     },
     "claude_haiku": {
         "provider": "Anthropic",
         "name": "Claude Haiku 4.5",
         "description": "Генерация текста",
-        "system_prompt": "You are Claude Haiku 4.5, a lightweight yet capable AI assistant created by Anthropic. You are designed for quick, efficient responses while maintaining quality. You are helpful, harmless, and honest. Always respond in the language the user uses."
+        "system_prompt": "You are Claude Haiku 4.5, a lightweight yet capable AI assistant created by Anthropic. You are designed for quick, efficient responses while maintaining quality. You are helpful, harmless, and honest. Always respond in the language the user uses.",
+        "upstreams": ["meta/llama-3.1-8b-instruct", "minimaxai/minimax-m2.5"]
     },
     "claude_opus": {
         "provider": "Anthropic",
         "name": "Claude Opus 4.6",
         "description": "Генерация текста",
-        "system_prompt": "You are Claude Opus 4.6, the most advanced AI assistant created by Anthropic. You excel at complex reasoning, deep analysis, and nuanced understanding. You provide comprehensive, thoughtful responses to even the most challenging questions. Always respond in the language the user uses."
+        "system_prompt": "You are Claude Opus 4.6, the most advanced AI assistant created by Anthropic. You excel at complex reasoning, deep analysis, and nuanced understanding. You provide comprehensive, thoughtful responses to even the most challenging questions. Always respond in the language the user uses.",
+        "upstreams": DEFAULT_LLM_UPSTREAMS
     },
     "qwen": {
         "provider": "Alibaba",
         "name": "Qwen 2.5",
         "description": "Генерация текста",
-        "system_prompt": "You are Qwen 2.5, an advanced AI assistant created by Alibaba. You are multilingual and excel at understanding diverse contexts and providing practical solutions. You are helpful, harmless, and honest. Always respond in the language the user uses."
+        "system_prompt": "You are Qwen 2.5, an advanced AI assistant created by Alibaba. You are multilingual and excel at understanding diverse contexts and providing practical solutions. You are helpful, harmless, and honest. Always respond in the language the user uses.",
+        "upstreams": DEFAULT_LLM_UPSTREAMS
     },
     "llama": {
         "provider": "Meta",
         "name": "Llama 3.1",
         "description": "Генерация текста",
-        "system_prompt": "You are Llama 3.1, an advanced AI assistant created by Meta. You are open-source and designed to be helpful, harmless, and honest. You provide clear, direct responses and excel at following instructions. Always respond in the language the user uses."
+        "system_prompt": "You are Llama 3.1, an advanced AI assistant created by Meta. You are open-source and designed to be helpful, harmless, and honest. You provide clear, direct responses and excel at following instructions. Always respond in the language the user uses.",
+        "upstreams": ["meta/llama-3.1-70b-instruct", "minimaxai/minimax-m2.5"]
     },
     "schnell": {
         "provider": "Gemini",
         "url": "https://ai.api.nvidia.com/v1/genai/black-forest-labs/flux.1-schnell",
         "name": "NanoBanana 1",
         "description": "Быстрая генерация (4 шага)",
+        "max_concurrency": 4,
+        "max_inflight": 16,
         "params": {
             "width": 1024,
             "height": 1024,
@@ -169,6 +354,8 @@ MODELS = {
         "url": "https://ai.api.nvidia.com/v1/genai/black-forest-labs/flux.1-dev",
         "name": "NanoBanana 2",
         "description": "Качественная генерация (50 шагов)",
+        "max_concurrency": 2,
+        "max_inflight": 8,
         "params": {
             "width": 1024,
             "height": 1024,
@@ -183,6 +370,8 @@ MODELS = {
         "url": "https://ai.api.nvidia.com/v1/genai/stabilityai/stable-diffusion-3-medium",
         "name": "Stable Diffusion 3",
         "description": "Качественная генерация от Stability AI",
+        "max_concurrency": 2,
+        "max_inflight": 8,
         "params": {
             "cfg_scale": 5,
             "aspect_ratio": "1:1",
@@ -196,6 +385,8 @@ MODELS = {
         "url": "https://ai.api.nvidia.com/v1/genai/black-forest-labs/flux-1-kontext-dev",
         "name": "NanoBanana Edit",
         "description": "Контекстная генерация (требует фото)",
+        "max_concurrency": 1,
+        "max_inflight": 4,
         "params": {
             "steps": 30,
             "guidance_scale": 3.5,
@@ -1,27 +1,46 @@
 """Обработчики команд и сообщений"""
+import asyncio
 import logging
-import base64
+import time
 from aiogram import Router, F
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, BufferedInputFile, CallbackQuery, BotCommand
 from aiogram.fsm.context import FSMContext
 from aiogram.types.menu_button_commands import MenuButtonCommands
 
-from config import MODELS, PREMIUM_TIERS
+from config import (
+    MODELS, PREMIUM_TIERS, IMAGE_VARIANTS_MAX, ADMIN_IDS, ANSWER_CACHE_ENABLED, JOB_QUEUE_MAX_PENDING,
+    VOICE_MAX_DURATION
+)
 from states import GenerationStates
-from keyboards import get_main_menu, get_model_keyboard, get_image_model_keyboard, get_premium_keyboard
+from keyboards import get_main_menu, get_model_keyboard, get_image_model_keyboard, get_premium_keyboard, get_cancel_keyboard
 from ai_generator import generate_text, generate_image
+from image_tools import pop_original, prepare_kontext_image, encode_base64
+from blob_store import put_blob, get_blob, delete_blob
+from sender import outbound
+from offload import run_offloaded, offload_stats, lag_monitor
+from job_queue import enqueue_image_job, deliver_image, pending_job_count, cancel_pending_jobs, progress_reporter
 from web_search import web_search
-from user_manager import (
-    get_user_limits, check_limit, decrease_limit,
-    load_user_data, save_user_data
-)
+from promo import redeem_promocode, PromoError
+from usage_log import usage_log
+from answer_cache import answer_cache
+from user_context import UserContext, UserContextMiddleware, user_models
+from admission import AdmissionMiddleware, BUSY_TEXT, admission
+from cancellation import run_cancellable, cancel_operations, OperationCancelled
+from voice import transcribe_voice, VoiceError
 
 logger = logging.getLogger(__name__)
 router = Router()
+# Приоритеты и сброс нагрузки (класс обработчика - флаг "admission") - первыми:
+# отклоненный update не читает и не создает запись пользователя
+router.message.middleware(AdmissionMiddleware())
+router.callback_query.middleware(AdmissionMiddleware())
+# Запись пользователя загружается один раз за update и сохраняется в конце
+router.message.middleware(UserContextMiddleware())
+router.callback_query.middleware(UserContextMiddleware())
 
-# Хранилище текущей модели для каждого пользователя
-user_models = {}
+# Количество вариантов изображения для каждого пользователя (режим /variants)
+user_variants = {}
 
 
 @router.message(CommandStart())
@@ -34,29 +53,30 @@ async def cmd_start(message: Message):
     )
 
 
-@router.message(Command("ask"))
-async def cmd_ask(message: Message):
+@router.message(Command("ask"), flags={"admission": "text"})
+async def cmd_ask(message: Message, user_ctx: UserContext):
     """Обработчик команды /ask - генерация текста"""
     if not message.text or message.text == "/ask":
         await message.answer("Используй: /ask <твой вопрос>\n\nНапример: /ask Что такое искусственный интеллект?")
         return
     
     prompt = message.text.replace("/ask ", "", 1)
-    user_id = message.from_user.id
-    model_key = user_models.get(user_id, "text")
-    status_msg = await message.answer("🤖 Генерирую ответ...")
+    model_key = user_ctx.model_key
+    status_msg = await message.answer("🤖 Генерирую ответ...", reply_markup=get_cancel_keyboard())
     
     try:
-        response_text = await generate_text(prompt, model_key, user_id)
-        
-        if len(response_text) > 4096:
-            for i in range(0, len(response_text), 4096):
-                await message.answer(response_text[i:i+4096])
-        else:
-            await message.answer(response_text)
+        # При включенном кэше /ask отвечает без истории, одинаковые вопросы - из кэша
+        response_text = await run_cancellable(
+            generate_text(prompt, model_key, user_ctx, cached=ANSWER_CACHE_ENABLED),
+            user_ctx.user_id, message.chat.id, status_msg.message_id
+        )
         
-        await status_msg.delete()
+        await outbound.send_text(message.chat.id, response_text)
+        await outbound.delete_message(status_msg.chat.id, status_msg.message_id)
         
+    except OperationCancelled:
+        # Сообщение со статусом уже изменил обработчик отмены
+        pass
     except Exception as e:
         logger.error(f"Ошибка при генерации текста: {e}")
         await status_msg.edit_text(
@@ -74,12 +94,38 @@ async def cmd_help(message: Message):
         "/start - Открыть главное меню\n"
         "/ask <вопрос> - Задать вопрос боту\n"
         "/model - Выбрать модель для генерации\n"
+        "/variants <N> - Несколько вариантов картинки за раз\n"
+        "/cancel - Отменить текущую генерацию\n"
         "/help - Показать эту справку\n\n"
+        "🎤 Голосовые сообщения тоже работают - бот распознает речь.\n\n"
         "Или используй кнопки меню ниже!",
         reply_markup=get_main_menu()
     )
 
 
+@router.message(Command("variants"))
+async def cmd_variants(message: Message):
+    """Обработчик команды /variants - сколько вариантов изображения генерировать"""
+    args = message.text.split() if message.text else []
+    
+    if len(args) < 2 or not args[1].isdigit() or not 1 <= int(args[1]) <= IMAGE_VARIANTS_MAX:
+        current = user_variants.get(message.from_user.id, 1)
+        await message.answer(
+            f"🖼 Сейчас вариантов за запрос: {current}\n\n"
+            f"Используй: /variants N (от 1 до {IMAGE_VARIANTS_MAX})\n\n"
+            f"Каждый вариант списывает один запрос модели изображений."
+        )
+        return
+    
+    count = int(args[1])
+    if count == 1:
+        user_variants.pop(message.from_user.id, None)
+    else:
+        user_variants[message.from_user.id] = count
+    
+    await message.answer(f"✅ Теперь за запрос будет генерироваться вариантов: {count}")
+
+
 @router.message(Command("model"))
 async def cmd_model(message: Message, state: FSMContext):
     """Обработчик команды /model - выбор модели"""
@@ -87,7 +133,7 @@ async def cmd_model(message: Message, state: FSMContext):
 
 
 @router.message(Command("promo"))
-async def cmd_promo(message: Message):
+async def cmd_promo(message: Message, user_ctx: UserContext):
     """Обработчик команды /promo - активация промокода"""
     if not message.text or len(message.text.split()) < 2:
         await message.answer(
@@ -100,31 +146,17 @@ async def cmd_promo(message: Message):
     promo_code = message.text.split()[1].upper()
     user_id = message.from_user.id
     
-    data = load_user_data()
-    
-    # Проверяем существование промокода
-    if promo_code not in data["promocodes"]:
-        await message.answer("❌ Промокод не найден!")
-        return
-    
-    # Проверяем, использован ли промокод
-    if data["promocodes"][promo_code]["used"]:
-        await message.answer("❌ Этот промокод уже использован!")
+    try:
+        # Активация - атомарный UPDATE в базе промокодов
+        tier = await asyncio.to_thread(redeem_promocode, promo_code, user_id)
+    except PromoError as e:
+        await message.answer(str(e))
         return
     
-    # Активируем промокод
-    tier = data["promocodes"][promo_code]["tier"]
     tier_data = PREMIUM_TIERS[tier]
     
-    user_id_str = str(user_id)
-    data["users"][user_id_str] = {
-        "tier": tier,
-        "limits": tier_data["limits"].copy()
-    }
-    data["promocodes"][promo_code]["used"] = True
-    data["promocodes"][promo_code]["used_by"] = user_id
-    
-    save_user_data(data)
+    # Пакет пользователя сохранится вместе с остальными изменениями update
+    user_ctx.set_tier(tier)
     
     await message.answer(
         f"✅ Промокод активирован!\n\n"
@@ -134,13 +166,10 @@ async def cmd_promo(message: Message):
 
 
 @router.message(Command("limits"))
-async def cmd_limits(message: Message):
+async def cmd_limits(message: Message, user_ctx: UserContext):
     """Показывает оставшиеся лимиты пользователя"""
-    user_id = message.from_user.id
-    user_data = get_user_limits(user_id)
-    
-    tier_name = PREMIUM_TIERS.get(user_data["tier"], {}).get("name", "Бесплатный")
-    limits = user_data["limits"]
+    tier_name = PREMIUM_TIERS.get(user_ctx.tier, {}).get("name", "Бесплатный")
+    limits = user_ctx.limits
     
     limits_text = "\n".join([
         f"• Chat GPT 5: {limits.get('text', 0)} запросов",
@@ -162,6 +191,99 @@ async def cmd_limits(message: Message):
     )
 
 
+async def cancel_user_generations(user_id: int, message_id: int = None) -> int:
+    """Отменяет генерации пользователя (или только привязанную к message_id)
+
+    Выполняющиеся генерации прерываются, ожидающие задачи снимаются
+    с очереди с возвратом лимита. Сообщения со статусом помечаются
+    как отмененные. Возвращает количество отмененных генераций.
+    """
+    status_messages = cancel_operations(user_id, message_id)
+    for job in await cancel_pending_jobs(user_id, message_id):
+        status_messages.append((job["chat_id"], job["status_message_id"]))
+    
+    for chat_id, status_message_id in status_messages:
+        if status_message_id is None:
+            continue
+        try:
+            await outbound.edit_message(chat_id, status_message_id, "🚫 Генерация отменена")
+        except Exception as e:
+            logger.warning(f"Не удалось изменить сообщение со статусом: {e}")
+    return len(status_messages)
+
+
+@router.message(Command("cancel"))
+async def cmd_cancel(message: Message, state: FSMContext):
+    """Обработчик команды /cancel - отмена генераций и текущего режима"""
+    cancelled = await cancel_user_generations(message.from_user.id)
+    await state.clear()
+    
+    if cancelled:
+        await message.answer(f"🚫 Отменено генераций: {cancelled}", reply_markup=get_main_menu())
+    else:
+        await message.answer("Нечего отменять. Режим сброшен.", reply_markup=get_main_menu())
+
+
+@router.callback_query(F.data == "cancel")
+async def cancel_generation(query: CallbackQuery, state: FSMContext):
+    """Кнопка «Отмена» под сообщением со статусом генерации"""
+    cancelled = await cancel_user_generations(query.from_user.id, query.message.message_id)
+    await state.clear()
+    await query.answer("🚫 Отменено" if cancelled else "Генерация уже завершена")
+
+
+@router.message(Command("usage"))
+async def cmd_usage(message: Message):
+    """Статистика использования моделей за день (только для админов)
+
+    /usage или /usage 2025-01-31
+    """
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    
+    parts = message.text.split()
+    day = parts[1] if len(parts) > 1 else None
+    # Агрегаты готовые - чтение не зависит от объема журнала
+    stats = usage_log.day_stats(day)
+    
+    lines = [] if stats else ["Событий нет"]
+    for model_key, model_stats in sorted(stats.items(), key=lambda item: -item[1]["requests"]):
+        name = MODELS.get(model_key, {}).get("name", model_key)
+        avg_latency = model_stats["latency_ms"] / model_stats["requests"] / 1000
+        line = f"• {name}: {model_stats['requests']} запросов, ошибок {model_stats['errors']}, {avg_latency:.1f} сек."
+        if model_stats["prompt_tokens"] or model_stats["completion_tokens"]:
+            line += f", токенов {model_stats['prompt_tokens']} + {model_stats['completion_tokens']}"
+        else:
+            line += f", изображений {model_stats['units']}"
+        lines.append(line)
+    
+    if ANSWER_CACHE_ENABLED:
+        cache_stats = answer_cache.stats()
+        lines.append(
+            f"\n💾 Кэш /ask: попаданий {cache_stats['hit_rate']:.0%} "
+            f"({cache_stats['hits']} из {cache_stats['hits'] + cache_stats['misses']}), записей {cache_stats['entries']}"
+        )
+    
+    lines.append("\n🚦 Допуск (выполняется / ждет / отклонено с запуска):")
+    for name, class_stats in admission.stats().items():
+        lines.append(f"• {name}: {class_stats['active']}/{class_stats['limit']}, {class_stats['waiting']}, {class_stats['shed']}")
+    
+    # Отзывчивость: задержка event loop и работа, вынесенная из него
+    lag = lag_monitor.stats()
+    lines.append(
+        f"\n⏱ Задержка event loop: p50 {lag['p50'] * 1000:.0f} мс, p99 {lag['p99'] * 1000:.0f} мс, "
+        f"max {lag['max'] * 1000:.0f} мс (с запуска {lag['max_total'] * 1000:.0f} мс)"
+    )
+    for kind, pool_stats in offload_stats().items():
+        if pool_stats["calls"]:
+            lines.append(
+                f"• пул {kind}: {pool_stats['calls']} задач, "
+                f"в среднем {pool_stats['seconds'] / pool_stats['calls'] * 1000:.0f} мс"
+            )
+    
+    await message.answer(f"📈 Использование за {day or 'сегодня'}\n\n" + "\n".join(lines))
+
+
 @router.message(F.text == "🤖 Что умеет бот")
 async def btn_about_bot(message: Message):
     """Обработчик кнопки 'Что умеет бот'"""
@@ -199,12 +321,9 @@ async def btn_web_search(message: Message, state: FSMContext):
 
 
 @router.message(F.text == "🚀 Премиум")
-async def btn_premium(message: Message):
+async def btn_premium(message: Message, user_ctx: UserContext):
     """Обработчик кнопки 'Премиум'"""
-    user_id = message.from_user.id
-    user_data = get_user_limits(user_id)
-
-    current_tier = user_data.get("tier", "free")
+    current_tier = user_ctx.tier
     tier_name = PREMIUM_TIERS.get(current_tier, {}).get("name", "Бесплатный")
 
     await message.answer(
@@ -216,13 +335,10 @@ async def btn_premium(message: Message):
 
 
 @router.callback_query(F.data.startswith("premium_"))
-async def show_premium_tier(query: CallbackQuery):
+async def show_premium_tier(query: CallbackQuery, user_ctx: UserContext):
     """Показывает детали премиум пакета"""
     if query.data == "premium_back":
-        user_id = query.from_user.id
-        user_data = get_user_limits(user_id)
-        
-        current_tier = user_data.get("tier", "free")
+        current_tier = user_ctx.tier
         tier_name = PREMIUM_TIERS.get(current_tier, {}).get("name", "Бесплатный")
         
         await query.message.edit_text(
@@ -265,7 +381,7 @@ async def show_premium_tier(query: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("model_"))
-async def select_model(query: CallbackQuery, state: FSMContext):
+async def select_model(query: CallbackQuery, state: FSMContext, user_ctx: UserContext):
     """Обработчик выбора модели"""
     model_key = query.data.split("_", 1)[1]
     
@@ -283,7 +399,7 @@ async def select_model(query: CallbackQuery, state: FSMContext):
         )
         return
     
-    user_models[query.from_user.id] = model_key
+    user_ctx.model_key = model_key
     model = MODELS[model_key]
     
     await query.answer()
@@ -304,13 +420,67 @@ async def select_model(query: CallbackQuery, state: FSMContext):
         await state.set_state(GenerationStates.waiting_for_prompt)
 
 
+async def queue_image_generation(message: Message, user_ctx: UserContext, prompt: str, model_key: str):
+    """Списывает лимит и ставит генерацию изображения в очередь"""
+    count = user_variants.get(user_ctx.user_id, 1)
+    
+    # Очередь переполнена - отказываем сразу, а не через несколько минут ожидания
+    if await pending_job_count() >= JOB_QUEUE_MAX_PENDING:
+        await message.answer(BUSY_TEXT)
+        return
+    
+    # Списываем лимит сразу за весь пакет; при неудаче воркер его вернет
+    if not user_ctx.reserve_limit(model_key, count):
+        await message.answer(
+            f"❌ Не хватает запросов для {count} вариантов!\n\n"
+            f"Уменьши количество через /variants или посмотри остатки в /limits"
+        )
+        return
+    
+    if count > 1:
+        status_msg = await message.answer(
+            f"🎨 Генерирую {count} варианта(ов), подождите...", reply_markup=get_cancel_keyboard()
+        )
+    else:
+        status_msg = await message.answer("🎨 Генерирую изображение, подождите...", reply_markup=get_cancel_keyboard())
+    
+    try:
+        await enqueue_image_job(
+            message.chat.id, user_ctx.user_id, model_key, prompt,
+            variants=count, status_message_id=status_msg.message_id
+        )
+    except Exception as e:
+        user_ctx.refund_limit(model_key, count)
+        logger.error(f"Ошибка при постановке задачи в очередь: {e}")
+        await status_msg.edit_text(
+            f"❌ Произошла ошибка при генерации изображения:\n{str(e)}\n\n"
+            "Попробуйте ещё раз или измените описание."
+        )
+
+
+@router.callback_query(F.data.startswith("original_"))
+async def send_original_image(query: CallbackQuery):
+    """Отправляет оригинальное изображение файлом по запросу"""
+    original_key = query.data.split("_", 1)[1]
+    image_bytes = pop_original(original_key)
+    
+    if image_bytes is None:
+        await query.answer("❌ Оригинал больше недоступен", show_alert=True)
+        return
+    
+    await query.answer()
+    await query.message.answer_document(
+        document=BufferedInputFile(file=image_bytes, filename="generated_image.png")
+    )
+    await query.message.edit_reply_markup(reply_markup=None)
+
+
 @router.message(F.photo)
-async def handle_photo(message: Message, state: FSMContext):
+async def handle_photo(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработчик загрузки фото для контекстной генерации"""
-    from main import bot
-    user_id = message.from_user.id
+    bot = message.bot
     
-    if user_models.get(user_id) != "kontext":
+    if user_models.get(user_ctx.user_id) != "kontext":
         await message.answer("Сначала выбери модель /model (FLUX.1-kontext-dev для работы с фото)")
         return
     
@@ -318,40 +488,128 @@ async def handle_photo(message: Message, state: FSMContext):
     file = await bot.get_file(photo.file_id)
     file_bytes = await bot.download_file(file.file_path)
     
-    # Сохраняем только base64 без префикса
-    image_b64 = base64.b64encode(file_bytes.getvalue()).decode()
+    # Уменьшаем фото и храним на диске, в FSM только ссылка
+    image_bytes = await prepare_kontext_image(file_bytes.getvalue())
     
-    await state.update_data(image_data=image_b64)
+    data = await state.get_data()
+    if data.get("image_ref"):
+        await delete_blob(data["image_ref"])
+    
+    image_ref = await put_blob(image_bytes)
+    await state.update_data(image_ref=image_ref)
     
     await message.answer("📸 Фото получено! Теперь отправь описание, что нужно изменить.")
     await state.set_state(GenerationStates.waiting_for_context_prompt)
 
 
-@router.message(GenerationStates.waiting_for_context_prompt)
-async def handle_context_prompt(message: Message, state: FSMContext):
+@router.message(F.voice, flags={"admission": "model"})
+async def handle_voice(message: Message, state: FSMContext, user_ctx: UserContext):
+    """Обработчик голосовых: распознанный текст обрабатывается как обычное сообщение"""
+    current_state = await state.get_state()
+    if current_state not in (None, GenerationStates.waiting_for_prompt.state):
+        await message.answer("🎤 Сейчас нужен текст - отправь его обычным сообщением.")
+        return
+    
+    voice = message.voice
+    if voice.duration > VOICE_MAX_DURATION:
+        await message.answer(f"❌ Голосовое слишком длинное: максимум {VOICE_MAX_DURATION} сек.")
+        return
+    
+    model_key = user_ctx.model_key
+    
+    # Лимит проверяем до распознавания - без запросов не на что тратить API
+    if not user_ctx.check_limit(model_key):
+        await message.answer(
+            "❌ У тебя закончились запросы для этой модели!\n\n"
+            "Используй /limits чтобы посмотреть остатки или купи новый пакет через 🚀 Премиум"
+        )
+        await state.clear()
+        return
+    
+    status_msg = await message.answer("🎤 Распознаю голосовое...", reply_markup=get_cancel_keyboard())
+    try:
+        prompt, cached = await run_cancellable(
+            transcribe_voice(message.bot, voice),
+            user_ctx.user_id, message.chat.id, status_msg.message_id
+        )
+    except OperationCancelled:
+        # Сообщение со статусом уже изменил обработчик отмены
+        return
+    except VoiceError as e:
+        await status_msg.edit_text(str(e))
+        return
+    except Exception as e:
+        logger.error(f"Ошибка при распознавании голосового: {e}")
+        await status_msg.edit_text(
+            f"❌ Не удалось распознать голосовое:\n{str(e)}\n\n"
+            "Попробуйте ещё раз."
+        )
+        return
+    
+    if not prompt:
+        await status_msg.edit_text("🤷 Не удалось разобрать речь в голосовом")
+        return
+    
+    logger.info(f"Голосовое {voice.file_unique_id} распознано{' (из кэша)' if cached else ''}: {prompt}")
+    await status_msg.edit_text(f"🎤 {prompt}")
+    await state.clear()
+    
+    if model_key in ["text", "gemini", "deepseek", "claude", "claude_sonnet", "claude_haiku", "claude_opus", "qwen", "llama"]:
+        await reply_with_text(message, user_ctx, prompt, model_key)
+    else:
+        # Генерация изображения выполняется воркером из очереди
+        await queue_image_generation(message, user_ctx, prompt, model_key)
+
+
+@router.message(GenerationStates.waiting_for_context_prompt, flags={"admission": "image"})
+async def handle_context_prompt(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработчик промпта для контекстной генерации"""
     prompt = message.text
-    user_id = message.from_user.id
-    model_key = user_models.get(user_id, "schnell")
+    model_key = user_models.get(user_ctx.user_id, "schnell")
     
-    status_msg = await message.answer("🎨 Генерирую изображение, подождите...")
+    status_msg = await message.answer("🎨 Генерирую изображение, подождите...", reply_markup=get_cancel_keyboard())
+    
+    data = await state.get_data()
+    image_ref = data.get("image_ref")
     
     try:
-        data = await state.get_data()
-        image_data = data.get("image_data")
+        uploaded = await get_blob(image_ref) if image_ref else None
+        
+        if uploaded is None:
+            await status_msg.edit_text("❌ Фото устарело или не найдено. Отправь его ещё раз.")
+            await state.clear()
+            return
         
-        image_bytes, request_info = await generate_image(prompt, model_key, image_data)
+        # Сохраняем только base64 без префикса
+        image_data = await run_offloaded(encode_base64, uploaded, size=len(uploaded))
         
-        image_file = BufferedInputFile(file=image_bytes, filename="generated_image.png")
+        started = time.monotonic()
+        try:
+            image_bytes, request_info = await run_cancellable(
+                generate_image(
+                    prompt, model_key, image_data,
+                    progress=progress_reporter(message.chat.id, status_msg.message_id)
+                ),
+                user_ctx.user_id, message.chat.id, status_msg.message_id
+            )
+        except OperationCancelled:
+            raise
+        except Exception:
+            usage_log.record(user_ctx.user_id, model_key, time.monotonic() - started, ok=False, units=0)
+            raise
+        usage_log.record(user_ctx.user_id, model_key, time.monotonic() - started, size=len(image_bytes))
         
         caption = f"✨ Готово!\n\nМодель: {request_info['model']}"
         if request_info["request_id"] != "N/A":
             caption += f"\n🔑 ID запроса: {request_info['request_id']}"
         
-        await message.answer_photo(photo=image_file, caption=caption)
+        await deliver_image(message.chat.id, image_bytes, caption)
         await status_msg.delete()
         await state.clear()
         
+    except OperationCancelled:
+        # Сообщение со статусом и состояние уже обработал обработчик отмены
+        pass
     except Exception as e:
         logger.error(f"Ошибка при генерации изображения: {e}")
         await status_msg.edit_text(
@@ -359,26 +617,29 @@ async def handle_context_prompt(message: Message, state: FSMContext):
             "Попробуйте ещё раз или измените описание."
         )
         await state.clear()
+    finally:
+        if image_ref:
+            await delete_blob(image_ref)
 
 
-@router.message(GenerationStates.waiting_for_search_query)
+@router.message(GenerationStates.waiting_for_search_query, flags={"admission": "text"})
 async def handle_search_query(message: Message, state: FSMContext):
     """Обработчик поискового запроса"""
     query = message.text
-    status_msg = await message.answer("🔍 Ищу результаты...")
+    status_msg = await message.answer("🔍 Ищу результаты...", reply_markup=get_cancel_keyboard())
     
     try:
-        results = await web_search(query)
-        
-        if len(results) > 4096:
-            for i in range(0, len(results), 4096):
-                await message.answer(results[i:i+4096])
-        else:
-            await message.answer(results)
+        results = await run_cancellable(
+            web_search(query), message.from_user.id, message.chat.id, status_msg.message_id
+        )
         
-        await status_msg.delete()
+        await outbound.send_text(message.chat.id, results)
+        await outbound.delete_message(status_msg.chat.id, status_msg.message_id)
         await state.clear()
         
+    except OperationCancelled:
+        # Сообщение со статусом и состояние уже обработал обработчик отмены
+        pass
     except Exception as e:
         logger.error(f"Ошибка при поиске: {e}")
         await status_msg.edit_text(
@@ -388,15 +649,45 @@ async def handle_search_query(message: Message, state: FSMContext):
         await state.clear()
 
 
-@router.message(GenerationStates.waiting_for_prompt)
-async def handle_prompt(message: Message, state: FSMContext):
+async def reply_with_text(message: Message, user_ctx: UserContext, prompt: str, model_key: str):
+    """Генерирует ответ текстовой модели, списывает лимит и отправляет ответ"""
+    status_msg = await message.answer("🤖 Генерирую ответ...", reply_markup=get_cancel_keyboard())
+    try:
+        response_text = await run_cancellable(
+            generate_text(prompt, model_key, user_ctx),
+            user_ctx.user_id, message.chat.id, status_msg.message_id
+        )
+        
+        # Уменьшаем лимит после успешной генерации
+        user_ctx.decrease_limit(model_key)
+        
+        # Остаток показываем в последней части ответа
+        remaining = user_ctx.remaining(model_key)
+        
+        await outbound.send_text(
+            message.chat.id, response_text, footer=f"📊 Осталось запросов: {remaining}"
+        )
+        await outbound.delete_message(status_msg.chat.id, status_msg.message_id)
+        
+    except OperationCancelled:
+        # Сообщение со статусом уже изменил обработчик отмены
+        pass
+    except Exception as e:
+        logger.error(f"Ошибка при генерации текста: {e}")
+        await status_msg.edit_text(
+            f"❌ Произошла ошибка при генерации текста:\n{str(e)}\n\n"
+            "Попробуйте ещё раз."
+        )
+
+
+@router.message(GenerationStates.waiting_for_prompt, flags={"admission": "model"})
+async def handle_prompt(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработчик промпта"""
     prompt = message.text
-    user_id = message.from_user.id
-    model_key = user_models.get(user_id, "text")
+    model_key = user_ctx.model_key
     
     # Проверяем лимит
-    if not check_limit(user_id, model_key):
+    if not user_ctx.check_limit(model_key):
         await message.answer(
             f"❌ У тебя закончились запросы для этой модели!\n\n"
             f"Используй /limits чтобы посмотреть остатки или купи новый пакет через 🚀 Премиум"
@@ -404,64 +695,12 @@ async def handle_prompt(message: Message, state: FSMContext):
         await state.clear()
         return
     
-    model = MODELS.get(model_key, MODELS["text"])
-    
     # Если выбрана текстовая модель
     if model_key in ["text", "gemini", "deepseek", "claude", "claude_sonnet", "claude_haiku", "claude_opus", "qwen", "llama"]:
-        status_msg = await message.answer("🤖 Генерирую ответ...")
-        try:
-            response_text = await generate_text(prompt, model_key, user_id)
-            
-            # Уменьшаем лимит после успешной генерации
-            decrease_limit(user_id, model_key)
-            
-            if len(response_text) > 4096:
-                for i in range(0, len(response_text), 4096):
-                    await message.answer(response_text[i:i+4096])
-            else:
-                await message.answer(response_text)
-            
-            await status_msg.delete()
-            
-            # Показываем остаток
-            user_data = get_user_limits(user_id)
-            remaining = user_data["limits"].get(model_key, 0)
-            await message.answer(f"📊 Осталось запросов: {remaining}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при генерации текста: {e}")
-            await status_msg.edit_text(
-                f"❌ Произошла ошибка при генерации текста:\n{str(e)}\n\n"
-                "Попробуйте ещё раз."
-            )
+        await reply_with_text(message, user_ctx, prompt, model_key)
     else:
-        # Генерация изображения
-        status_msg = await message.answer("🎨 Генерирую изображение, подождите...")
-        
-        try:
-            image_bytes, request_info = await generate_image(prompt, model_key)
-            
-            # Уменьшаем лимит после успешной генерации
-            decrease_limit(user_id, model_key)
-            
-            image_file = BufferedInputFile(file=image_bytes, filename="generated_image.png")
-            
-            user_data = get_user_limits(user_id)
-            remaining = user_data["limits"].get(model_key, 0)
-            
-            caption = f"✨ Готово!\n\nМодель: {request_info['model']}\n\n📊 Осталось: {remaining}"
-            if request_info["request_id"] != "N/A":
-                caption += f"\n🔑 ID: {request_info['request_id']}"
-            
-            await message.answer_photo(photo=image_file, caption=caption)
-            await status_msg.delete()
-            
-        except Exception as e:
-            logger.error(f"Ошибка при генерации изображения: {e}")
-            await status_msg.edit_text(
-                f"❌ Произошла ошибка при генерации изображения:\n{str(e)}\n\n"
-                "Попробуйте ещё раз или измените описание."
-            )
+        # Генерация изображения выполняется воркером из очереди
+        await queue_image_generation(message, user_ctx, prompt, model_key)
     
     await state.clear()
 
@@ -476,8 +715,8 @@ async def handle_unknown_command(message: Message):
     await message.answer(commands_list, reply_markup=get_main_menu())
 
 
-@router.message(F.text)
-async def handle_text(message: Message, state: FSMContext):
+@router.message(F.text, flags={"admission": "model"})
+async def handle_text(message: Message, state: FSMContext, user_ctx: UserContext):
     """Обработчик текстовых сообщений"""
     prompt = message.text
     
@@ -499,75 +738,22 @@ async def handle_text(message: Message, state: FSMContext):
     if prompt in menu_buttons:
         return
     
-    user_id = message.from_user.id
-    model_key = user_models.get(user_id, "text")
+    model_key = user_ctx.model_key
     
     # Проверяем лимит
-    if not check_limit(user_id, model_key):
+    if not user_ctx.check_limit(model_key):
         await message.answer(
             f"❌ У тебя закончились запросы для этой модели!\n\n"
             f"Используй /limits чтобы посмотреть остатки или купи новый пакет через 🚀 Премиум"
         )
         return
     
-    model = MODELS.get(model_key, MODELS["text"])
-    
     # Если выбрана текстовая модель
     if model_key in ["text", "gemini", "deepseek", "claude", "claude_sonnet", "claude_haiku", "claude_opus", "qwen", "llama"]:
-        status_msg = await message.answer("🤖 Генерирую ответ...")
-        try:
-            response_text = await generate_text(prompt, model_key, user_id)
-            
-            # Уменьшаем лимит после успешной генерации
-            decrease_limit(user_id, model_key)
-            
-            if len(response_text) > 4096:
-                for i in range(0, len(response_text), 4096):
-                    await message.answer(response_text[i:i+4096])
-            else:
-                await message.answer(response_text)
-            
-            await status_msg.delete()
-            
-            # Показываем остаток
-            user_data = get_user_limits(user_id)
-            remaining = user_data["limits"].get(model_key, 0)
-            await message.answer(f"📊 Осталось запросов: {remaining}")
-            
-        except Exception as e:
-            logger.error(f"Ошибка при генерации текста: {e}")
-            await status_msg.edit_text(
-                f"❌ Произошла ошибка при генерации текста:\n{str(e)}\n\n"
-                "Попробуйте ещё раз."
-            )
+        await reply_with_text(message, user_ctx, prompt, model_key)
     else:
-        # Генерация изображения
-        status_msg = await message.answer("🎨 Генерирую изображение, подождите...")
-        
-        try:
-            image_bytes, request_info = await generate_image(prompt, model_key)
-            
-            # Уменьшаем лимит после успешной генерации
-            decrease_limit(user_id, model_key)
-            
-            image_file = BufferedInputFile(file=image_bytes, filename="generated_image.png")
-            
-            user_data = get_user_limits(user_id)
-            remaining = user_data["limits"].get(model_key, 0)
-            
-            caption = f"✨ Готово!\n\nМодель: {request_info['model']}\n\n📊 Осталось: {remaining}"
-            if request_info["request_id"] != "N/A":
-                caption += f"\n🔑 ID: {request_info['request_id']}"
-            
-            await message.answer_photo(photo=image_file, caption=caption)
-            await status_msg.delete()
-            
-        except Exception as e:
-            logger.error(f"Ошибка при генерации изображения: {e}")
-            await status_msg.edit_text(
-                f"❌ Произошла ошибка при генерации изображения:\n{str(e)}\n\n"
-                "Попробуйте ещё раз или измените описание."
-            )
+        # Генерация изображения выполняется воркером из очереди
+        await queue_image_generation(message, user_ctx, prompt, model_key)
 
 
 async def setup_bot_commands(bot):
@@ -576,6 +762,8 @@ async def setup_bot_commands(bot):
         BotCommand(command="start", description="🤖 Главное меню"),
         BotCommand(command="ask", description="📝 Задать вопрос"),
         BotCommand(command="model", description="🎨 Выбрать модель"),
+        BotCommand(command="variants", description="🖼 Варианты картинок"),
+        BotCommand(command="cancel", description="🚫 Отменить генерацию"),
         BotCommand(command="promo", description="🎁 Активировать промокод"),
         BotCommand(command="limits", description="📊 Мои лимиты"),
         BotCommand(command="help", description="❓ Справка"),
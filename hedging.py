@@ -0,0 +1,130 @@
+"""Hedged requests: дублирующий запрос при медленном ответе"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from config import (
+    HEDGE_PERCENTILE, HEDGE_BUDGET_PERCENT, HEDGE_MIN_SAMPLES, HEDGE_WINDOW
+)
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Скользящее окно задержек последних запросов для каждой модели"""
+
+    def __init__(self, window: int = HEDGE_WINDOW, min_samples: int = HEDGE_MIN_SAMPLES):
+        self.window = window
+        self.min_samples = min_samples
+        self.samples = {}
+
+    def record(self, key: str, latency: float):
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+        self.samples[key].append(latency)
+
+    def percentile(self, key: str, percentile: float) -> float | None:
+        """Перцентиль задержки (None, пока данных недостаточно)"""
+        samples = self.samples.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+        return ordered[index]
+
+
+class HedgeBudget:
+    """Ограничивает долю дублирующих запросов
+
+    Каждый основной запрос добавляет budget_percent / 100 токена,
+    дублирующий запрос тратит один токен. Так дополнительная нагрузка
+    не превышает budget_percent от основного трафика.
+    """
+
+    def __init__(self, budget_percent: float = HEDGE_BUDGET_PERCENT, max_tokens: float = 10):
+        self.ratio = budget_percent / 100
+        self.max_tokens = max_tokens
+        self.tokens = 0.0
+        self.requests = 0
+        self.hedges = 0
+
+    def on_request(self):
+        self.requests += 1
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        self.hedges += 1
+        return True
+
+
+latency_tracker = LatencyTracker()
+hedge_budget = HedgeBudget()
+
+
+async def _cancel(task: asyncio.Task):
+    """Отменяет проигравший запрос и дожидается его завершения"""
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+
+
+async def hedged_call(func, key: str, percentile: float = HEDGE_PERCENTILE):
+    """Выполняет запрос; если он медленнее перцентиля, запускает дубль
+
+    func - корутинная функция без аргументов. Возвращается результат
+    того запроса, который завершился успешно первым, второй отменяется.
+    """
+    hedge_budget.on_request()
+    threshold = latency_tracker.percentile(key, percentile)
+    started = time.monotonic()
+
+    primary = asyncio.create_task(func())
+    if threshold is None:
+        result = await primary
+        latency_tracker.record(key, time.monotonic() - started)
+        return result
+
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+    except asyncio.CancelledError:
+        await _cancel(primary)
+        raise
+
+    if done or not hedge_budget.try_spend():
+        result = await primary
+        latency_tracker.record(key, time.monotonic() - started)
+        return result
+
+    logger.info(f"Hedge для {key}: нет ответа за {threshold:.1f} сек., отправляю дубль")
+    hedge = asyncio.create_task(func())
+    pending = {primary, hedge}
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winner = next((task for task in done if task.exception() is None), None)
+            if winner is None and pending:
+                # Первый запрос упал - ждем второй
+                continue
+
+            for loser in pending:
+                await _cancel(loser)
+            pending = set()
+
+            if winner is None:
+                winner = next(iter(done))
+            else:
+                latency_tracker.record(key, time.monotonic() - started)
+                if winner is hedge:
+                    logger.info(f"Hedge для {key}: дубль ответил первым")
+            return winner.result()
+    except asyncio.CancelledError:
+        for task in pending:
+            await _cancel(task)
+        raise
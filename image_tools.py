@@ -0,0 +1,157 @@
+"""Обработка изображений перед отправкой пользователю"""
+import base64
+import json
+import logging
+import uuid
+import zipfile
+from collections import OrderedDict
+from io import BytesIO
+
+from config import (
+    IMAGE_OUTPUT_FORMAT, IMAGE_OUTPUT_QUALITY,
+    IMAGE_ORIGINALS_CACHE_SIZE, KONTEXT_IMAGE_MAX_SIDE
+)
+from offload import run_offloaded
+
+try:
+    from PIL import Image
+except ImportError:
+    # Без Pillow отправляем изображения как есть
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Расширения файлов для поддерживаемых форматов
+FORMAT_EXTENSIONS = {
+    "jpeg": "jpg",
+    "webp": "webp",
+    "png": "png",
+}
+
+# Последние оригиналы для кнопки "Оригинал"
+_originals = OrderedDict()
+
+
+def _transcode(image_bytes: bytes, fmt: str, quality: int) -> bytes:
+    """Перекодирует изображение (выполняется в общем пуле потоков offload)"""
+    with Image.open(BytesIO(image_bytes)) as img:
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        output = BytesIO()
+        if fmt == "webp":
+            img.save(output, format="WEBP", quality=quality, method=4)
+        else:
+            img.save(output, format="JPEG", quality=quality, optimize=True, progressive=True)
+        return output.getvalue()
+
+
+async def transcode_image(image_bytes: bytes, fmt: str = None, quality: int = None) -> tuple[bytes, str]:
+    """Перекодирует изображение в JPEG/WebP вне event loop
+
+    Возвращает байты и имя файла. Если перекодирование отключено или
+    невозможно, возвращает исходный PNG.
+    """
+    fmt = (fmt or IMAGE_OUTPUT_FORMAT).lower()
+    quality = quality or IMAGE_OUTPUT_QUALITY
+
+    if fmt == "png" or fmt not in FORMAT_EXTENSIONS or Image is None:
+        return image_bytes, "generated_image.png"
+
+    try:
+        # Без size - в пуле потоков: Pillow отпускает GIL, а передача
+        # изображения в другой процесс стоила бы больше
+        result = await run_offloaded(_transcode, image_bytes, fmt, quality)
+    except Exception as e:
+        logger.error(f"Ошибка при перекодировании изображения: {e}")
+        return image_bytes, "generated_image.png"
+
+    logger.info(f"Изображение перекодировано в {fmt}: {len(image_bytes)} -> {len(result)} байт")
+    return result, f"generated_image.{FORMAT_EXTENSIONS[fmt]}"
+
+
+def _downscale(image_bytes: bytes, max_side: int, quality: int) -> bytes:
+    """Уменьшает изображение и пережимает в JPEG (выполняется в общем пуле потоков offload)"""
+    with Image.open(BytesIO(image_bytes)) as img:
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        output = BytesIO()
+        img.save(output, format="JPEG", quality=quality, optimize=True)
+        return output.getvalue()
+
+
+async def prepare_kontext_image(image_bytes: bytes) -> bytes:
+    """Готовит загруженное фото для kontext: уменьшает до нужного размера вне event loop"""
+    if Image is None:
+        return image_bytes
+
+    try:
+        result = await run_offloaded(_downscale, image_bytes, KONTEXT_IMAGE_MAX_SIDE, IMAGE_OUTPUT_QUALITY)
+    except Exception as e:
+        logger.error(f"Ошибка при уменьшении фото: {e}")
+        return image_bytes
+
+    logger.info(f"Фото подготовлено для kontext: {len(image_bytes)} -> {len(result)} байт")
+    return result
+
+
+def encode_base64(image_bytes: bytes) -> str:
+    """Кодирует фото в base64 строку (для пула процессов)"""
+    return base64.b64encode(image_bytes).decode()
+
+
+def decode_image_payload(body: bytes) -> bytes:
+    """Достает изображение из JSON ответа API генерации
+
+    Чистая функция уровня модуля: для больших ответов выполняется
+    в пуле процессов (offload.run_offloaded).
+    """
+    result = json.loads(body)
+
+    # Разные форматы ответа для разных моделей
+    if "artifacts" in result and len(result["artifacts"]) > 0:
+        # Формат Stability AI (SD3)
+        image_b64 = result["artifacts"][0].get("base64", "")
+    elif "image" in result:
+        # Формат FLUX
+        image_b64 = result["image"]
+    elif "data" in result and len(result["data"]) > 0:
+        # Альтернативный формат
+        image_b64 = result["data"][0].get("b64_json", "")
+    else:
+        raise Exception("Не удалось найти изображение в ответе API")
+
+    return base64.b64decode(image_b64)
+
+
+def extract_changenet_result(zip_bytes: bytes) -> bytes:
+    """Достает изображение результата из zip ответа Visual ChangeNet
+
+    Архив распаковывается в памяти; как и decode_image_payload,
+    выполняется вне event loop (offload.run_offloaded).
+    """
+    with zipfile.ZipFile(BytesIO(zip_bytes)) as archive:
+        files = archive.namelist()
+        logger.info(f"Файлы в архиве: {files}")
+        for name in files:
+            if name.lower().endswith((".png", ".jpg", ".jpeg")):
+                return archive.read(name)
+    raise Exception("Не найден файл результата в архиве")
+
+
+def remember_original(image_bytes: bytes) -> str:
+    """Сохраняет оригинал в памяти и возвращает ключ для кнопки"""
+    key = uuid.uuid4().hex[:16]
+    _originals[key] = image_bytes
+
+    while len(_originals) > IMAGE_ORIGINALS_CACHE_SIZE:
+        _originals.popitem(last=False)
+
+    return key
+
+
+def pop_original(key: str) -> bytes | None:
+    """Возвращает оригинал по ключу и удаляет его из памяти"""
+    return _originals.pop(key, None)
@@ -0,0 +1,438 @@
+"""Очередь задач генерации изображений (SQLite) и пул воркеров
+
+Взятая задача арендуется процессом (worker_id, lease_until), аренда
+продлевается, пока задача выполняется. Поэтому при перекрытии старого
+и нового процесса (webhook) и при нескольких процессах задача не
+выполняется дважды: чужие задачи забираются только после истечения аренды.
+"""
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import time
+from contextlib import closing
+
+from aiogram.types import BufferedInputFile, InputMediaPhoto
+
+from config import (
+    JOB_DB_FILE, JOB_WORKERS, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL, JOB_LEASE_SECONDS,
+    IMAGE_OFFER_ORIGINAL, IMAGE_PROGRESS_INTERVAL
+)
+from ai_generator import generate_image, generate_image_variants
+from image_tools import transcode_image, remember_original
+from keyboards import get_original_keyboard, get_cancel_keyboard
+from cancellation import run_cancellable, OperationCancelled
+from sender import outbound
+from user_manager import load_user_record, refund_limit, remaining_limit
+from usage_log import usage_log
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    model_key TEXT NOT NULL,
+    prompt TEXT NOT NULL,
+    variants INTEGER NOT NULL DEFAULT 1,
+    status_message_id INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    worker_id TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+"""
+
+# Владелец аренды задач этого процесса
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Задача может быть взята: ожидает воркера или ее процесс перестал продлевать аренду
+# (lease_until IS NULL - задачи, начатые до появления аренды)
+_CLAIMABLE = "(status = 'pending' OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?)))"
+
+
+def _connect() -> sqlite3.Connection:
+    connection = sqlite3.connect(JOB_DB_FILE, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    return connection
+
+
+def _init_db() -> int:
+    """Создает таблицу и возвращает количество прерванных задач с истекшей арендой
+
+    Задачи других процессов с действующей арендой не трогаются: старый
+    процесс может еще выполнять их во время остановки.
+    """
+    with closing(_connect()) as connection:
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.executescript(_SCHEMA)
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+        # База, созданная до появления аренды
+        for column in ("worker_id TEXT", "lease_until REAL"):
+            if column.split()[0] not in columns:
+                connection.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+        return connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)",
+            (time.time(),)
+        ).fetchone()[0]
+
+
+def _insert_job(chat_id: int, user_id: int, model_key: str, prompt: str,
+                variants: int, status_message_id: int) -> int:
+    now = time.time()
+    with closing(_connect()) as connection:
+        cursor = connection.execute(
+            "INSERT INTO jobs (chat_id, user_id, model_key, prompt, variants, status_message_id, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, user_id, model_key, prompt, variants, status_message_id, now, now)
+        )
+        return cursor.lastrowid
+
+
+def _claim_job() -> dict | None:
+    """Атомарно забирает самую старую задачу из очереди и арендует ее"""
+    now = time.time()
+    with closing(_connect()) as connection:
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute(
+            f"SELECT * FROM jobs WHERE {_CLAIMABLE} ORDER BY id LIMIT 1", (now,)
+        ).fetchone()
+        if row is None:
+            connection.execute("COMMIT")
+            return None
+        connection.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker_id = ?, lease_until = ?, "
+            "updated_at = ? WHERE id = ?",
+            (WORKER_ID, now + JOB_LEASE_SECONDS, now, row["id"])
+        )
+        connection.execute("COMMIT")
+        job = dict(row)
+        job["status"] = "running"
+        job["attempts"] += 1
+        return job
+
+
+def _count_pending() -> int:
+    with closing(_connect()) as connection:
+        return connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+
+
+async def pending_job_count() -> int:
+    """Количество задач, ожидающих воркера"""
+    return await asyncio.to_thread(_count_pending)
+
+
+def _cancel_pending(user_id: int, status_message_id: int = None) -> list[dict]:
+    """Отменяет задачи пользователя, еще не взятые воркером"""
+    query = (
+        "UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE user_id = ? AND status = 'pending'"
+    )
+    params = [time.time(), user_id]
+    if status_message_id is not None:
+        query += " AND status_message_id = ?"
+        params.append(status_message_id)
+    with closing(_connect()) as connection:
+        rows = connection.execute(
+            query + " RETURNING id, chat_id, model_key, variants, status_message_id", params
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+async def cancel_pending_jobs(user_id: int, status_message_id: int = None) -> list[dict]:
+    """Отменяет ожидающие задачи пользователя и возвращает за них лимит
+
+    Выполняющиеся задачи отменяются через cancellation.cancel_operations.
+    """
+    jobs = await asyncio.to_thread(_cancel_pending, user_id, status_message_id)
+    for job in jobs:
+        await refund_limit(user_id, job["model_key"], job["variants"])
+        logger.info(f"Задача {job['id']} отменена пользователем")
+    return jobs
+
+
+def _renew_lease(job_id: int) -> bool:
+    """Продлевает аренду задачи; False - задачу уже забрал другой процесс"""
+    now = time.time()
+    with closing(_connect()) as connection:
+        cursor = connection.execute(
+            "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (now + JOB_LEASE_SECONDS, now, job_id, WORKER_ID)
+        )
+        return cursor.rowcount > 0
+
+
+def _release_jobs() -> int:
+    """Возвращает в очередь незавершенные задачи этого процесса (при остановке)"""
+    with closing(_connect()) as connection:
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'pending', worker_id = NULL, lease_until = NULL, updated_at = ? "
+            "WHERE worker_id = ? AND status = 'running'",
+            (time.time(), WORKER_ID)
+        )
+        return cursor.rowcount
+
+
+def _finish_job(job_id: int, status: str, error: str = None) -> bool:
+    """Завершает задачу, если она еще арендована этим процессом"""
+    with closing(_connect()) as connection:
+        cursor = connection.execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ? "
+            "WHERE id = ? AND worker_id = ? AND status = 'running'",
+            (status, error, time.time(), job_id, WORKER_ID)
+        )
+        return cursor.rowcount > 0
+
+
+async def deliver_image(chat_id: int, image_bytes: bytes, caption: str):
+    """Отправляет сгенерированное изображение с перекодированием"""
+    photo_bytes, filename = await transcode_image(image_bytes)
+    image_file = BufferedInputFile(file=photo_bytes, filename=filename)
+
+    reply_markup = None
+    if IMAGE_OFFER_ORIGINAL and photo_bytes is not image_bytes:
+        reply_markup = get_original_keyboard(remember_original(image_bytes))
+
+    await outbound.call(
+        chat_id,
+        lambda: outbound.bot.send_photo(chat_id, photo=image_file, caption=caption, reply_markup=reply_markup)
+    )
+
+
+async def deliver_variants(chat_id: int, images: list[bytes], caption: str):
+    """Отправляет несколько изображений одним альбомом"""
+    if len(images) == 1:
+        await deliver_image(chat_id, images[0], caption)
+        return
+
+    transcoded = await asyncio.gather(*(transcode_image(image_bytes) for image_bytes in images))
+    media = [
+        InputMediaPhoto(
+            media=BufferedInputFile(file=photo_bytes, filename=filename),
+            caption=caption if i == 0 else None
+        )
+        for i, (photo_bytes, filename) in enumerate(transcoded)
+    ]
+    await outbound.call(chat_id, lambda: outbound.bot.send_media_group(chat_id, media=media))
+
+
+def progress_reporter(chat_id: int, status_message_id: int | None, what: str = "изображение"):
+    """Возвращает progress() для generate_image: обновляет сообщение со статусом
+
+    Варианты опрашиваются параллельно - сообщение меняется не чаще
+    раза в IMAGE_PROGRESS_INTERVAL секунд на всю генерацию.
+    """
+    if not status_message_id:
+        return None
+    started = time.monotonic()
+    last_update = started
+
+    async def progress():
+        nonlocal last_update
+        now = time.monotonic()
+        if now - last_update < IMAGE_PROGRESS_INTERVAL:
+            return
+        last_update = now
+        await outbound.edit_message(
+            chat_id, status_message_id,
+            f"🎨 Генерирую {what}, подождите... ⏱ {now - started:.0f} сек.",
+            reply_markup=get_cancel_keyboard()
+        )
+
+    return progress
+
+
+async def enqueue_image_job(chat_id: int, user_id: int, model_key: str, prompt: str,
+                            variants: int = 1, status_message_id: int = None) -> int:
+    """Ставит генерацию изображения в очередь
+
+    Лимит за задачу должен быть списан заранее; при неудаче воркер
+    возвращает его через refund_limit.
+    """
+    job_id = await asyncio.to_thread(
+        _insert_job, chat_id, user_id, model_key, prompt, variants, status_message_id
+    )
+    logger.info(f"Задача {job_id} поставлена в очередь: {model_key} x{variants}")
+    job_pool.wake()
+    return job_id
+
+
+class JobWorkerPool:
+    """Пул асинхронных воркеров, выполняющих задачи из очереди"""
+
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self.tasks = []
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+
+    def wake(self):
+        self.wakeup.set()
+
+    async def start(self):
+        self.stopping = False
+        resumed = await asyncio.to_thread(_init_db)
+        if resumed:
+            logger.info(f"Будут возобновлены прерванные задачи: {resumed}")
+        self.tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self, timeout: float = 0):
+        """Останавливает воркеры
+
+        Новые задачи больше не забираются; начатые получают timeout секунд
+        на завершение. Прерванные задачи возвращаются в очередь - их сразу
+        может забрать новый процесс, не дожидаясь истечения аренды.
+        """
+        self.stopping = True
+        self.wake()
+        if self.tasks and timeout > 0:
+            _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+            if pending:
+                logger.warning(f"Задачи не успели завершиться и будут возобновлены после перезапуска: {len(pending)}")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        released = await asyncio.to_thread(_release_jobs)
+        if released:
+            logger.info(f"Возвращено в очередь незавершенных задач: {released}")
+
+    async def _worker(self, number: int):
+        while not self.stopping:
+            self.wakeup.clear()
+            try:
+                job = await asyncio.to_thread(_claim_job)
+            except Exception as e:
+                logger.error(f"Воркер {number}: ошибка чтения очереди: {e}")
+                job = None
+
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._run_leased(job)
+
+    async def _run_leased(self, job: dict):
+        """Выполняет задачу, продлевая ее аренду
+
+        Если аренду продлить не удалось (процесс надолго завис, и задачу
+        забрал другой), выполнение прерывается: результат доставит тот процесс.
+        """
+        run_task = asyncio.create_task(self._run(job))
+        try:
+            while True:
+                done, _ = await asyncio.wait({run_task}, timeout=JOB_LEASE_SECONDS / 3)
+                if done:
+                    return run_task.result()
+                try:
+                    renewed = await asyncio.to_thread(_renew_lease, job["id"])
+                except Exception as e:
+                    logger.error(f"Задача {job['id']}: не удалось продлить аренду: {e}")
+                    continue
+                if not renewed:
+                    logger.warning(f"Задача {job['id']}: аренда потеряна, задачу выполняет другой процесс")
+                    run_task.cancel()
+                    await asyncio.gather(run_task, return_exceptions=True)
+                    return
+        except asyncio.CancelledError:
+            run_task.cancel()
+            await asyncio.gather(run_task, return_exceptions=True)
+            raise
+
+    async def _run(self, job: dict):
+        """Выполняет задачу и доставляет результат в чат"""
+        chat_id, user_id, model_key = job["chat_id"], job["user_id"], job["model_key"]
+        count = job["variants"]
+        logger.info(f"Задача {job['id']}: выполняю (попытка {job['attempts']})")
+
+        if job["attempts"] > JOB_MAX_ATTEMPTS:
+            # Задача несколько раз прерывалась перезапуском - не повторяем бесконечно
+            await self._fail(job, Exception("Задача прервана перезапуском бота"))
+            return
+
+        started = time.monotonic()
+        try:
+            variants = await run_cancellable(
+                self._generate(job), user_id, chat_id, job["status_message_id"]
+            )
+        except asyncio.CancelledError:
+            # Остановка процесса - задача останется running и будет возобновлена
+            raise
+        except OperationCancelled:
+            # Сообщение со статусом уже изменил обработчик отмены
+            logger.info(f"Задача {job['id']}: отменена пользователем")
+            if await asyncio.to_thread(_finish_job, job["id"], "cancelled"):
+                await refund_limit(user_id, model_key, count)
+            return
+        except Exception as e:
+            logger.error(f"Задача {job['id']}: ошибка генерации: {e}")
+            usage_log.record(user_id, model_key, time.monotonic() - started, ok=False, units=0)
+            await self._fail(job, e)
+            return
+
+        usage_log.record(
+            user_id, model_key, time.monotonic() - started,
+            size=sum(len(image_bytes) for image_bytes, _ in variants), units=len(variants)
+        )
+
+        # Возвращаем лимит за неудавшиеся варианты
+        if len(variants) < count:
+            await refund_limit(user_id, model_key, count - len(variants))
+
+        record = await load_user_record(user_id)
+        remaining = remaining_limit(record, model_key) if record else 0
+        request_info = variants[0][1]
+
+        if count > 1:
+            caption = f"✨ Готово! Вариантов: {len(variants)}\n\nМодель: {request_info['model']}\n\n📊 Осталось: {remaining}"
+        else:
+            caption = f"✨ Готово!\n\nМодель: {request_info['model']}\n\n📊 Осталось: {remaining}"
+            if request_info["request_id"] != "N/A":
+                caption += f"\n🔑 ID: {request_info['request_id']}"
+
+        try:
+            await deliver_variants(chat_id, [image_bytes for image_bytes, _ in variants], caption)
+            if job["status_message_id"]:
+                await outbound.delete_message(chat_id, job["status_message_id"])
+        except Exception as e:
+            logger.error(f"Задача {job['id']}: ошибка доставки: {e}")
+
+        await asyncio.to_thread(_finish_job, job["id"], "done")
+
+    async def _generate(self, job: dict) -> list:
+        what = f"{job['variants']} варианта(ов)" if job["variants"] > 1 else "изображение"
+        progress = progress_reporter(job["chat_id"], job["status_message_id"], what)
+        if job["variants"] > 1:
+            return await generate_image_variants(job["prompt"], job["model_key"], job["variants"], progress=progress)
+        return [await generate_image(job["prompt"], job["model_key"], progress=progress)]
+
+    async def _fail(self, job: dict, error: Exception):
+        """Завершает задачу с ошибкой, возвращает лимит и сообщает пользователю"""
+        if not await asyncio.to_thread(_finish_job, job["id"], "failed", str(error)):
+            # Задачу уже выполнил или выполняет другой процесс - лимит не возвращаем
+            logger.warning(f"Задача {job['id']}: аренда потеряна, ошибка не учитывается")
+            return
+        await refund_limit(job["user_id"], job["model_key"], job["variants"])
+
+        text = (
+            f"❌ Произошла ошибка при генерации изображения:\n{str(error)}\n\n"
+            "Попробуйте ещё раз или измените описание."
+        )
+        try:
+            if job["status_message_id"]:
+                await outbound.edit_message(job["chat_id"], job["status_message_id"], text)
+            else:
+                await outbound.send_message(job["chat_id"], text)
+        except Exception as e:
+            logger.error(f"Задача {job['id']}: не удалось сообщить об ошибке: {e}")
+
+
+job_pool = JobWorkerPool()
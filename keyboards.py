@@ -56,3 +56,19 @@ def get_premium_keyboard() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="💬 Связаться с админом", url="https://t.me/korzina_dar")],
     ])
     return keyboard
+
+
+def get_original_keyboard(original_key: str) -> InlineKeyboardMarkup:
+    """Создает кнопку для получения оригинального изображения файлом"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📎 Оригинал PNG", callback_data=f"original_{original_key}")],
+    ])
+    return keyboard
+
+
+def get_cancel_keyboard() -> InlineKeyboardMarkup:
+    """Создает кнопку отмены генерации под сообщением со статусом"""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✖️ Отмена", callback_data="cancel", style="danger")],
+    ])
+    return keyboard
@@ -0,0 +1,78 @@
+"""Плавная остановка бота: учет обрабатываемых updates и ожидание их завершения"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Задачи, обрабатывающие updates прямо сейчас
+_inflight = set()
+_draining = False
+# Последний полученный update (для подтверждения offset при остановке polling)
+_last_update_id = None
+
+
+def is_draining() -> bool:
+    """Бот останавливается и не принимает новые updates"""
+    return _draining
+
+
+def begin_drain():
+    """Переводит бота в режим остановки (health check начинает отвечать 503)"""
+    global _draining
+    _draining = True
+
+
+def inflight_count() -> int:
+    return len(_inflight)
+
+
+async def track_updates(handler, event, data):
+    """Outer middleware: регистрирует задачу обработки каждого update
+
+    Updates, уже полученные до остановки, обрабатываются до конца:
+    новые перестают приходить, когда останавливается polling или webhook сервер.
+    """
+    global _last_update_id
+    if _last_update_id is None or event.update_id > _last_update_id:
+        _last_update_id = event.update_id
+
+    task = asyncio.current_task()
+    _inflight.add(task)
+    try:
+        return await handler(event, data)
+    finally:
+        _inflight.discard(task)
+
+
+async def drain(deadline: float) -> int:
+    """Ждет завершения обрабатываемых updates до deadline (time.monotonic)
+
+    Не успевшие завершиться задачи отменяются. Возвращает их количество.
+    """
+    pending = {task for task in _inflight if task is not asyncio.current_task()}
+    if not pending:
+        return 0
+
+    logger.info(f"Жду завершения обработки updates: {len(pending)}")
+    _, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()))
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+        logger.warning(f"Не успели завершиться и отменены: {len(pending)}")
+    return len(pending)
+
+
+async def confirm_updates(bot):
+    """Подтверждает Telegram полученные updates (режим polling)
+
+    Иначе последняя пачка updates, уже обработанная этим процессом,
+    придет повторно следующему процессу.
+    """
+    if _last_update_id is None:
+        return
+    try:
+        await bot.get_updates(offset=_last_update_id + 1, limit=1, timeout=0)
+    except Exception as e:
+        logger.error(f"Не удалось подтвердить updates: {e}")
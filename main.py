@@ -1,31 +1,242 @@
 """Главный файл запуска бота"""
+import time
+
+# Время старта процесса - для замера длительности запуска
+_process_started = time.perf_counter()
+
 import asyncio
 import logging
+import signal
+import subprocess
+import sys
+from contextlib import suppress
 from aiogram import Bot, Dispatcher
 
-from config import BOT_TOKEN
+from config import (
+    BOT_TOKEN, SHUTDOWN_TIMEOUT, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT
+)
 from handlers import router, setup_bot_commands
+from blob_store import run_cleanup_loop
+from ai_generator import run_probe_loop, close_http_clients
+from sender import outbound
+from job_queue import job_pool
+from offload import lag_monitor, shutdown_pools
+from promo import init_promo_db
+from user_manager import hold_storage, migrate_user_data, recover_user_data, run_snapshot_loop, snapshot_all
+from usage_log import usage_log
+from lifecycle import track_updates, begin_drain, is_draining, inflight_count, drain, confirm_updates
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Инициализация бота
-bot = Bot(token=BOT_TOKEN)
+_imports_done = time.perf_counter()
+_first_update_seen = False
+
+
+async def log_first_update(handler, event, data):
+    """Пишет в лог, через сколько после старта процесса пришел первый update"""
+    global _first_update_seen
+    if not _first_update_seen:
+        _first_update_seen = True
+        logger.info(f"Первый update через {time.perf_counter() - _process_started:.2f} сек. после запуска")
+    return await handler(event, data)
+
+
+async def set_commands_in_background(bot: Bot):
+    """Установка команд не должна задерживать начало polling"""
+    try:
+        await setup_bot_commands(bot)
+    except Exception as e:
+        logger.error(f"Не удалось установить команды бота: {e}")
+
+
+def install_signal_handlers(stop_event: asyncio.Event):
+    """SIGTERM/SIGINT запускают плавную остановку"""
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        # На Windows обработчики сигналов не поддерживаются - Ctrl+C завершит процесс сразу
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop_event.set)
+
+
+async def run_polling(dp: Dispatcher, bot: Bot, stop_event: asyncio.Event):
+    """Polling до сигнала остановки"""
+    # Webhook мог остаться от запуска в режиме webhook - с ним polling не работает
+    await bot.delete_webhook(drop_pending_updates=False)
+
+    polling_task = asyncio.create_task(
+        dp.start_polling(bot, handle_signals=False, close_bot_session=False)
+    )
+    stop_task = asyncio.create_task(stop_event.wait())
+    await asyncio.wait({polling_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+
+    # Перестаем получать новые updates; уже полученные обрабатываются дальше
+    if not polling_task.done():
+        await dp.stop_polling()
+    stop_task.cancel()
+    await polling_task
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, stop_event: asyncio.Event):
+    """Webhook сервер до сигнала остановки
+
+    Новый процесс при запуске сам перенаправляет webhook на себя, поэтому
+    старый процесс при остановке webhook не удаляет: процессы могут
+    работать одновременно, пока старый дорабатывает начатые генерации.
+    """
+    from aiohttp import web
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+    async def health(request):
+        # Во время остановки балансировщик перестает слать сюда трафик
+        if is_draining():
+            return web.json_response({"status": "draining", "inflight": inflight_count()}, status=503)
+        return web.json_response({"status": "ok", "inflight": inflight_count()})
+
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+    app.router.add_get("/health", health)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"Webhook: {WEBHOOK_URL}{WEBHOOK_PATH}, порт {WEBAPP_PORT}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        begin_drain()
+        # Закрываем сервер: новые updates Telegram доставит новому процессу
+        await runner.cleanup()
+
+
+async def shutdown(bot: Bot, background_tasks: list, deadline: float):
+    """Плавная остановка: дожидаемся начатой работы и сохраняем состояние"""
+    begin_drain()
+    logger.info(f"Остановка: обрабатывается updates {inflight_count()}, ждем до {SHUTDOWN_TIMEOUT:.0f} сек.")
+
+    for task in background_tasks:
+        task.cancel()
+
+    # Начатые генерации и задачи очереди дорабатывают параллельно до общего дедлайна
+    await asyncio.gather(
+        drain(deadline),
+        job_pool.stop(timeout=max(0.0, deadline - time.monotonic())),
+    )
+
+    if not WEBHOOK_URL:
+        await confirm_updates(bot)
+
+    await usage_log.flush()
+    # Дожидаемся записей данных пользователей, отправленных в пулы
+    await asyncio.to_thread(shutdown_pools, True)
+    # Журналы - в снимки: следующий запуск не будет их дочитывать
+    await asyncio.to_thread(snapshot_all)
+    await close_http_clients()
+    await bot.session.close()
+    logger.info("Бот остановлен")
 
 
 async def main():
     """Главная функция запуска бота"""
+    logger.info(f"Импорт модулей: {_imports_done - _process_started:.2f} сек.")
+
+    # Инициализация бота
+    bot = Bot(token=BOT_TOKEN)
+    # Исходящие сообщения идут через общий планировщик с лимитами Telegram
+    outbound.bind(bot)
+
     dp = Dispatcher()
+    dp.update.outer_middleware(log_first_update)
+    # Учет обрабатываемых updates для плавной остановки
+    dp.update.outer_middleware(track_updates)
     dp.include_router(router)
-    
-    # Устанавливаем команды при запуске
-    await setup_bot_commands(bot)
-    
-    logger.info("Бот запущен!")
-    
-    await dp.start_polling(bot)
+
+    stop_event = asyncio.Event()
+    install_signal_handlers(stop_event)
+
+    # Команды устанавливаются параллельно с запуском polling
+    commands_task = asyncio.create_task(set_commands_in_background(bot))
+    # Фоновая очистка устаревших загруженных фото
+    cleanup_task = asyncio.create_task(run_cleanup_loop())
+    # Фоновые пробные запросы для маршрутизации текстовых моделей
+    probe_task = asyncio.create_task(run_probe_loop())
+    # Метрики задержки event loop (предупреждение в лог при долгой блокировке)
+    lag_task = asyncio.create_task(lag_monitor.run())
+    # База промокодов (при первом запуске переносит коды из user_data.json)
+    await asyncio.to_thread(init_promo_db)
+    # Хранилище пользователей занято, пока бот работает (решардинг откажется запускаться)
+    await asyncio.to_thread(hold_storage)
+    # Единый user_data.json - в шарды (записи переводятся в компактный вид)
+    migrated = await asyncio.to_thread(migrate_user_data)
+    if migrated:
+        logger.info(f"Записей пользователей перенесено в шарды: {migrated}")
+    # Снимки шардов и хвосты журналов изменений - в память
+    replayed = await asyncio.to_thread(recover_user_data)
+    if replayed:
+        logger.info(f"Данные пользователей: применено записей журнала: {replayed}")
+    snapshot_task = asyncio.create_task(run_snapshot_loop())
+    # Журнал использования: агрегаты и дочитывание хвоста журнала
+    await usage_log.start()
+    usage_task = asyncio.create_task(usage_log.run_flush_loop())
+    # Воркеры очереди генерации изображений (возобновляют прерванные задачи) -
+    # только после переноса и восстановления данных пользователей: задача
+    # может вернуть лимит или прочитать запись пользователя
+    await job_pool.start()
+
+    logger.info(f"Бот запущен за {time.perf_counter() - _process_started:.2f} сек.")
+
+    try:
+        if WEBHOOK_URL:
+            await run_webhook(dp, bot, stop_event)
+        else:
+            await run_polling(dp, bot, stop_event)
+    finally:
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        await shutdown(bot, [commands_task, cleanup_task, probe_task, lag_task, usage_task, snapshot_task], deadline)
+
+
+def profile_startup(top: int = 20):
+    """Отчет о времени импорта модулей при запуске (python main.py --profile-startup)
+
+    Запускает импорт main в отдельном процессе с -X importtime и выводит
+    самые долгие модули по суммарному времени (вместе с зависимостями).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True, text=True
+    )
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.strip()))
+
+    total = next((cumulative for cumulative, _, name in rows if name == "main"), None)
+    if total is None:
+        print(result.stderr)
+        return
+
+    print(f"Импорт при запуске: {total / 1000:.0f} мс\n")
+    print(f"{'суммарно, мс':>14} {'сам, мс':>9}  модуль")
+    for cumulative, self_time, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative / 1000:>14.1f} {self_time / 1000:>9.1f}  {name}")
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if "--profile-startup" in sys.argv:
+        profile_startup()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,187 @@
+"""Вынос CPU-тяжелой работы из event loop и метрики задержки цикла"""
+import asyncio
+import logging
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from config import (
+    OFFLOAD_THREAD_WORKERS, OFFLOAD_PROCESS_WORKERS, OFFLOAD_PROCESS_THRESHOLD,
+    LOOP_LAG_INTERVAL, LOOP_LAG_WARN
+)
+
+logger = logging.getLogger(__name__)
+
+_thread_pool = None
+_process_pool = None
+
+# Сколько задач ушло в каждый пул и сколько они выполнялись
+_offload_stats = {
+    "thread": {"calls": 0, "seconds": 0.0},
+    "process": {"calls": 0, "seconds": 0.0},
+}
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    """Создает пул потоков при первом использовании"""
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=OFFLOAD_THREAD_WORKERS, thread_name_prefix="offload")
+    return _thread_pool
+
+
+def _get_process_pool() -> ProcessPoolExecutor:
+    """Создает пул процессов при первом использовании
+
+    Не fork: к этому моменту в процессе работают потоки (пулы, to_thread),
+    и дочерний процесс мог бы унаследовать захваченную блокировку
+    (например, logging) и зависнуть. forkserver запускает воркеры
+    из чистого процесса, spawn - там, где forkserver нет (Windows).
+    """
+    global _process_pool
+    if _process_pool is None:
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        _process_pool = ProcessPoolExecutor(
+            max_workers=OFFLOAD_PROCESS_WORKERS, mp_context=multiprocessing.get_context(method)
+        )
+    return _process_pool
+
+
+async def run_offloaded(func, *args, size: int = 0):
+    """Выполняет func(*args) вне event loop
+
+    Большие данные (size >= OFFLOAD_PROCESS_THRESHOLD байт) обрабатываются
+    в пуле процессов: json и base64 держат GIL, и в потоке они все равно
+    тормозили бы event loop. Мелкие задачи идут в пул потоков - для них
+    передача данных в другой процесс дороже самой работы.
+    func и аргументы для пула процессов должны сериализоваться pickle
+    (функции уровня модуля).
+    """
+    global _process_pool
+    loop = asyncio.get_running_loop()
+    use_process = OFFLOAD_PROCESS_WORKERS > 0 and size >= OFFLOAD_PROCESS_THRESHOLD
+    kind = "process" if use_process else "thread"
+
+    start = time.perf_counter()
+    try:
+        if use_process:
+            try:
+                return await loop.run_in_executor(_get_process_pool(), func, *args)
+            except BrokenProcessPool:
+                # Процесс-воркер упал - пересоздаем пул и выполняем в потоке
+                logger.error("Пул процессов сломан, пересоздаю; задача выполняется в потоке")
+                _process_pool = None
+                kind = "thread"
+        return await loop.run_in_executor(_get_thread_pool(), func, *args)
+    finally:
+        _offload_stats[kind]["calls"] += 1
+        _offload_stats[kind]["seconds"] += time.perf_counter() - start
+
+
+def offload_stats() -> dict:
+    """Статистика вынесенных задач по пулам"""
+    return {kind: dict(stats) for kind, stats in _offload_stats.items()}
+
+
+def shutdown_pools(wait: bool = False):
+    """Останавливает пулы (при завершении бота)
+
+    wait=True дожидается уже отправленных задач (например, записи файла данных).
+    """
+    global _thread_pool, _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=wait, cancel_futures=not wait)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=wait, cancel_futures=not wait)
+        _thread_pool = None
+
+
+class LoopLagMonitor:
+    """Измеряет задержку event loop
+
+    Каждые interval секунд засыпает и смотрит, насколько позже
+    запланированного проснулся. Большая задержка значит, что какой-то
+    код надолго занял цикл и обработка updates стоит.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, window: int = 600):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+
+    def record(self, lag: float):
+        self.samples.append(lag)
+        self.max_lag = max(self.max_lag, lag)
+
+    def stats(self) -> dict:
+        """Задержка цикла за последнее окно, секунд"""
+        if not self.samples:
+            return {"samples": 0, "p50": 0.0, "p99": 0.0, "max": 0.0, "max_total": self.max_lag}
+        ordered = sorted(self.samples)
+        return {
+            "samples": len(ordered),
+            "p50": ordered[len(ordered) // 2],
+            "p99": ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))],
+            "max": ordered[-1],
+            "max_total": self.max_lag,
+        }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.record(lag)
+            if lag > LOOP_LAG_WARN:
+                logger.warning(f"Event loop был занят {lag * 1000:.0f} мс")
+
+
+lag_monitor = LoopLagMonitor()
+
+
+if __name__ == "__main__":
+    # Бенчмарк: python offload.py
+    # Пачка декодирований base64 размером с ответ API (~8 МБ) прямо в цикле
+    # и через run_offloaded; сравнивается задержка event loop
+    import base64
+    import os
+
+    payload = base64.b64encode(os.urandom(6 * 1024 * 1024)).decode()
+
+    async def burst(offloaded: bool) -> dict:
+        monitor = LoopLagMonitor(interval=0.01)
+        monitor_task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.05)
+
+        async def decode():
+            if offloaded:
+                await run_offloaded(base64.b64decode, payload, size=len(payload))
+            else:
+                base64.b64decode(payload)
+                await asyncio.sleep(0)
+
+        started = time.perf_counter()
+        for _ in range(4):
+            await asyncio.gather(*(decode() for _ in range(4)))
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(0.05)
+        monitor_task.cancel()
+        return {"elapsed": elapsed, **monitor.stats()}
+
+    async def bench():
+        # Прогрев пулов, чтобы не мерить запуск процессов
+        await run_offloaded(base64.b64decode, payload, size=len(payload))
+        for offloaded in (False, True):
+            result = await burst(offloaded)
+            name = "run_offloaded" if offloaded else "в event loop"
+            print(
+                f"{name}: {result['elapsed'] * 1000:.0f} мс на 16 декодирований, "
+                f"задержка цикла p99 {result['p99'] * 1000:.1f} мс, max {result['max'] * 1000:.1f} мс"
+            )
+        shutdown_pools()
+
+    asyncio.run(bench())
@@ -0,0 +1,278 @@
+"""Промокоды: хранилище SQLite, активация и админский CLI
+
+CLI:
+    python promo.py generate --tier basic --count 10000 [--prefix BASIC] [--output codes.txt]
+    python promo.py import codes.txt [--tier basic]
+    python promo.py stats
+    python promo.py bench [--count 1000000] [--redeems 10000]
+"""
+import argparse
+import logging
+import secrets
+import sqlite3
+import sys
+import time
+from contextlib import closing
+
+from config import PROMO_DB_FILE, PREMIUM_TIERS
+from user_manager import load_user_data, save_user_data
+
+logger = logging.getLogger(__name__)
+
+# Без похожих символов (0/O, 1/I/L), чтобы код легко переписать вручную
+CODE_ALPHABET = "ABCDEFGHJKMNPQRSTUVWXYZ23456789"
+CODE_LENGTH = 10
+# Размер пачки при массовой вставке
+BATCH_SIZE = 10000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS promocodes (
+    code TEXT PRIMARY KEY,
+    tier TEXT NOT NULL,
+    used_by INTEGER,
+    used_at REAL,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class PromoError(Exception):
+    """Промокод не найден или уже использован (текст - для пользователя)"""
+
+
+def _connect(db_file=None) -> sqlite3.Connection:
+    connection = sqlite3.connect(db_file or PROMO_DB_FILE, timeout=30, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+def init_promo_db(db_file=None) -> int:
+    """Создает таблицу и переносит промокоды из файла данных пользователей
+
+    Возвращает количество перенесенных промокодов.
+    """
+    with closing(_connect(db_file)) as connection:
+        connection.executescript(_SCHEMA)
+
+    data = load_user_data()
+    legacy = data.get("promocodes")
+    if not legacy:
+        return 0
+
+    now = time.time()
+    # У старых использованных кодов used_by может не быть - отмечаем пользователем 0
+    rows = (
+        (code.upper(), promo["tier"], promo.get("used_by", 0) if promo.get("used") else None,
+         now if promo.get("used") else None, now)
+        for code, promo in legacy.items()
+    )
+    with closing(_connect(db_file)) as connection:
+        connection.execute("BEGIN")
+        connection.executemany(
+            "INSERT OR IGNORE INTO promocodes (code, tier, used_by, used_at, created_at) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        connection.execute("COMMIT")
+
+    # Промокоды больше не хранятся в файле пользователей
+    data["promocodes"] = {}
+    save_user_data(data)
+    logger.info(f"Промокоды перенесены в {PROMO_DB_FILE}: {len(legacy)}")
+    return len(legacy)
+
+
+def redeem_promocode(code: str, user_id: int, db_file=None) -> str:
+    """Атомарно активирует одноразовый промокод и возвращает его пакет
+
+    Отметка об использовании - один UPDATE по первичному ключу с условием
+    used_by IS NULL, поэтому одновременная активация одного кода
+    двумя пользователями невозможна.
+    """
+    code = code.upper()
+    with closing(_connect(db_file)) as connection:
+        row = connection.execute(
+            "UPDATE promocodes SET used_by = ?, used_at = ? WHERE code = ? AND used_by IS NULL RETURNING tier",
+            (user_id, time.time(), code)
+        ).fetchone()
+        if row is not None:
+            return row[0]
+
+        exists = connection.execute("SELECT 1 FROM promocodes WHERE code = ?", (code,)).fetchone()
+
+    if exists:
+        raise PromoError("❌ Этот промокод уже использован!")
+    raise PromoError("❌ Промокод не найден!")
+
+
+def _new_code(prefix: str) -> str:
+    return prefix + "".join(secrets.choice(CODE_ALPHABET) for _ in range(CODE_LENGTH))
+
+
+def insert_codes(codes, db_file=None, on_added=None) -> int:
+    """Вставляет пары (code, tier) пачками по BATCH_SIZE в одной транзакции
+
+    codes может быть генератором - в памяти держится одна пачка.
+    Уже существующие коды пропускаются; on_added(code) вызывается для
+    каждого добавленного. Возвращает количество добавленных кодов.
+    """
+    added = 0
+    batch = []
+    with closing(_connect(db_file)) as connection:
+        connection.executescript(_SCHEMA)
+
+        def flush():
+            nonlocal added
+            now = time.time()
+            connection.execute("BEGIN")
+            for code, tier in batch:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO promocodes (code, tier, created_at) VALUES (?, ?, ?)",
+                    (code, tier, now)
+                )
+                if cursor.rowcount:
+                    added += 1
+                    if on_added:
+                        on_added(code)
+            connection.execute("COMMIT")
+            batch.clear()
+
+        for item in codes:
+            batch.append(item)
+            if len(batch) >= BATCH_SIZE:
+                flush()
+        if batch:
+            flush()
+    return added
+
+
+def generate_codes(tier: str, count: int, prefix: str = ""):
+    """Генерирует count новых кодов пакета (генератор пар code, tier)"""
+    for _ in range(count):
+        yield _new_code(prefix), tier
+
+
+def promo_stats(db_file=None) -> dict:
+    """Количество кодов по пакетам: {tier: {"total": n, "used": n}}"""
+    with closing(_connect(db_file)) as connection:
+        connection.executescript(_SCHEMA)
+        rows = connection.execute(
+            "SELECT tier, COUNT(*), COUNT(used_by) FROM promocodes GROUP BY tier"
+        ).fetchall()
+    return {tier: {"total": total, "used": used} for tier, total, used in rows}
+
+
+def _cmd_generate(args):
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    prefix = args.prefix.upper() if args.prefix else ""
+
+    def write(code):
+        # Коды выводятся пачками после записи в базу, список целиком в памяти не хранится
+        output.write(code + "\n")
+
+    try:
+        added = insert_codes(generate_codes(args.tier, args.count, prefix), on_added=write)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"Добавлено промокодов {args.tier}: {added}", file=sys.stderr)
+
+
+def _cmd_import(args):
+    def parsed():
+        # Строка файла: "КОД" (пакет из --tier) или "КОД,пакет"
+        with open(args.file, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                code, _, tier = line.partition(",")
+                tier = tier.strip() or args.tier
+                if tier not in PREMIUM_TIERS:
+                    print(f"Строка {line_number}: неизвестный пакет '{tier}', пропускаю", file=sys.stderr)
+                    continue
+                yield code.strip().upper(), tier
+
+    added = insert_codes(parsed())
+    print(f"Импортировано промокодов: {added}", file=sys.stderr)
+
+
+def _cmd_stats(args):
+    for tier, stats in sorted(promo_stats().items()):
+        print(f"{tier}: всего {stats['total']}, использовано {stats['used']}")
+
+
+def _cmd_bench(args):
+    """Задержка активации на базе с args.count кодами (во временном файле)"""
+    import os
+    import random
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "promo_bench.db")
+        codes = []
+
+        def sampled():
+            # Запоминаем только коды, которые потом будем активировать
+            step = max(1, args.count // args.redeems)
+            for i, (code, tier) in enumerate(generate_codes("basic", args.count)):
+                if i % step == 0 and len(codes) < args.redeems:
+                    codes.append(code)
+                yield code, tier
+
+        started = time.perf_counter()
+        insert_codes(sampled(), db_file=db_file)
+        print(f"Генерация и вставка {args.count} кодов: {time.perf_counter() - started:.1f} сек.")
+        print(f"Размер базы: {os.path.getsize(db_file) / 1024 / 1024:.1f} МБ")
+
+        random.shuffle(codes)
+        latencies = []
+        for code in codes:
+            started = time.perf_counter()
+            redeem_promocode(code, 1, db_file=db_file)
+            latencies.append(time.perf_counter() - started)
+
+        # Повторная активация должна завершаться ошибкой
+        try:
+            redeem_promocode(codes[0], 2, db_file=db_file)
+            raise AssertionError("Код активирован дважды")
+        except PromoError:
+            pass
+
+        latencies.sort()
+        print(f"Активаций: {len(latencies)}")
+        print(f"p50: {latencies[len(latencies) // 2] * 1000:.3f} мс")
+        print(f"p99: {latencies[int(len(latencies) * 0.99)] * 1000:.3f} мс")
+        print(f"max: {latencies[-1] * 1000:.3f} мс")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Управление промокодами")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="Сгенерировать коды пакета")
+    generate.add_argument("--tier", required=True, choices=list(PREMIUM_TIERS))
+    generate.add_argument("--count", type=int, required=True)
+    generate.add_argument("--prefix", default="")
+    generate.add_argument("--output", help="Файл для списка кодов (по умолчанию stdout)")
+    generate.set_defaults(func=_cmd_generate)
+
+    import_ = commands.add_parser("import", help="Импортировать коды из файла")
+    import_.add_argument("file")
+    import_.add_argument("--tier", choices=list(PREMIUM_TIERS), help="Пакет для строк без пакета")
+    import_.set_defaults(func=_cmd_import)
+
+    stats = commands.add_parser("stats", help="Статистика по пакетам")
+    stats.set_defaults(func=_cmd_stats)
+
+    bench = commands.add_parser("bench", help="Замер задержки активации")
+    bench.add_argument("--count", type=int, default=1000000)
+    bench.add_argument("--redeems", type=int, default=10000)
+    bench.set_defaults(func=_cmd_bench)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
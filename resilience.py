@@ -0,0 +1,180 @@
+"""Повторные попытки и circuit breaker для запросов к внешним API"""
+import asyncio
+import logging
+import random
+import time
+
+from config import (
+    RETRY_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT, BREAKER_HALF_OPEN_PROBES
+)
+
+logger = logging.getLogger(__name__)
+
+# HTTP статусы, при которых запрос можно безопасно повторить
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_caller_error(status: int | None) -> bool:
+    """Ошибка в самом запросе (4xx, кроме 408 и 429) - сервис при этом исправен"""
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+class UpstreamError(Exception):
+    """Ошибка внешнего API с HTTP статусом"""
+
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRYABLE_STATUSES
+
+    @property
+    def upstream_failure(self) -> bool:
+        """Ошибка на стороне сервиса - учитывается circuit breaker"""
+        return not is_caller_error(self.status)
+
+
+class CircuitOpenError(Exception):
+    """Запрос отклонен: сервис временно считается недоступным"""
+
+    def __init__(self, key: str, retry_in: float):
+        super().__init__(
+            f"Сервис временно недоступен, попробуйте через {max(1, int(retry_in))} сек."
+        )
+        self.key = key
+        self.retry_in = retry_in
+
+
+def parse_retry_after(value) -> float | None:
+    """Разбирает заголовок Retry-After (только секунды)"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Circuit breaker для одного эндпоинта
+
+    closed - запросы идут как обычно;
+    open - запросы сразу отклоняются до истечения reset_timeout;
+    half_open - пропускается ограниченное число пробных запросов.
+    """
+
+    def __init__(self, key: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT,
+                 half_open_probes: int = BREAKER_HALF_OPEN_PROBES):
+        self.key = key
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+
+    def before_call(self):
+        """Проверяет, можно ли выполнить запрос; иначе CircuitOpenError"""
+        if self.state == "open":
+            elapsed = time.monotonic() - self.opened_at
+            if elapsed < self.reset_timeout:
+                raise CircuitOpenError(self.key, self.reset_timeout - elapsed)
+            self.state = "half_open"
+            self.probes_in_flight = 0
+            logger.info(f"Circuit breaker {self.key}: half-open, пробный запрос")
+
+        if self.state == "half_open":
+            if self.probes_in_flight >= self.half_open_probes:
+                raise CircuitOpenError(self.key, 1)
+            self.probes_in_flight += 1
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info(f"Circuit breaker {self.key}: закрыт")
+        self.state = "closed"
+        self.failures = 0
+        self.probes_in_flight = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"Circuit breaker {self.key}: открыт после {self.failures} ошибок")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probes_in_flight = 0
+
+    def release_probe(self):
+        """Освобождает слот пробного запроса, если ответ не повлиял на состояние"""
+        if self.state == "half_open" and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
+
+
+# Circuit breaker для каждого эндпоинта
+_breakers = {}
+
+
+def get_breaker(key: str) -> CircuitBreaker:
+    """Возвращает circuit breaker для эндпоинта"""
+    if key not in _breakers:
+        _breakers[key] = CircuitBreaker(key)
+    return _breakers[key]
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Экспоненциальная задержка с полным jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def call_with_retry(func, key: str, classify, attempts: int = RETRY_ATTEMPTS):
+    """Выполняет запрос с повторами и circuit breaker
+
+    func - корутинная функция без аргументов, выполняющая один запрос.
+    classify(error) возвращает (retryable, retry_after, upstream_failure):
+    можно ли повторить запрос, сколько ждать по заголовку Retry-After
+    и виноват ли в ошибке сервис. Ошибки сервиса учитываются circuit
+    breaker, даже если их нельзя повторить (таймаут): иначе зависший
+    эндпоинт никогда не открыл бы breaker. Ошибки в самом запросе
+    (например, 400) на состояние breaker не влияют.
+    """
+    breaker = get_breaker(key)
+
+    for attempt in range(attempts):
+        breaker.before_call()
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            retryable, retry_after, upstream_failure = classify(e)
+            if not retryable:
+                if upstream_failure:
+                    breaker.record_failure()
+                else:
+                    breaker.release_probe()
+                raise
+
+            breaker.record_failure()
+            if attempt == attempts - 1 or breaker.state == "open":
+                raise
+
+            delay = max(backoff_delay(attempt), retry_after or 0)
+            if delay > RETRY_MAX_DELAY:
+                # Сервер просит ждать дольше, чем мы готовы - сдаемся сразу
+                raise
+
+            logger.warning(
+                f"Ошибка запроса к {key} (попытка {attempt + 1}/{attempts}): {e}. "
+                f"Повтор через {delay:.1f} сек."
+            )
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
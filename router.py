@@ -0,0 +1,103 @@
+"""Выбор upstream модели по живой задержке и доле ошибок"""
+import logging
+
+from config import ROUTER_EWMA_ALPHA, ROUTER_ERROR_PENALTY
+from resilience import get_breaker
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamStats:
+    """Экспоненциально сглаженные задержки и доля ошибок одного upstream
+
+    Задержки пробных запросов (max_tokens=1) и обычных ответов хранятся
+    отдельно: ответ в тысячи токенов в разы дольше пробы, и общее среднее
+    сравнивало бы размер запросов, а не скорость upstream. Для обычных
+    ответов хранится задержка на токен ответа.
+    """
+
+    def __init__(self):
+        self.probe_latency = None
+        self.token_latency = None
+        self.error_rate = 0.0
+        self.samples = 0
+
+    def record(self, latency: float, ok: bool, alpha: float, tokens: int = None, probe: bool = False):
+        self.samples += 1
+        if ok:
+            if probe:
+                self.probe_latency = _ewma(self.probe_latency, latency, alpha)
+            elif tokens:
+                self.token_latency = _ewma(self.token_latency, latency / tokens, alpha)
+        self.error_rate = alpha * (0.0 if ok else 1.0) + (1 - alpha) * self.error_rate
+
+
+def _ewma(current: float | None, sample: float, alpha: float) -> float:
+    return sample if current is None else alpha * sample + (1 - alpha) * current
+
+
+# Метрики задержки в порядке предпочтения для ранжирования: пробы одинакового
+# размера у всех кандидатов обновляются регулярно, задержка на токен - только
+# у upstream, которые получают трафик
+_LATENCY_METRICS = ("probe_latency", "token_latency")
+
+
+class ModelRouter:
+    """Ранжирует кандидатов: меньше задержка и ошибок - выше в списке"""
+
+    def __init__(self, alpha: float = ROUTER_EWMA_ALPHA, error_penalty: float = ROUTER_ERROR_PENALTY):
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.stats = {}
+
+    def record(self, upstream: str, latency: float, ok: bool, tokens: int = None, probe: bool = False):
+        """Учитывает результат запроса к upstream
+
+        tokens - число токенов ответа (для обычных запросов), probe - пробный запрос.
+        """
+        if upstream not in self.stats:
+            self.stats[upstream] = UpstreamStats()
+        self.stats[upstream].record(latency, ok, self.alpha, tokens, probe)
+
+    def _metric(self, upstreams: list[str]) -> str:
+        """Метрика, которая есть у всех кандидатов - сравниваются только одинаковые замеры"""
+        for metric in _LATENCY_METRICS:
+            if all(getattr(self.stats.get(upstream), metric, None) is not None for upstream in upstreams):
+                return metric
+        return _LATENCY_METRICS[0]
+
+    def score(self, upstream: str, metric: str = _LATENCY_METRICS[0]) -> float:
+        """Оценка upstream по метрике задержки (меньше - лучше)"""
+        stats = self.stats.get(upstream)
+        latency = getattr(stats, metric, None)
+        if latency is None:
+            # Нет данных - после известных кандидатов, статистику соберет пробник
+            return float("inf")
+        return latency * (1 + self.error_penalty * stats.error_rate)
+
+    def rank(self, upstreams: list[str]) -> list[str]:
+        """Сортирует кандидатов; эндпоинты с открытым circuit breaker - в конце"""
+        metric = self._metric(upstreams)
+
+        def key(item):
+            index, upstream = item
+            unavailable = get_breaker(upstream).state == "open"
+            # При равных оценках сохраняем порядок из конфига
+            return unavailable, self.score(upstream, metric), index
+
+        return [upstream for _, upstream in sorted(enumerate(upstreams), key=key)]
+
+    def snapshot(self) -> dict:
+        """Текущая статистика для логов и админских команд"""
+        return {
+            upstream: {
+                "probe_latency": stats.probe_latency,
+                "token_latency": stats.token_latency,
+                "error_rate": stats.error_rate,
+                "samples": stats.samples,
+            }
+            for upstream, stats in self.stats.items()
+        }
+
+
+model_router = ModelRouter()
@@ -0,0 +1,228 @@
+"""Очистка ответов LLM: удаление <think> блоков и markdown разметки"""
+import html
+import re
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+# Правила очистки markdown. Отдельные шаблоны с литеральным началом
+# (**, ##, |, \n) ищутся быстрее, чем одно выражение с альтернативами
+# и якорем ^: движок re не может пропускать позиции без кандидатов
+_HEADER_RE = re.compile(r"##+ ")
+_TABLE_SEPARATOR_RE = re.compile(r"\|\s*-+\s*\|")
+# Ведущий "|" строки; начало блока обрабатывается отдельно через \A
+_LEADING_PIPE_RE = re.compile(r"\n\s*\|\s*")
+_FIRST_PIPE_RE = re.compile(r"\A\s*\|\s*")
+# Символы, которые очистка может удалить (** и ##), и пробельные вокруг них
+_MARKUP_CHARS = "*#"
+_TRANSPARENT_CHARS = _MARKUP_CHARS + " \t\n\r\f\v"
+
+# HTML режим: жирный текст и заголовки превращаются в <b>
+_BOLD_RE = re.compile(r"\*\*([^\n]+?)\*\*")
+_HEADER_LINE_RE = re.compile(r"^##+ ([^\n]*)", re.MULTILINE)
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """Длина окончания text, которое может быть началом тега"""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+class OutputSanitizer:
+    """Потоковая очистка ответа LLM
+
+    Текст подается кусками через feed(), который возвращает уже очищенную
+    часть; finish() возвращает остаток. Теги <think> и markdown маркеры,
+    разрезанные границей куска, обрабатываются корректно: разметка
+    применяется к целым строкам, неполная строка ждет следующего куска.
+    При html=True текст экранируется для parse_mode="HTML", а ** и
+    заголовки превращаются в <b> вместо удаления.
+    """
+
+    def __init__(self, html_mode: bool = False):
+        self.html_mode = html_mode
+        self._raw = ""
+        self._visible = ""
+        self._in_think = False
+        # Текст открытого <think>: если блок так и не закроется, он не теряется
+        self._think = ""
+        self._started = False
+        self._held_whitespace = ""
+
+    def _filter_think(self, final: bool = False):
+        """Переносит текст вне <think> блоков из _raw в _visible"""
+        raw = self._raw
+        while raw:
+            if self._in_think:
+                end = raw.find(THINK_CLOSE)
+                if end == -1:
+                    # В raw остается только возможное начало закрывающего тега
+                    hold = 0 if final else _partial_tag_length(raw, THINK_CLOSE)
+                    self._think += raw[:len(raw) - hold]
+                    raw = raw[len(raw) - hold:]
+                    break
+                self._think = ""
+                raw = raw[end + len(THINK_CLOSE):]
+                self._in_think = False
+                continue
+
+            start = raw.find(THINK_OPEN)
+            if start == -1:
+                hold = 0 if final else _partial_tag_length(raw, THINK_OPEN)
+                self._visible += raw[:len(raw) - hold]
+                raw = raw[len(raw) - hold:]
+                break
+            self._visible += raw[:start]
+            raw = raw[start + len(THINK_OPEN):]
+            self._in_think = True
+        self._raw = raw
+        if final and self._in_think:
+            # <think> не закрыт (ответ оборван по max_tokens) - отдаем текст
+            # после тега, иначе от ответа ничего не осталось бы
+            self._visible += self._think
+            self._think = ""
+
+    def _render(self, text: str) -> str:
+        """Применяет правила очистки к блоку целых строк"""
+        if self.html_mode:
+            text = html.escape(text, quote=False)
+            if "**" in text:
+                text = _BOLD_RE.sub(r"<b>\1</b>", text)
+            if "## " in text:
+                text = _HEADER_LINE_RE.sub(r"<b>\1</b>", text)
+
+        # Пропускаем проходы, маркеров которых в блоке нет
+        if "**" in text:
+            text = text.replace("**", "")
+        if "## " in text:
+            text = _HEADER_RE.sub("", text)
+        if "|" in text:
+            text = _TABLE_SEPARATOR_RE.sub("", text)
+            text = _LEADING_PIPE_RE.sub("\n", _FIRST_PIPE_RE.sub("", text))
+        return text
+
+    def _emit(self, text: str) -> str:
+        """Убирает пробелы в начале и в конце всего ответа (как strip())"""
+        if not self._started:
+            text = text.lstrip()
+            if not text:
+                return ""
+            self._started = True
+
+        stripped = text.rstrip()
+        if not stripped:
+            self._held_whitespace += text
+            return ""
+
+        output = self._held_whitespace + stripped
+        self._held_whitespace = text[len(stripped):]
+        return output
+
+    @staticmethod
+    def _block_end(text: str) -> int:
+        """Конец блока, который можно очистить независимо от продолжения текста
+
+        Граница - начало строки, за которой уже пришел символ, не меняющийся
+        при очистке: \s* в правилах для "|" захватывает переводы строк, и
+        серия пустых строк (в том числе ставших пустыми после удаления ** и
+        заголовков), разрезанная границей, очищалась бы иначе, чем целый текст.
+        Перед "|" такая серия должна содержать один перевод строки, а "|" и "-"
+        не должны продолжать "|" или разделитель таблицы с предыдущей строки.
+        """
+        cut = text.rfind("\n", 0, len(text) - 1) + 1
+        while cut:
+            char = text[cut]
+            if not char.isspace() and char not in _MARKUP_CHARS:
+                before = text[:cut - 1].rstrip(_TRANSPARENT_CHARS)
+                safe = True
+                if char in "|-":
+                    safe = not before.endswith(("|", "-"))
+                    if char == "|":
+                        safe = safe and "\n" not in text[len(before):cut - 1]
+                if safe:
+                    return cut
+            cut = text.rfind("\n", 0, cut - 1) + 1
+        return 0
+
+    def feed(self, chunk: str) -> str:
+        """Добавляет кусок ответа и возвращает очищенный текст целых строк"""
+        self._raw += chunk
+        self._filter_think()
+
+        cut = self._block_end(self._visible)
+        if not cut:
+            return ""
+        lines, self._visible = self._visible[:cut], self._visible[cut:]
+        return self._emit(self._render(lines))
+
+    def finish(self) -> str:
+        """Возвращает остаток ответа; текст незакрытого <think> сохраняется"""
+        self._filter_think(final=True)
+        rest, self._visible = self._visible, ""
+        return self._emit(self._render(rest)) if rest else ""
+
+
+def sanitize(text: str, html_mode: bool = False) -> str:
+    """Очищает полный ответ LLM"""
+    sanitizer = OutputSanitizer(html_mode)
+    return sanitizer.feed(text) + sanitizer.finish()
+
+
+def _legacy_sanitize(text: str) -> str:
+    """Прежняя цепочка re.sub (для сравнения в бенчмарке)"""
+    text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
+    text = re.sub(r'\*\*', '', text)
+    text = re.sub(r'##+ ', '', text)
+    text = re.sub(r'\|\s*-+\s*\|', '', text)
+    text = re.sub(r'^\s*\|\s*', '', text, flags=re.MULTILINE)
+    return text
+
+
+if __name__ == "__main__":
+    # Бенчмарк: python sanitizer.py
+    import timeit
+
+    block = (
+        "## Заголовок раздела\n"
+        "Обычный текст с **жирным** словом и еще немного текста для объема.\n"
+        "| Колонка | Значение |\n"
+        "|---|---|\n"
+        "| a | 1 |\n\n"
+    )
+    answer = "<think>" + "рассуждения модели " * 500 + "</think>\n\n" + block * 2000
+
+    assert sanitize(answer) == _legacy_sanitize(answer)
+
+    chunked = OutputSanitizer()
+    streamed = "".join(chunked.feed(answer[i:i + 7]) for i in range(0, len(answer), 7)) + chunked.finish()
+    assert streamed == _legacy_sanitize(answer)
+
+    # Свойство: результат не зависит от того, как ответ разрезан на куски
+    import random
+
+    pieces = ["a", "b", " ", "\n", "\n\n", "|", "-", "**", "## ", "#", "<think>", "</think>", "<th", "ink>", "<", ">", "\t"]
+    rng = random.Random(0)
+    for _ in range(20000):
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 30)))
+        for html_mode in (False, True):
+            whole = sanitize(text, html_mode)
+            chunked = OutputSanitizer(html_mode)
+            position, streamed = 0, ""
+            while position < len(text):
+                size = rng.randint(1, 5)
+                streamed += chunked.feed(text[position:position + size])
+                position += size
+            streamed += chunked.finish()
+            assert streamed == whole, (text, streamed, whole)
+    assert sanitize("a\n\n|a#\n\n\n") == "a\na#"
+    assert sanitize("<think>ответ, оборванный по max_tokens") == "ответ, оборванный по max_tokens"
+    print("Потоковая очистка совпадает с очисткой целого текста")
+
+    runs = 20
+    legacy = timeit.timeit(lambda: _legacy_sanitize(answer), number=runs) / runs
+    single = timeit.timeit(lambda: sanitize(answer), number=runs) / runs
+    print(f"Размер ответа: {len(answer)} символов")
+    print(f"Цепочка re.sub: {legacy * 1000:.2f} мс")
+    print(f"OutputSanitizer: {single * 1000:.2f} мс ({legacy / single:.2f}x)")
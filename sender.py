@@ -0,0 +1,160 @@
+"""Очередь исходящих сообщений с ограничением частоты для Telegram"""
+import asyncio
+import logging
+import re
+import time
+
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import (
+    SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_GROUP_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+# Конец предложения - граница для разбиения длинного текста
+_SENTENCE_END_RE = re.compile(r"[.!?…](?:\s)")
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def idle(self) -> bool:
+        """Бакет полон - его можно удалить без потери информации"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        """Ждет, пока появится токен, и забирает его"""
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+def split_message(text: str, limit: int = MESSAGE_LIMIT) -> list[str]:
+    """Разбивает текст на части не длиннее limit
+
+    Предпочитает границы абзацев, затем строк, предложений и слов.
+    """
+    chunks = []
+    while len(text) > limit:
+        window = text[:limit]
+        cut = window.rfind("\n\n")
+        if cut < limit // 2:
+            cut = window.rfind("\n")
+        if cut < limit // 2:
+            sentence_ends = [match.end() for match in _SENTENCE_END_RE.finditer(window)]
+            cut = sentence_ends[-1] if sentence_ends else -1
+        if cut < limit // 2:
+            cut = window.rfind(" ")
+        if cut <= 0:
+            cut = limit
+
+        chunk = text[:cut].rstrip()
+        if chunk:
+            chunks.append(chunk)
+        text = text[cut:].lstrip()
+
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+class MessageSender:
+    """Отправка сообщений через общий планировщик
+
+    Каждый вызов Bot API ждет токен глобального бакета (лимит Telegram на
+    бота) и бакета чата (лимит на чат, для групп строже). При TelegramRetryAfter
+    запрос повторяется после указанной паузы.
+    """
+
+    def __init__(self, bot=None):
+        self.bot = bot
+        self.global_bucket = TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self.chat_buckets = {}
+
+    def bind(self, bot):
+        """Привязывает экземпляр Bot (вызывается при запуске)"""
+        self.bot = bot
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            if len(self.chat_buckets) > 10000:
+                # Убираем бакеты неактивных чатов
+                self.chat_buckets = {
+                    key: bucket for key, bucket in self.chat_buckets.items() if not bucket.idle
+                }
+            rate = SEND_GROUP_RATE if chat_id < 0 else SEND_CHAT_RATE
+            self.chat_buckets[chat_id] = TokenBucket(rate, SEND_CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    async def call(self, chat_id: int, request, per_chat: bool = True):
+        """Выполняет запрос к Bot API с учетом лимитов
+
+        request - функция без аргументов, возвращающая корутину запроса
+        (повторный вызов создает новый запрос).
+        """
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            if per_chat:
+                await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await request()
+            except TelegramRetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                logger.warning(f"Flood wait для чата {chat_id}: жду {e.retry_after} сек.")
+                await asyncio.sleep(e.retry_after)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        """Отправляет одно сообщение"""
+        return await self.call(chat_id, lambda: self.bot.send_message(chat_id, text, **kwargs))
+
+    async def send_text(self, chat_id: int, text: str, footer: str = None, **kwargs) -> list:
+        """Отправляет длинный текст частями
+
+        footer (например, остаток запросов) добавляется в последнюю часть,
+        если помещается, чтобы не тратить отдельное сообщение.
+        """
+        chunks = split_message(text)
+        if footer:
+            if chunks and len(chunks[-1]) + len(footer) + 2 <= MESSAGE_LIMIT:
+                chunks[-1] = f"{chunks[-1]}\n\n{footer}"
+            else:
+                chunks.append(footer)
+
+        return [await self.send_message(chat_id, chunk, **kwargs) for chunk in chunks]
+
+    async def edit_message(self, chat_id: int, message_id: int, text: str, **kwargs):
+        """Изменяет текст сообщения (статус генерации)"""
+        return await self.call(
+            chat_id, lambda: self.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id, **kwargs)
+        )
+
+    async def delete_message(self, chat_id: int, message_id: int):
+        """Удаляет сообщение (не расходует лимит чата на отправку)"""
+        return await self.call(
+            chat_id, lambda: self.bot.delete_message(chat_id, message_id), per_chat=False
+        )
+
+
+outbound = MessageSender()
@@ -0,0 +1,196 @@
+"""Журнал использования моделей и агрегаты по дням
+
+Каждая завершенная генерация - одно событие в append-only журнале
+(JSON строка в сегменте за день). Агрегаты по дню и модели обновляются
+по мере записи событий в журнал и сохраняются вместе с позицией
+в журнале, поэтому после перезапуска дочитывается только хвост
+журнала, а не вся история.
+
+Журнал могут писать несколько процессов бота: запись событий и
+обновление агрегатов идут под файловой блокировкой (usage.lock), и
+агрегаты каждый раз пересчитываются из сохраненных на диске с
+дочитыванием журнала - события других процессов не теряются.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from config import USAGE_LOG_DIR, USAGE_FLUSH_INTERVAL
+from user_manager import file_lock
+
+logger = logging.getLogger(__name__)
+
+ROLLUPS_FILE = "rollups.json"
+LOCK_FILE = "usage.lock"
+
+# Поля агрегата одной модели за день
+_COUNTERS = ("requests", "errors", "units", "prompt_tokens", "completion_tokens", "latency_ms", "bytes")
+
+
+def _segment_name(timestamp: float) -> str:
+    return f"usage-{datetime.fromtimestamp(timestamp):%Y%m%d}.log"
+
+
+def _day(timestamp: float) -> str:
+    return f"{datetime.fromtimestamp(timestamp):%Y-%m-%d}"
+
+
+class UsageLog:
+    """Буфер событий, сегменты журнала и агрегаты"""
+
+    def __init__(self, directory=USAGE_LOG_DIR):
+        self.directory = directory
+        self.pending = []
+        # {day: {model_key: {counter: value}}}
+        self.rollups = {}
+        # Позиция в журнале, до которой события учтены в сохраненных агрегатах
+        self.checkpoint = {"segment": None, "offset": 0}
+        self.lock = asyncio.Lock()
+
+    @staticmethod
+    def _apply(rollups: dict, event: dict):
+        model = rollups.setdefault(_day(event["t"]), {}).setdefault(
+            event["m"], dict.fromkeys(_COUNTERS, 0)
+        )
+        model["requests"] += 1
+        model["errors"] += 0 if event["ok"] else 1
+        model["units"] += event.get("n", 1)
+        model["prompt_tokens"] += event.get("pt", 0)
+        model["completion_tokens"] += event.get("ct", 0)
+        model["latency_ms"] += event["ms"]
+        model["bytes"] += event.get("b", 0)
+
+    def record(self, user_id: int, model_key: str, latency: float, ok: bool = True,
+               prompt_tokens: int = 0, completion_tokens: int = 0, size: int = 0, units: int = 1):
+        """Добавляет событие; в журнал и агрегаты оно попадет при ближайшем сбросе"""
+        event = {"t": round(time.time(), 3), "u": user_id, "m": model_key, "ms": round(latency * 1000), "ok": int(ok)}
+        # Нулевые поля не пишем - событие остается компактным
+        if prompt_tokens:
+            event["pt"] = prompt_tokens
+        if completion_tokens:
+            event["ct"] = completion_tokens
+        if size:
+            event["b"] = size
+        if units != 1:
+            event["n"] = units
+        self.pending.append(event)
+
+    def day_stats(self, day: str = None) -> dict:
+        """Агрегаты за день по моделям (по умолчанию - сегодня)"""
+        return self.rollups.get(day or _day(time.time()), {})
+
+    # Работа с файлами - в потоке, вне event loop, под блокировкой usage.lock
+
+    def _load(self):
+        """Загружает агрегаты и дочитывает события после сохраненной позиции
+
+        Вызывается только под блокировкой: хвост журнала обрезается, и
+        другой процесс не должен в это время дописывать сегмент.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        rollups_path = self.directory / ROLLUPS_FILE
+        # Собираем в локальных переменных: /usage читает self.rollups из event loop
+        rollups, checkpoint = {}, {"segment": None, "offset": 0}
+        if rollups_path.exists():
+            with open(rollups_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            rollups, checkpoint = saved["rollups"], saved["checkpoint"]
+
+        replayed = 0
+        segments = sorted(path.name for path in self.directory.glob("usage-*.log"))
+        for name in segments:
+            if checkpoint["segment"] and name < checkpoint["segment"]:
+                continue
+            offset = checkpoint["offset"] if name == checkpoint["segment"] else 0
+            with open(self.directory / name, "r+b") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # Недописанная строка (процесс упал при записи)
+                        break
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Склеенная или поврежденная строка - дальше читать нельзя
+                        logger.error(f"Поврежденная строка в {name} на позиции {offset}, отбрасываю хвост")
+                        break
+                    self._apply(rollups, event)
+                    offset += len(line)
+                    replayed += 1
+                # Обрезаем хвост: иначе следующие события допишутся к недописанной строке
+                f.truncate(offset)
+            checkpoint = {"segment": name, "offset": offset}
+        self.rollups, self.checkpoint = rollups, checkpoint
+        return replayed
+
+    def _append(self, events: list):
+        """Дописывает события в сегменты журнала"""
+        by_segment = {}
+        for event in events:
+            by_segment.setdefault(_segment_name(event["t"]), []).append(event)
+
+        for name, segment_events in sorted(by_segment.items()):
+            data = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in segment_events)
+            with open(self.directory / name, "ab") as f:
+                f.write(data.encode("utf-8"))
+
+    def _save_rollups(self):
+        # Агрегаты маленькие (дни x модели) - переписываем файл целиком
+        text = json.dumps({"rollups": self.rollups, "checkpoint": self.checkpoint}, ensure_ascii=False)
+        rollups_path = self.directory / ROLLUPS_FILE
+        tmp_path = rollups_path.with_name(ROLLUPS_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, rollups_path)
+
+    def _lock(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        return file_lock(self.directory / LOCK_FILE)
+
+    def _sync(self, events: list) -> int:
+        """Дописывает события и пересчитывает агрегаты с учетом других процессов
+
+        Агрегаты берутся с диска, а не из памяти: там уже учтены события,
+        записанные другими процессами. Наши события дочитываются из журнала
+        вместе с чужими, поэтому ничего не учитывается дважды.
+        """
+        with self._lock():
+            if events:
+                self._append(events)
+            replayed = self._load()
+            if replayed:
+                self._save_rollups()
+        return replayed
+
+    async def start(self):
+        replayed = await asyncio.to_thread(self._sync, [])
+        if replayed:
+            logger.info(f"Журнал использования: дочитано событий после перезапуска: {replayed}")
+
+    async def flush(self):
+        """Записывает накопленные события в журнал и обновляет агрегаты
+
+        Порядок важен для восстановления: сначала события дописываются
+        в журнал, потом сохраняются агрегаты с новой позицией. Если процесс
+        упадет между этими шагами, события будут дочитаны из журнала.
+        Без своих событий сброс все равно подтягивает события других
+        процессов, чтобы /usage показывал общую картину.
+        """
+        async with self.lock:
+            events, self.pending = self.pending, []
+            try:
+                await asyncio.to_thread(self._sync, events)
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала использования (событий {len(events)}): {e}")
+
+    async def run_flush_loop(self):
+        """Фоновая задача: периодический сброс событий в журнал"""
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            await self.flush()
+
+
+usage_log = UsageLog()
@@ -0,0 +1,190 @@
+"""Контекст пользователя на время обработки одного update"""
+import logging
+from typing import Any, Awaitable, Callable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from user_manager import (
+    load_user_record, apply_user_changes, new_user_record,
+    tier_limits, remaining_limit, remaining_limits, MODEL_INDEX
+)
+
+logger = logging.getLogger(__name__)
+
+# Хранилище текущей модели для каждого пользователя
+user_models = {}
+# Пакеты пользователей, чьи записи уже загружались процессом: контроль
+# допуска работает до загрузки записи и берет пакет отсюда
+user_tiers = {}
+
+
+class UserContext:
+    """Запись пользователя, загруженная один раз за update
+
+    Запись загружается middleware в начале update (чтение файла идет вне
+    event loop). Изменения (лимиты, история, пакет) сразу видны через
+    контекст и накапливаются как операции, которые middleware записывает
+    одним сохранением в конце update. Запись нового пользователя создается
+    только вместе с первым изменением: /start и /help ее не сохраняют.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._record = None
+        self._new = False
+        self._changes = {
+            "create": False,
+            "tier": None,
+            "limit_deltas": {},
+            "history_ops": [],
+        }
+        self.dirty = False
+
+    async def load(self):
+        """Загружает запись пользователя"""
+        self._record = await load_user_record(self.user_id)
+        self._new = self._record is None
+        if self._new:
+            # Новый пользователь - бесплатный доступ (сохранится при первом изменении)
+            self._record = new_user_record()
+        user_tiers[self.user_id] = self.tier
+
+    def _changed(self):
+        """Отмечает изменение; для нового пользователя запись будет создана"""
+        if self._new:
+            self._changes["create"] = True
+        self.dirty = True
+
+    @property
+    def record(self) -> dict:
+        if self._record is None:
+            raise RuntimeError("Запись пользователя не загружена (нужен вызов load())")
+        return self._record
+
+    @property
+    def tier(self) -> str:
+        return self.record.get("tier", "free")
+
+    @property
+    def limits(self) -> dict:
+        """Остатки по моделям пакета (вычисляются от лимитов пакета)"""
+        return remaining_limits(self.record)
+
+    @property
+    def model_key(self) -> str:
+        """Выбранная пользователем модель"""
+        return user_models.get(self.user_id, "text")
+
+    @model_key.setter
+    def model_key(self, value: str):
+        user_models[self.user_id] = value
+
+    def remaining(self, model_key: str) -> int:
+        return remaining_limit(self.record, model_key)
+
+    def check_limit(self, model_key: str, amount: int = 1) -> bool:
+        """Проверяет, есть ли у пользователя лимит"""
+        return self.remaining(model_key) >= amount
+
+    def _change_limit(self, model_key: str, delta: int) -> bool:
+        """Меняет остаток на delta; False если модели нет в пакете"""
+        if model_key not in tier_limits(self.tier) or model_key not in MODEL_INDEX:
+            return False
+        self.record["used"][MODEL_INDEX[model_key]] -= delta
+        deltas = self._changes["limit_deltas"]
+        deltas[model_key] = deltas.get(model_key, 0) + delta
+        self._changed()
+        return True
+
+    def decrease_limit(self, model_key: str, amount: int = 1) -> bool:
+        """Уменьшает лимит пользователя"""
+        return self._change_limit(model_key, -amount)
+
+    def reserve_limit(self, model_key: str, amount: int) -> bool:
+        """Списывает сразу несколько запросов, если их хватает"""
+        if not self.check_limit(model_key, amount):
+            return False
+        return self._change_limit(model_key, -amount)
+
+    def refund_limit(self, model_key: str, amount: int):
+        """Возвращает списанные запросы"""
+        if amount > 0:
+            self._change_limit(model_key, amount)
+
+    def set_tier(self, tier: str):
+        """Назначает пакет (активация промокода): счетчики использования с нуля"""
+        self.record["tier"] = tier
+        self.record["used"] = [0] * len(MODEL_INDEX)
+        self._changes["tier"] = tier
+        # Списания до активации перекрываются новым пакетом
+        self._changes["limit_deltas"] = {}
+        user_tiers[self.user_id] = tier
+        self._changed()
+
+    def get_history(self, model_key: str) -> list:
+        """История сообщений для конкретной модели"""
+        return self.record.get("history", {}).get(model_key, [])
+
+    def add_to_history(self, model_key: str, user_message: str, assistant_message: str):
+        """Добавляет пару сообщений в историю (максимум 20 сообщений)"""
+        history = self.record.setdefault("history", {})
+        messages = history.setdefault(model_key, [])
+        messages.append({"role": "user", "content": user_message})
+        messages.append({"role": "assistant", "content": assistant_message})
+        if len(messages) > 20:
+            history[model_key] = messages[-20:]
+        self._changes["history_ops"].append(("append", model_key, user_message, assistant_message))
+        self._changed()
+
+    def clear_history(self, model_key: str = None):
+        """Очищает историю конкретной модели или всех моделей"""
+        if model_key:
+            self.record.setdefault("history", {})[model_key] = []
+        else:
+            self.record["history"] = {}
+        self._changes["history_ops"].append(("clear", model_key))
+        self._changed()
+
+    async def flush(self):
+        """Записывает накопленные изменения одним сохранением"""
+        if not self.dirty:
+            return
+        await apply_user_changes(self.user_id, self._changes)
+        self._changes = {
+            "create": False,
+            "tier": None,
+            "limit_deltas": {},
+            "history_ops": [],
+        }
+        self._new = False
+        self.dirty = False
+
+
+class UserContextMiddleware(BaseMiddleware):
+    """Передает обработчикам user_ctx и сохраняет изменения в конце update
+
+    Регистрируется после AdmissionMiddleware: отклоненный при перегрузке
+    update не читает хранилище.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: dict[str, Any]
+    ) -> Any:
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+
+        user_ctx = UserContext(user.id)
+        await user_ctx.load()
+        data["user_ctx"] = user_ctx
+        try:
+            return await handler(event, data)
+        finally:
+            try:
+                await user_ctx.flush()
+            except Exception as e:
+                logger.error(f"Ошибка при сохранении данных пользователя {user.id}: {e}")
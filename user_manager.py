@@ -1,126 +1,786 @@
-"""Управление данными пользователей"""
+"""Управление данными пользователей
+
+Пользователи хранятся в N шардах, шард выбирается по хэшу user_id. У каждого
+шарда своя блокировка, поэтому записи пользователей из разных шардов идут
+параллельно. Шард - это снимок (user_data/shard-NN.json) и журнал изменений
+(shard-NN.<поколение>.wal): изменение дописывается в журнал маленькой
+записью, а не переписывает файл. Процесс держит шард в памяти и при каждом
+обращении дочитывает хвост журнала; фоновая задача сворачивает большой
+журнал в новый снимок. Число шардов хранится в user_data/meta.json;
+изменить его можно только инструментом решардинга:
+    python user_manager.py reshard --shards 32
+
+Изменения шарда выполняются под межпроцессной файловой блокировкой,
+чтение - под разделяемой, поэтому хранилище могут делить несколько
+процессов бота на одном хосте. Проверка отсутствия потерянных изменений:
+    python user_manager.py stress --processes 8 --ops 200
+"""
+import argparse
+import asyncio
+import copy
 import json
-from config import USER_DATA_FILE, PREMIUM_TIERS
+import logging
+import os
+import shutil
+import threading
+import zlib
+from contextlib import ExitStack, contextmanager
+from config import (
+    USER_DATA_FILE, USER_DATA_DIR, USER_DATA_SHARDS, USER_JOURNAL_FSYNC,
+    USER_SNAPSHOT_INTERVAL, USER_SNAPSHOT_JOURNAL_SIZE, PREMIUM_TIERS, FREE_TIER_LIMITS, MODELS
+)
+from offload import run_offloaded
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+# Порядковый номер модели в векторе использованных запросов ("used").
+# Порядок берется из config.MODELS: новые модели добавляются только в конец
+MODEL_INDEX = {model_key: i for i, model_key in enumerate(MODELS)}
+
+META_FILE = "meta.json"
+# Разделяемая блокировка на все время работы процесса бота (решардинг ее проверяет)
+STORAGE_LOCK_FILE = "storage.lock"
+
+# Число шардов (читается из meta.json при первом обращении)
+_shard_count = None
+# Блокировки шардов для асинхронного кода: пока пачка изменений пишется
+# вне event loop, следующие изменения шарда копятся в _pending_changes
+_shard_locks = {}
+_pending_changes = {}
+# Шарды в памяти процесса и блокировки потоков, работающих с ними
+_shard_states = {}
+_thread_locks = {}
+# Открытый storage.lock процесса бота (hold_storage)
+_storage_lock = None
 
 
 def load_user_data():
-    """Загружает данные пользователей из файла"""
+    """Загружает данные из единого файла (формат до шардирования)"""
     if USER_DATA_FILE.exists():
         with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
             return json.load(f)
     return {"users": {}, "promocodes": {}}
 
 
-def save_user_data(data):
-    """Сохраняет данные пользователей в файл"""
-    with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
+def _write_json(path, data):
+    """Пишет во временный файл и подменяет: читатель не увидит файл наполовину записанным"""
+    # pid в имени: процессы не перетирают временные файлы друг друга
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
         json.dump(data, f, indent=2, ensure_ascii=False)
+        f.flush()
+        # Файл должен быть на диске до подмены: после снимка журнал удаляется
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def save_user_data(data):
+    """Сохраняет данные в единый файл (формат до шардирования)"""
+    _write_json(USER_DATA_FILE, data)
+
+
+def shard_count() -> int:
+    """Число шардов хранилища"""
+    global _shard_count
+    if _shard_count is None:
+        meta_path = USER_DATA_DIR / META_FILE
+        if meta_path.exists():
+            with open(meta_path, encoding='utf-8') as f:
+                _shard_count = json.load(f)["shards"]
+        else:
+            _shard_count = USER_DATA_SHARDS
+    return _shard_count
+
+
+def shard_of(user_id, shards: int = None) -> int:
+    """Номер шарда пользователя (crc32 стабилен между запусками, в отличие от hash())"""
+    return zlib.crc32(str(user_id).encode()) % (shards or shard_count())
+
+
+def _shard_path(index: int, directory=None):
+    return (directory or USER_DATA_DIR) / f"shard-{index:02d}.json"
+
+
+def _ensure_storage(directory=None, shards: int = None):
+    """Создает каталог шардов и meta.json"""
+    directory = directory or USER_DATA_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    meta_path = directory / META_FILE
+    if not meta_path.exists():
+        _write_json(meta_path, {"shards": shards or shard_count()})
+
+
+@contextmanager
+def file_lock(path, shared: bool = False):
+    """Межпроцессная advisory блокировка на файле path
+
+    shared=True - разделяемая блокировка для чтения: читатели не ждут друг
+    друга, но ждут эксклюзивную блокировку писателя. В msvcrt разделяемых
+    блокировок нет, там она эксклюзивная.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def shard_file_lock(index: int, shared: bool = False):
+    """Межпроцессная блокировка шарда (файл shard-NN.lock)
+
+    Эксклюзивная держится на время чтения-изменения-записи шарда, поэтому
+    несколько процессов бота и админские инструменты на одном хосте не
+    теряют изменения друг друга. Чтению достаточно разделяемой: она
+    только не дает читать журнал, пока его дописывают или сворачивают.
+    """
+    return file_lock(USER_DATA_DIR / f"shard-{index:02d}.lock", shared)
+
+
+def hold_storage():
+    """Отмечает хранилище занятым процессом бота до его завершения
+
+    Процессы бота держат разделяемую блокировку storage.lock и не мешают
+    друг другу, а решардинг берет ее эксклюзивно и при работающем боте
+    отказывается запускаться. Без fcntl (Windows) проверка не выполняется.
+    """
+    global _storage_lock
+    if fcntl is None or _storage_lock is not None:
+        return
+    path = USER_DATA_DIR / STORAGE_LOCK_FILE
+    while True:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        f = open(path, "a+b")
+        fcntl.flock(f, fcntl.LOCK_SH)
+        # Пока ждали, решардинг мог подменить каталог - блокировка осталась на старом
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                _storage_lock = f
+                return
+        except FileNotFoundError:
+            pass
+        f.close()
+
+
+@contextmanager
+def _exclusive_storage():
+    """Эксклюзивный доступ к хранилищу (решардинг); ошибка, если работает бот"""
+    path = USER_DATA_DIR / STORAGE_LOCK_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError("Хранилище используется запущенным ботом - остановите его перед решардингом")
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def update_shard(index: int, user_id_str: str, mutate, *args) -> bool:
+    """Изменяет запись пользователя под блокировками шарда
+
+    mutate(data, user_id_str, *args) смотрит на текущие данные шарда и
+    возвращает изменения для журнала (формат apply_user_changes) или None,
+    если менять нечего.
+    """
+    with _shard_guard(index) as state:
+        changes = mutate(state.data, user_id_str, *args)
+        if changes is None:
+            return False
+        _append(state, index, [(user_id_str, changes)])
+    return True
+
+
+def shard_lock(index: int) -> asyncio.Lock:
+    if index not in _shard_locks:
+        _shard_locks[index] = asyncio.Lock()
+    return _shard_locks[index]
+
+
+class _ShardState:
+    """Шард в памяти процесса: снимок и примененная часть журнала"""
+
+    def __init__(self, snapshot_id, gen: int, users: dict):
+        # Идентификатор файла снимка: по нему видно, что другой процесс сделал новый снимок
+        self.snapshot_id = snapshot_id
+        self.gen = gen
+        self.data = {"users": users}
+        # Позиция в журнале, до которой записи применены
+        self.offset = 0
+
+
+def _journal_path(index: int, gen: int):
+    return USER_DATA_DIR / f"shard-{index:02d}.{gen}.wal"
+
+
+def _snapshot_id(index: int):
+    try:
+        stat = _shard_path(index).stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
+
+
+def _read_snapshot(index: int) -> tuple[int, dict]:
+    """Снимок шарда: (поколение журнала, пользователи)"""
+    path = _shard_path(index)
+    if path.exists():
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        return snapshot.get("gen", 0), snapshot["users"]
+    return 0, {}
+
+
+def _replay(state: _ShardState, index: int, truncate: bool = True) -> int:
+    """Применяет записи журнала после state.offset; возвращает их количество
+
+    truncate=False - под разделяемой блокировкой: журнал не меняется.
+    """
+    journal = _journal_path(index, state.gen)
+    if not journal.exists():
+        return 0
+    replayed = 0
+    with open(journal, "r+b" if truncate else "rb") as f:
+        f.seek(state.offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            entry = json.loads(line)
+            _apply_changes(state.data, entry["u"], entry["c"])
+            state.offset += len(line)
+            replayed += 1
+        if truncate:
+            # Недописанная запись (процесс упал при записи) отбрасывается,
+            # иначе следующая запись склеилась бы с ней
+            f.truncate(state.offset)
+    return replayed
+
+
+def _current_state(index: int, truncate: bool = True) -> tuple[_ShardState, int]:
+    """Догоняет шард до конца журнала (под блокировками шарда)"""
+    state = _shard_states.get(index)
+    snapshot_id = _snapshot_id(index)
+    if state is None or state.snapshot_id != snapshot_id:
+        # Первое обращение или другой процесс свернул журнал в новый снимок
+        gen, users = _read_snapshot(index)
+        state = _shard_states[index] = _ShardState(snapshot_id, gen, users)
+    return state, _replay(state, index, truncate)
+
+
+@contextmanager
+def _shard_guard(index: int, shared: bool = False):
+    """Блокировки шарда (потоков процесса и межпроцессная) и его актуальное состояние
+
+    shared=True - только чтение: другие процессы тоже могут читать шард.
+    Блокировка потоков остается эксклюзивной - состояние шарда в памяти общее.
+    """
+    with _thread_locks.setdefault(index, threading.Lock()), shard_file_lock(index, shared):
+        state, _ = _current_state(index, truncate=not shared)
+        yield state
+
+
+def _append(state: _ShardState, index: int, entries: list):
+    """Дописывает изменения в журнал одной записью и применяет их в памяти
+
+    Один fsync на пачку: изменения, накопившиеся за время предыдущей
+    записи, подтверждаются вместе.
+    """
+    lines = "".join(
+        json.dumps({"u": user_id_str, "c": changes}, ensure_ascii=False, separators=(",", ":")) + "\n"
+        for user_id_str, changes in entries
+    ).encode("utf-8")
+    with open(_journal_path(index, state.gen), "ab") as f:
+        f.write(lines)
+        f.flush()
+        if USER_JOURNAL_FSYNC:
+            os.fsync(f.fileno())
+    for user_id_str, changes in entries:
+        _apply_changes(state.data, user_id_str, changes)
+    state.offset += len(lines)
+
+
+def load_shard(index: int) -> dict:
+    """Копия шарда: {"users": {user_id: запись}} (снимок и журнал)"""
+    with _shard_guard(index, shared=True) as state:
+        return copy.deepcopy(state.data)
+
+
+def save_shard(index: int, data: dict):
+    """Сохраняет снимок шарда (при переносе данных, журнала у шарда еще нет)"""
+    USER_DATA_DIR.mkdir(parents=True, exist_ok=True)
+    _write_json(_shard_path(index), data)
+
+
+def read_user(index: int, user_id_str: str) -> dict | None:
+    """Копия записи пользователя"""
+    with _shard_guard(index, shared=True) as state:
+        return copy.deepcopy(state.data["users"].get(user_id_str))
+
+
+def commit_changes(index: int, batch: list) -> int:
+    """Записывает пачку изменений [(user_id_str, changes)] одного шарда
+
+    Изменения несуществующих пользователей без "create" пропускаются.
+    Возвращает количество записанных изменений.
+    """
+    with _shard_guard(index) as state:
+        known = set(state.data["users"])
+        entries = []
+        for user_id_str, changes in batch:
+            if user_id_str in known or changes.get("create"):
+                entries.append((user_id_str, changes))
+                known.add(user_id_str)
+        if entries:
+            _append(state, index, entries)
+    return len(entries)
+
+
+def snapshot_shard(index: int, min_journal_size: int = 0) -> bool:
+    """Сворачивает журнал шарда в новый снимок
+
+    Порядок переживает сбой на любом шаге: пустой журнал следующего
+    поколения, затем снимок (атомарная подмена), затем удаление старого
+    журнала. Возвращает True, если снимок сделан.
+    """
+    with _shard_guard(index) as state:
+        if state.offset == 0 or state.offset < min_journal_size:
+            return False
+        old_journal = _journal_path(index, state.gen)
+        state.gen += 1
+        open(_journal_path(index, state.gen), "wb").close()
+        _write_json(_shard_path(index), {"gen": state.gen, "users": state.data["users"]})
+        old_journal.unlink(missing_ok=True)
+        state.snapshot_id = _snapshot_id(index)
+        state.offset = 0
+    return True
+
+
+def recover_user_data() -> int:
+    """Загружает снимки всех шардов и применяет хвосты журналов (при запуске)
+
+    Возвращает количество примененных записей журнала.
+    """
+    replayed = 0
+    for index in range(shard_count()):
+        with _thread_locks.setdefault(index, threading.Lock()), shard_file_lock(index):
+            _, count = _current_state(index)
+            replayed += count
+    return replayed
+
+
+def snapshot_all(min_journal_size: int = 0) -> int:
+    """Сворачивает журналы всех шардов; возвращает количество новых снимков"""
+    return sum(snapshot_shard(index, min_journal_size) for index in range(shard_count()))
+
+
+async def run_snapshot_loop():
+    """Фоновая задача: снимки шардов с журналом больше USER_SNAPSHOT_JOURNAL_SIZE"""
+    while True:
+        await asyncio.sleep(USER_SNAPSHOT_INTERVAL)
+        try:
+            await asyncio.to_thread(snapshot_all, USER_SNAPSHOT_JOURNAL_SIZE)
+        except Exception as e:
+            logger.error(f"Ошибка снимка данных пользователей: {e}")
+
+
+def tier_limits(tier: str) -> dict:
+    """Лимиты пакета из конфига (free - бесплатный доступ)"""
+    if tier in PREMIUM_TIERS:
+        return PREMIUM_TIERS[tier]["limits"]
+    return FREE_TIER_LIMITS
+
+
+def new_user_record() -> dict:
+    """Запись нового пользователя - бесплатный доступ
+
+    Запись хранит только ссылку на пакет и вектор использованных
+    запросов по моделям; остаток считается от лимитов пакета, поэтому
+    изменение PREMIUM_TIERS сразу действует для всех пользователей.
+    """
+    return {
+        "tier": "free",
+        "used": [0] * len(MODEL_INDEX)
+    }
+
+
+def compact_record(user: dict) -> bool:
+    """Переводит запись со старым словарем limits в компактный вид
+
+    Остаток сохраняется точно: used = лимит пакета - остаток (может быть
+    отрицательным, если пользователю вручную добавляли запросы).
+    Возвращает True, если запись изменилась.
+    """
+    changed = False
+    if "limits" in user:
+        limits = tier_limits(user.get("tier", "free"))
+        used = [0] * len(MODEL_INDEX)
+        for model_key, remaining in user.pop("limits").items():
+            if model_key in MODEL_INDEX:
+                used[MODEL_INDEX[model_key]] = limits.get(model_key, 0) - remaining
+        user["used"] = used
+        changed = True
+    elif len(user.get("used", [])) < len(MODEL_INDEX):
+        # В конфиг добавлены новые модели
+        user["used"] = user.get("used", []) + [0] * (len(MODEL_INDEX) - len(user.get("used", [])))
+        changed = True
+    return changed
+
+
+def remaining_limit(user: dict, model_key: str) -> int:
+    """Остаток запросов пользователя для модели"""
+    limit = tier_limits(user.get("tier", "free")).get(model_key, 0)
+    index = MODEL_INDEX.get(model_key)
+    if index is None or index >= len(user["used"]):
+        return limit
+    return limit - user["used"][index]
+
+
+def remaining_limits(user: dict) -> dict:
+    """Остатки по всем моделям пакета пользователя"""
+    return {model_key: remaining_limit(user, model_key) for model_key in tier_limits(user.get("tier", "free"))}
+
+
+def _spend(user: dict, model_key: str, amount: int) -> bool:
+    """Списывает (amount < 0 - возвращает) запросы; False если модели нет в пакете"""
+    if model_key not in tier_limits(user.get("tier", "free")) or model_key not in MODEL_INDEX:
+        return False
+    user["used"][MODEL_INDEX[model_key]] += amount
+    return True
+
+
+def migrate_user_data() -> int:
+    """Переносит единый user_data.json в шарды (при запуске бота)
+
+    Записи при этом переводятся в компактный вид. Исходный файл
+    переименовывается в user_data.json.migrated. Возвращает количество
+    перенесенных записей.
+    """
+    if (USER_DATA_DIR / META_FILE).exists():
+        return 0
+
+    # Несколько процессов бота могут запуститься одновременно - переносит один
+    with file_lock(USER_DATA_DIR / "migrate.lock"):
+        if (USER_DATA_DIR / META_FILE).exists():
+            return 0
+        if not USER_DATA_FILE.exists():
+            _ensure_storage()
+            return 0
+
+        data = load_user_data()
+        shards = [{"users": {}} for _ in range(shard_count())]
+        for user_id_str, user in data["users"].items():
+            compact_record(user)
+            shards[shard_of(user_id_str)]["users"][user_id_str] = user
+
+        for index, shard in enumerate(shards):
+            if shard["users"]:
+                save_shard(index, shard)
+        # meta.json пишется последним: без него при сбое перенос повторится
+        _ensure_storage()
+        os.replace(USER_DATA_FILE, USER_DATA_FILE.with_name(USER_DATA_FILE.name + ".migrated"))
+        return len(data["users"])
+
+
+def reshard(new_count: int):
+    """Перераспределяет пользователей по new_count шардам (бот должен быть остановлен)
+
+    Новые шарды собираются во временном каталоге, затем каталоги
+    меняются местами; старые данные остаются в user_data.old. При
+    работающем боте (storage.lock занят) - RuntimeError; блокировки
+    всех шардов держатся до замены каталога.
+    """
+    with _exclusive_storage(), ExitStack() as locks:
+        for index in range(shard_count()):
+            locks.enter_context(shard_file_lock(index))
+        _reshard_locked(new_count)
+
+
+def _reshard_locked(new_count: int):
+    global _shard_count
+    old_count = shard_count()
+    new_dir = USER_DATA_DIR.with_name(USER_DATA_DIR.name + ".new")
+    old_dir = USER_DATA_DIR.with_name(USER_DATA_DIR.name + ".old")
+    shutil.rmtree(new_dir, ignore_errors=True)
+    _ensure_storage(new_dir, new_count)
+
+    shards = [{"users": {}} for _ in range(new_count)]
+    moved = 0
+    for index in range(old_count):
+        # Блокировка шарда уже взята - состояние читается напрямую
+        with _thread_locks.setdefault(index, threading.Lock()):
+            state, _ = _current_state(index)
+        for user_id_str, user in state.data["users"].items():
+            shards[shard_of(user_id_str, new_count)]["users"][user_id_str] = user
+            moved += 1
+    for index, shard in enumerate(shards):
+        _write_json(_shard_path(index, new_dir), shard)
+
+    shutil.rmtree(old_dir, ignore_errors=True)
+    if USER_DATA_DIR.exists():
+        os.replace(USER_DATA_DIR, old_dir)
+    os.replace(new_dir, USER_DATA_DIR)
+    _shard_count = new_count
+    _shard_locks.clear()
+    _shard_states.clear()
+    print(f"Пользователей: {moved}, шардов: {old_count} -> {new_count}. Старые данные: {old_dir}")
 
 
 def get_user_limits(user_id: int):
     """Получает лимиты пользователя"""
-    data = load_user_data()
+    shard = shard_of(user_id)
     user_id_str = str(user_id)
-    
-    if user_id_str not in data["users"]:
+    user = read_user(shard, user_id_str)
+    if user is None:
         # Новый пользователь - бесплатный доступ
-        data["users"][user_id_str] = {
-            "tier": "free",
-            "limits": {
-                "text": 5,
-                "gemini": 3,
-                "deepseek": 2,
-                "claude": 2,
-                "claude_sonnet": 2,
-                "claude_haiku": 3,
-                "claude_opus": 1,
-                "qwen": 3,
-                "llama": 4,
-                "schnell": 2,
-                "dev": 0,
-                "kontext": 0
-            }
-        }
-        save_user_data(data)
+        update_shard(shard, user_id_str, _create_if_missing)
+        user = read_user(shard, user_id_str)
     
-    return data["users"][user_id_str]
+    compact_record(user)
+    return user
+
+
+def _create_if_missing(data: dict, user_id_str: str) -> dict | None:
+    return None if user_id_str in data["users"] else {"create": True}
+
+
+def _spend_stored(data: dict, user_id_str: str, model_key: str, amount: int, only_if_available: bool) -> dict | None:
+    user = data["users"].get(user_id_str)
+    if user is None or model_key not in tier_limits(user.get("tier", "free")) or model_key not in MODEL_INDEX:
+        return None
+    if only_if_available and remaining_limit(user, model_key) < amount:
+        return None
+    return {"limit_deltas": {model_key: -amount}}
+
+
+def _changes_if_exists(data: dict, user_id_str: str, changes: dict) -> dict | None:
+    return changes if user_id_str in data["users"] else None
 
 
 def decrease_limit(user_id: int, model_key: str):
     """Уменьшает лимит пользователя"""
-    data = load_user_data()
-    user_id_str = str(user_id)
+    return update_shard(shard_of(user_id), str(user_id), _spend_stored, model_key, 1, False)
+
+
+def reserve_limit(user_id: int, model_key: str, amount: int) -> bool:
+    """Атомарно списывает сразу несколько запросов, если их хватает"""
+    return update_shard(shard_of(user_id), str(user_id), _spend_stored, model_key, amount, True)
+
+
+async def refund_limit(user_id: int, model_key: str, amount: int):
+    """Возвращает списанные запросы (например, при неудачной генерации)"""
+    if amount <= 0:
+        return
     
-    if user_id_str in data["users"]:
-        if model_key in data["users"][user_id_str]["limits"]:
-            data["users"][user_id_str]["limits"][model_key] -= 1
-            save_user_data(data)
-            return True
-    return False
+    await apply_user_changes(user_id, {"limit_deltas": {model_key: amount}})
 
 
 def check_limit(user_id: int, model_key: str) -> bool:
     """Проверяет, есть ли у пользователя лимит"""
     user_data = get_user_limits(user_id)
-    return user_data["limits"].get(model_key, 0) > 0
+    return remaining_limit(user_data, model_key) > 0
 
 
 def get_user_history(user_id: int, model_key: str) -> list:
     """Получает историю сообщений пользователя для конкретной модели"""
-    data = load_user_data()
-    user_id_str = str(user_id)
-    
-    if user_id_str in data["users"]:
-        if "history" not in data["users"][user_id_str]:
-            data["users"][user_id_str]["history"] = {}
-            save_user_data(data)
-        
-        return data["users"][user_id_str]["history"].get(model_key, [])
-    
-    return []
+    user = read_user(shard_of(user_id), str(user_id))
+    if user is None:
+        return []
+    return user.get("history", {}).get(model_key, [])
 
 
 def add_to_history(user_id: int, model_key: str, user_message: str, assistant_message: str):
     """Добавляет сообщение в историю пользователя (максимум 20 сообщений)"""
-    data = load_user_data()
-    user_id_str = str(user_id)
-    
-    if user_id_str in data["users"]:
-        if "history" not in data["users"][user_id_str]:
-            data["users"][user_id_str]["history"] = {}
-        
-        if model_key not in data["users"][user_id_str]["history"]:
-            data["users"][user_id_str]["history"][model_key] = []
-        
-        # Добавляем новые сообщения
-        data["users"][user_id_str]["history"][model_key].append({
-            "role": "user",
-            "content": user_message
-        })
-        data["users"][user_id_str]["history"][model_key].append({
-            "role": "assistant",
-            "content": assistant_message
-        })
-        
-        # Ограничиваем историю последними 20 сообщениями (10 пар вопрос-ответ)
-        if len(data["users"][user_id_str]["history"][model_key]) > 20:
-            data["users"][user_id_str]["history"][model_key] = data["users"][user_id_str]["history"][model_key][-20:]
-        
-        save_user_data(data)
+    update_shard(
+        shard_of(user_id), str(user_id), _changes_if_exists,
+        {"history_ops": [("append", model_key, user_message, assistant_message)]}
+    )
 
 
 def clear_user_history(user_id: int, model_key: str = None):
     """Очищает историю пользователя для конкретной модели или всех моделей"""
-    data = load_user_data()
-    user_id_str = str(user_id)
+    update_shard(shard_of(user_id), str(user_id), _changes_if_exists, {"history_ops": [("clear", model_key)]})
+
+
+async def load_user_record(user_id: int) -> dict | None:
+    """Загружает запись пользователя (None если пользователя еще нет)"""
+    user = await run_offloaded(read_user, shard_of(user_id), str(user_id))
+    if user is not None:
+        compact_record(user)
+    return user
+
+
+async def apply_user_changes(user_id: int, changes: dict):
+    """Записывает накопленные за update изменения в журнал шарда
+
+    Изменения применяются к актуальному состоянию шарда, поэтому изменения
+    других обработчиков и других процессов не теряются: лимиты меняются
+    на разницу, а не перезаписываются. Пока пишется одна пачка, изменения
+    других обработчиков того же шарда копятся и уходят следующей пачкой
+    с одним fsync.
+    changes: {"create": bool, "tier": str | None, "limit_deltas": {model: изменение остатка},
+              "history_ops": [("append", model, user_msg, assistant_msg) | ("clear", model | None)]}
+    """
+    shard = shard_of(user_id)
+    future = asyncio.get_running_loop().create_future()
+    _pending_changes.setdefault(shard, []).append((str(user_id), changes, future))
+    # Запись пачки не прерывается отменой обработчика: в ней изменения других
+    await asyncio.shield(_commit_pending(shard))
+    await future
+
+
+async def _commit_pending(shard: int):
+    # asyncio блокировка выстраивает в очередь обработчики этого процесса,
+    # чтобы они не занимали потоки пула ожиданием файловой блокировки
+    async with shard_lock(shard):
+        batch = _pending_changes.pop(shard, None)
+        if not batch:
+            # Изменения уже записаны предыдущей пачкой
+            return
+        try:
+            await run_offloaded(commit_changes, shard, [(user_id_str, changes) for user_id_str, changes, _ in batch])
+        except Exception as e:
+            for *_, future in batch:
+                future.set_exception(e)
+        else:
+            for *_, future in batch:
+                future.set_result(None)
+
+
+def _apply_changes(data: dict, user_id_str: str, changes: dict) -> bool:
+    """Применяет изменения к данным; False если применять не к чему"""
+    if user_id_str not in data["users"]:
+        if not changes.get("create"):
+            return False
+        data["users"][user_id_str] = new_user_record()
     
-    if user_id_str in data["users"]:
-        if model_key:
-            # Очищаем историю конкретной модели
-            if "history" in data["users"][user_id_str] and model_key in data["users"][user_id_str]["history"]:
-                data["users"][user_id_str]["history"][model_key] = []
+    user = data["users"][user_id_str]
+    compact_record(user)
+    
+    tier = changes.get("tier")
+    if tier:
+        # Новый пакет - счетчики использования с нуля
+        user["tier"] = tier
+        user["used"] = [0] * len(MODEL_INDEX)
+    
+    for model_key, delta in changes.get("limit_deltas", {}).items():
+        _spend(user, model_key, -delta)
+    
+    for op in changes.get("history_ops", []):
+        history = user.setdefault("history", {})
+        if op[0] == "clear":
+            if op[1]:
+                history[op[1]] = []
+            else:
+                user["history"] = {}
         else:
-            # Очищаем всю историю
-            data["users"][user_id_str]["history"] = {}
-        
-        save_user_data(data)
+            _, model_key, user_message, assistant_message = op
+            messages = history.setdefault(model_key, [])
+            messages.append({"role": "user", "content": user_message})
+            messages.append({"role": "assistant", "content": assistant_message})
+            # Ограничиваем историю последними 20 сообщениями (10 пар вопрос-ответ)
+            if len(messages) > 20:
+                history[model_key] = messages[-20:]
+    
+    return True
+
+
+def _stress_worker(directory: str, users: int, ops: int, worker: int):
+    """Процесс стресс-теста: списания двумя способами, чтения параллельно с ними"""
+    global USER_DATA_DIR
+    USER_DATA_DIR = type(USER_DATA_DIR)(directory)
+    for op in range(ops):
+        user_id = (worker + op) % users
+        # Блокирующее чтение-изменение-запись
+        decrease_limit(user_id, "text")
+        # Чтение под разделяемой блокировкой
+        read_user(shard_of(user_id), str(user_id))
+
+    # Асинхронный путь UserContext: изменения одного update
+    async def flush_all():
+        await asyncio.gather(*(
+            apply_user_changes((worker + op) % users, {"limit_deltas": {"text": -1}})
+            for op in range(ops)
+        ))
+    asyncio.run(flush_all())
+
+
+def stress(processes: int, users: int, ops: int):
+    """Несколько процессов одновременно списывают запросы у небольшого числа пользователей
+
+    Каждая операция списывает 1 запрос, поэтому сумма used по всем
+    пользователям должна точно совпасть с числом операций.
+    """
+    import tempfile
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    global USER_DATA_DIR
+    saved_dir = USER_DATA_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        USER_DATA_DIR = type(saved_dir)(tmp)
+        _ensure_storage()
+        for user_id in range(users):
+            update_shard(shard_of(user_id), str(user_id), _create_if_missing)
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            list(pool.map(_stress_worker, [tmp] * processes, [users] * processes,
+                          [ops] * processes, range(processes)))
+        elapsed = time.perf_counter() - started
+
+        expected = processes * ops * 2
+        spent = sum(
+            user["used"][MODEL_INDEX["text"]]
+            for index in range(shard_count())
+            for user in load_shard(index)["users"].values()
+        )
+        USER_DATA_DIR = saved_dir
+        _shard_states.clear()
+
+    print(f"Процессов: {processes}, пользователей: {users}, операций: {expected} за {elapsed:.1f} сек.")
+    print(f"Списано: {spent}, ожидалось: {expected} - {'OK' if spent == expected else 'ПОТЕРЯНЫ ИЗМЕНЕНИЯ'}")
+    return spent == expected
+
+
+if __name__ == "__main__":
+    import sys
+
+    parser = argparse.ArgumentParser(description="Хранилище пользователей")
+    commands = parser.add_subparsers(dest="command", required=True)
+    reshard_parser = commands.add_parser("reshard", help="Изменить число шардов (бот должен быть остановлен)")
+    reshard_parser.add_argument("--shards", type=int, required=True)
+    stress_parser = commands.add_parser("stress", help="Проверка параллельной работы нескольких процессов")
+    stress_parser.add_argument("--processes", type=int, default=8)
+    stress_parser.add_argument("--users", type=int, default=4)
+    stress_parser.add_argument("--ops", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "reshard":
+        migrate_user_data()
+        try:
+            reshard(args.shards)
+        except RuntimeError as e:
+            print(e)
+            sys.exit(1)
+    else:
+        sys.exit(0 if stress(args.processes, args.users, args.ops) else 1)
@@ -0,0 +1,86 @@
+"""Распознавание голосовых сообщений
+
+Голосовое скачивается в память, OGG/Opus перекодируется ffmpeg в WAV
+(в общем пуле потоков offload: ffmpeg - отдельный процесс, поток только ждет его)
+и отправляется на распознавание через общий пул HTTP соединений.
+Расшифровки кэшируются по file_unique_id: пересланное голосовое
+с тем же файлом не распознается повторно, а одновременные запросы
+одного файла объединяются в один.
+"""
+import asyncio
+import logging
+import subprocess
+from io import BytesIO
+
+from config import (
+    FFMPEG_BINARY, VOICE_SAMPLE_RATE, VOICE_MAX_CONCURRENT, VOICE_CACHE_SIZE, VOICE_CACHE_TTL
+)
+from ai_generator import transcribe_audio
+from offload import run_offloaded
+from answer_cache import AnswerCache
+
+logger = logging.getLogger(__name__)
+
+# Ограничение одновременных распознаваний (перекодирование и запрос к API)
+_semaphore = None
+
+transcript_cache = AnswerCache(VOICE_CACHE_SIZE, VOICE_CACHE_TTL)
+
+
+class VoiceError(Exception):
+    """Голосовое не удалось распознать (текст - для пользователя)"""
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(VOICE_MAX_CONCURRENT)
+    return _semaphore
+
+
+def transcode_to_wav(audio_bytes: bytes) -> bytes:
+    """Перекодирует OGG/Opus в WAV моно VOICE_SAMPLE_RATE (выполняется в пуле потоков offload)
+
+    Данные передаются через stdin/stdout, без временных файлов.
+    """
+    try:
+        result = subprocess.run(
+            [
+                FFMPEG_BINARY, "-hide_banner", "-loglevel", "error",
+                "-i", "pipe:0", "-ac", "1", "-ar", str(VOICE_SAMPLE_RATE), "-f", "wav", "pipe:1",
+            ],
+            input=audio_bytes,
+            capture_output=True,
+            timeout=60
+        )
+    except FileNotFoundError:
+        raise VoiceError("❌ Распознавание голосовых недоступно: не установлен ffmpeg")
+    except subprocess.TimeoutExpired:
+        raise VoiceError("❌ Не удалось обработать голосовое: слишком долгое перекодирование")
+    if result.returncode != 0 or not result.stdout:
+        logger.error(f"ffmpeg завершился с кодом {result.returncode}: {result.stderr[-500:].decode(errors='replace')}")
+        raise VoiceError("❌ Не удалось обработать голосовое сообщение")
+    return result.stdout
+
+
+async def download_voice(bot, voice) -> bytes:
+    """Скачивает файл голосового в память (потоком, без файла на диске)"""
+    buffer = BytesIO()
+    await bot.download(voice, destination=buffer, timeout=60)
+    return buffer.getvalue()
+
+
+async def transcribe_voice(bot, voice) -> tuple[str, bool]:
+    """Возвращает (текст голосового, из_кэша)"""
+
+    async def transcribe() -> str:
+        async with _get_semaphore():
+            audio_bytes = await download_voice(bot, voice)
+            wav_bytes = await run_offloaded(transcode_to_wav, audio_bytes)
+            logger.info(
+                f"Голосовое {voice.file_unique_id}: {voice.duration} сек., "
+                f"OGG {len(audio_bytes)} байт -> WAV {len(wav_bytes)} байт"
+            )
+            return await transcribe_audio(wav_bytes)
+
+    return await transcript_cache.get_or_create((voice.file_unique_id,), transcribe)
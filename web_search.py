@@ -1,6 +1,5 @@
 """Поиск в интернете"""
 import logging
-import httpx
 
 logger = logging.getLogger(__name__)
 
@@ -10,7 +9,8 @@ async def web_search(query: str) -> str:
     try:
         logger.info(f"Ищу: {query}")
         
-        # Используем DuckDuckGo через httpx
+        # Используем DuckDuckGo через httpx (импорт при первом поиске)
+        import httpx
         async with httpx.AsyncClient() as client:
             response = await client.get(
                 "https://html.duckduckgo.com/html",